@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Hashable, Optional
+
+from config import (
+    USER_MAX_INFLIGHT,
+    USER_RATE_PER_MIN,
+    USER_BURST,
+    ADMISSION_PERMIT_TTL,
+    STATE_BACKEND,
+    AI_MAX_CONCURRENCY,
+    AI_QUEUE_MAX,
+    USER_WEIGHTS,
+)
+from shared_state import shared_state
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+OnPosition = Optional[Callable[[int], None]]
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# ============================================
+# ДОПУСК: ЛИМИТ ОДНОВРЕМЕННЫХ ЗАПРОСОВ И TOKEN BUCKET
+# ============================================
+# Проверяется на входе (handle_msg, /api/fix): лишний запрос отклоняется сразу,
+# а не занимает место в очереди к ИИ. С общим хранилищем (state: sqlite/redis)
+# лимиты общие для всех процессов; допуск процесса, упавшего не отпустив его,
+# освобождается через permit_ttl. Хранилище недоступно — лимиты этого процесса.
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float):
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, rate: float, capacity: float) -> float:
+        """0 — токен взят, иначе сколько секунд ждать следующего"""
+        now = time.monotonic()
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionControl:
+    def __init__(
+        self,
+        max_inflight: int = USER_MAX_INFLIGHT,
+        rate_per_min: float = USER_RATE_PER_MIN,
+        burst: int = USER_BURST,
+        max_users: int = 100_000,
+        state=None,
+        permit_ttl: float = ADMISSION_PERMIT_TTL,
+    ):
+        self.state = state  # None — лимиты в памяти процесса
+        self.permit_ttl = permit_ttl
+        self.max_inflight = max_inflight
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.max_users = max_users
+        self._inflight: dict[Hashable, int] = {}
+        self._buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+        self.rejected_inflight = 0
+        self.rejected_rate = 0
+
+    @asynccontextmanager
+    async def admit(self, key: Hashable):
+        if self.state is None:
+            with self._admit_local(key):
+                yield
+            return
+        try:
+            permit, reason, wait = await self.state.take_permit(str(key), self.max_inflight, self.rate, self.burst, self.permit_ttl)
+        except Exception as e:
+            logger.warning("Shared admission failed, local limits: %r", e)
+            permit = reason = None
+        if permit is None and reason is None:
+            with self._admit_local(key):
+                yield
+            return
+        if permit is None:
+            raise self._rejected(reason, wait)
+        try:
+            with self._hold(key):
+                yield
+        finally:
+            try:
+                await self.state.release_permit(str(key), permit)
+            except Exception as e:
+                logger.warning("Admission permit release failed: %r", e)
+
+    def _rejected(self, reason: str, wait: float) -> AdmissionRejected:
+        if reason == "inflight":
+            self.rejected_inflight += 1
+            return AdmissionRejected("Дождись ответа на предыдущие запросы", 10)
+        self.rejected_rate += 1
+        return AdmissionRejected("Слишком много запросов", math.ceil(wait))
+
+    @contextmanager
+    def _admit_local(self, key: Hashable):
+        if self._inflight.get(key, 0) >= self.max_inflight:
+            raise self._rejected("inflight", 0)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+        wait = bucket.take(self.rate, self.burst)
+        if wait:
+            raise self._rejected("rate", wait)
+        with self._hold(key):
+            yield
+
+    @contextmanager
+    def _hold(self, key: Hashable):
+        # Учёт допусков этого процесса (лимит в памяти, stats)
+        self._inflight[key] = self._inflight.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            left = self._inflight[key] - 1
+            if left:
+                self._inflight[key] = left
+            else:
+                del self._inflight[key]
+
+    async def sweep(self):
+        if self.state is not None:
+            # Корзина, не тронутая burst/rate секунд, снова полная — хранить незачем
+            await self.state.sweep_admission(self.burst / self.rate if self.rate else 0)
+
+    def stats(self) -> dict:
+        return {
+            "shared": int(self.state is not None),
+            "users_inflight": len(self._inflight),
+            "rejected_inflight": self.rejected_inflight,
+            "rejected_rate": self.rejected_rate,
+        }
+
+
+# ============================================
+# ЧЕСТНАЯ ОЧЕРЕДЬ К ИИ (WEIGHTED ROUND ROBIN)
+# ============================================
+# Не больше concurrency вызовов ИИ одновременно. Ожидающие стоят в очередях
+# по пользователям; освободившийся слот получает следующий пользователь
+# по кругу, пользователь с весом w получает w слотов за свой ход. Тот, кто
+# прислал 50 запросов, не задерживает остальных дольше одного круга.
+class _Waiter:
+    __slots__ = ("key", "future", "on_position", "position")
+
+    def __init__(self, key: Hashable, on_position: OnPosition):
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position = 0
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        concurrency: int = AI_MAX_CONCURRENCY,
+        max_queue: int = AI_QUEUE_MAX,
+        weights: Optional[dict] = None,
+    ):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.weights = USER_WEIGHTS if weights is None else weights
+        self._free = concurrency
+        # Порядок ключей — порядок обхода по кругу
+        self._queues: OrderedDict[Hashable, deque] = OrderedDict()
+        self._credit: dict[Hashable, int] = {}
+        self.waiting = 0
+        self.granted = 0
+        self.queued = 0
+
+    def _weight(self, key: Hashable) -> int:
+        return max(1, self.weights.get(key, 1))
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable, on_position: OnPosition = None):
+        if self._free and not self._queues:
+            self._free -= 1
+            self.granted += 1
+        else:
+            if self.waiting >= self.max_queue:
+                raise AdmissionRejected("Сервис перегружен", 30)
+            waiter = _Waiter(key, on_position)
+            self._queues.setdefault(key, deque()).append(waiter)
+            self.waiting += 1
+            self.queued += 1
+            self._notify()
+            try:
+                with span("queue.wait", waiting=self.waiting):
+                    await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.cancelled():
+                    self._remove(waiter)
+                else:
+                    self._release()  # слот выдали одновременно с отменой
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self._queues[waiter.key]
+                self._credit.pop(waiter.key, None)
+        self._notify()
+
+    def _release(self):
+        self._free += 1
+        while self._free and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self.waiting -= 1
+            self._free -= 1
+            self.granted += 1
+            waiter.future.set_result(None)
+            credit = self._credit.get(key, self._weight(key)) - 1
+            if not queue:
+                del self._queues[key]
+                self._credit.pop(key, None)
+            elif credit <= 0:
+                self._queues.move_to_end(key)
+                self._credit.pop(key, None)
+            else:
+                self._credit[key] = credit
+        self._notify()
+
+    def _notify(self):
+        """Пересчитывает места в очереди, проигрывая обход по кругу"""
+        order = 0
+        keys = deque(self._queues)
+        taken = dict.fromkeys(keys, 0)
+        credit = dict(self._credit)
+        while keys:
+            key = keys[0]
+            queue = self._queues[key]
+            waiter = queue[taken[key]]
+            taken[key] += 1
+            order += 1
+            if waiter.position != order:
+                waiter.position = order
+                if waiter.on_position is not None:
+                    try:
+                        waiter.on_position(order)
+                    except Exception as e:
+                        logger.warning("Queue position callback failed: %r", e)
+            left = credit.get(key, self._weight(key)) - 1
+            if taken[key] == len(queue):
+                keys.popleft()
+            elif left <= 0:
+                keys.rotate(-1)
+                credit.pop(key, None)
+            else:
+                credit[key] = left
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "running": self.concurrency - self._free,
+            "waiting": self.waiting,
+            "waiting_users": len(self._queues),
+            "granted": self.granted,
+            "queued": self.queued,
+        }
+
+
+admission = AdmissionControl(state=None if STATE_BACKEND == "memory" else shared_state)
+ai_scheduler = FairScheduler()
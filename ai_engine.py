@@ -1,5 +1,23 @@
-import httpx
-from config import OPENROUTER_API_KEY
+import asyncio
+import json
+import logging
+
+from config import (
+    OPENROUTER_API_KEY,
+    HEDGE_ENABLED,
+    HEDGE_DELAY,
+    MODEL_DEADLINE,
+    MODEL_DEADLINES,
+    REQUEST_BUDGET,
+)
+from http_client import get_client, UpstreamError
+from hedging import hedged_race
+from model_health import model_health
+from session_store import SessionStore
+from context_builder import build_messages, estimate_tokens, token_budget
+from database import add_tokens
+
+logger = logging.getLogger(__name__)
 
 # ============================================
 # ВСЕ ТОПОВЫЕ МОДЕЛИ 2025 (от лучшей к запасной)
@@ -20,24 +38,22 @@ MODELS = [
     "google/gemini-2.0-flash-001",               # Gemini Flash
 ]
 
-# Хранилище истории по пользователям
-user_context = {}
+# Хранилище истории по пользователям (последние 4 пары вопрос/ответ)
+user_context = SessionStore("openrouter", history_turns=4, turn_chars=1500)
 
 async def ask_openrouter(messages: list, user_id: int) -> tuple[str, str]:
     """
     Возвращает (ответ, название_модели)
     """
-    if user_id not in user_context:
-        user_context[user_id] = []
-
-    # Собираем контекст (последние 8 сообщений)
-    history = user_context[user_id][-8:]
-    
-    full_messages = [
-        {"role": "system", "content": messages[0]["content"]}
-    ] + history + [
-        {"role": "user", "content": messages[1]["content"]}
-    ]
+    # Собираем контекст (последние 8 сообщений), ужатый под бюджет модели
+    history = await user_context.history(user_id)
+    contexts: dict[int, tuple[list, int]] = {}
+
+    def context_for(model: str) -> tuple[list, int]:
+        budget = token_budget(model)
+        if budget not in contexts:
+            contexts[budget] = build_messages(messages[0]["content"], history, messages[1]["content"], budget)
+        return contexts[budget]
 
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
@@ -46,55 +62,60 @@ async def ask_openrouter(messages: list, user_id: int) -> tuple[str, str]:
         "X-Title": "BotHost AI Support"
     }
 
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        for model in MODELS:
-            try:
-                payload = {
-                    "model": model,
-                    "messages": full_messages,
-                    "temperature": 0.3,
-                    "max_tokens": 8192
-                }
-
-                response = await client.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=payload
+    async def attempt(model: str, first_byte: asyncio.Event) -> tuple[str, dict]:
+        payload = {
+            "model": model,
+            "messages": context_for(model)[0],
+            "temperature": 0.3,
+            "max_tokens": 8192
+        }
+        async with get_client("openrouter").stream(
+            "POST",
+            "/chat/completions",
+            timeout=MODEL_DEADLINES.get(model, MODEL_DEADLINE),
+            headers=headers,
+            json=payload
+        ) as response:
+            body = await response.aread()
+            # 429/503/529 — rate limit или перегруз, hedged_race пробует следующую
+            if response.status_code != 200:
+                raise UpstreamError(
+                    response.status_code, body.decode(errors="ignore"), response.headers.get("retry-after")
                 )
+            # Первый байт — только у ответа, который пойдёт в дело: быстрый отказ не должен
+            # ни попадать в TTFT, ни сдерживать запуск следующей модели
+            first_byte.set()
+            data = json.loads(body)
+            return data["choices"][0]["message"]["content"], data.get("usage") or {}
+
+    winner = await hedged_race(
+        MODELS,
+        attempt,
+        hedge_delay=HEDGE_DELAY if HEDGE_ENABLED else None,
+        deadline_for=lambda model: MODEL_DEADLINES.get(model, MODEL_DEADLINE),
+        budget=REQUEST_BUDGET,
+        health=model_health,
+    )
+    if winner:
+        model, (answer, usage) = winner
+
+        # Учёт токенов: usage от OpenRouter, иначе локальная оценка
+        tokens = usage.get("prompt_tokens", context_for(model)[1]) + usage.get("completion_tokens", estimate_tokens(answer))
+        try:
+            await add_tokens(user_id, tokens)
+        except Exception as e:
+            logger.warning("Token accounting failed: %r", e)
+
+        # Сохраняем в историю
+        await user_context.add_turn(user_id, messages[1]["content"], answer)
 
-                if response.status_code == 200:
-                    data = response.json()
-                    answer = data["choices"][0]["message"]["content"]
-                    
-                    # Сохраняем в историю
-                    user_context[user_id].append({
-                        "role": "user", 
-                        "content": messages[1]["content"][:1500]
-                    })
-                    user_context[user_id].append({
-                        "role": "assistant", 
-                        "content": answer[:1500]
-                    })
-                    
-                    # Возвращаем ответ + какая модель ответила
-                    model_name = model.split("/")[-1]
-                    return answer, model_name
-
-                elif response.status_code in [429, 503, 529]:
-                    # Rate limit или перегруз — пробуем следующую
-                    continue
-                else:
-                    print(f"[{model}] Error {response.status_code}: {response.text[:200]}")
-                    continue
-
-            except Exception as e:
-                print(f"[{model}] Exception: {e}")
-                continue
+        # Возвращаем ответ + какая модель ответила
+        model_name = model.split("/")[-1]
+        return answer, model_name
 
     return "⚠️ Все серверы ИИ сейчас перегружены. Попробуй через минуту.", "none"
 
 
 # Очистка контекста пользователя
-def clear_context(user_id: int):
-    if user_id in user_context:
-        user_context[user_id] = []
+async def clear_context(user_id: int):
+    await user_context.clear_history(user_id)
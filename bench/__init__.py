@@ -0,0 +1 @@
+# Офлайн-бенчмарки: python -m bench.<модуль>
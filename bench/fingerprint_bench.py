@@ -0,0 +1,90 @@
+import hashlib
+import re
+import sys
+import time
+from itertools import combinations
+
+from error_fingerprint import fingerprint, error_category
+from bench.fingerprint_corpus import SAME, DISTINCT
+
+
+# Прежняя реализация из main.py — для сравнения
+def legacy_hash(text: str) -> str:
+    normalized = re.sub(r'/[\w/]+/', '/PATH/', text)
+    normalized = re.sub(r'line \d+', 'line N', normalized)
+    normalized = normalized.lower().strip()
+    return hashlib.md5(normalized.encode()).hexdigest()[:16]
+
+
+def legacy_type(text: str) -> str:
+    patterns = {
+        "ModuleNotFoundError": r"ModuleNotFoundError|No module named",
+        "ImportError": r"ImportError|cannot import",
+        "SyntaxError": r"SyntaxError|invalid syntax",
+        "TypeError": r"TypeError",
+        "AttributeError": r"AttributeError",
+        "KeyError": r"KeyError",
+        "ValueError": r"ValueError",
+        "ConnectionError": r"ConnectionError|Connection refused",
+        "AuthError": r"401|403|Unauthorized",
+    }
+    for error_type, pattern in patterns.items():
+        if re.search(pattern, text, re.IGNORECASE):
+            return error_type
+    return "UnknownError"
+
+
+def check_corpus(hash_fn) -> list[str]:
+    problems = []
+    group_hashes = {}
+    for group, samples in SAME.items():
+        hashes = {hash_fn(sample) for sample in samples}
+        if len(hashes) > 1:
+            problems.append(f"{group}: {len(hashes)} разных отпечатков вместо одного")
+        group_hashes[group] = hashes
+    for group, samples in DISTINCT.items():
+        hashes = {hash_fn(sample) for sample in samples}
+        if len(hashes) < len(samples):
+            problems.append(f"{group}: разный код слился в {len(hashes)} отпечатков из {len(samples)}")
+        group_hashes[group] = hashes
+    for (a, ha), (b, hb) in combinations(group_hashes.items(), 2):
+        if ha & hb:
+            problems.append(f"{a} и {b}: одинаковый отпечаток")
+    return problems
+
+
+def bench(fn, samples: list[str], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for sample in samples:
+            fn(sample)
+    return (time.perf_counter() - start) / (rounds * len(samples)) * 1e6
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    samples = [sample for group in (*SAME.values(), *DISTINCT.values()) for sample in group]
+
+    problems = check_corpus(fingerprint)
+    legacy_problems = check_corpus(legacy_hash)
+    print(f"Корпус: {len(SAME)} + {len(DISTINCT)} групп, {len(samples)} логов")
+    print(f"  error_fingerprint: {len(problems)} проблем")
+    for problem in problems:
+        print(f"    - {problem}")
+    print(f"  legacy get_error_hash: {len(legacy_problems)} проблем")
+
+    mismatched = [s for s in samples if error_category(s) != legacy_type(s)]
+    print(f"  error_category расходится с legacy на {len(mismatched)} логах")
+
+    print(f"\nМикробенчмарк ({rounds} прогонов, мкс на лог):")
+    # Без кэша — стоимость нового текста; с кэшем — повторные вызовы в том же запросе
+    print(f"  fingerprint      {bench(fingerprint.__wrapped__, samples, rounds):8.1f}")
+    print(f"    из кэша        {bench(fingerprint, samples, rounds):8.1f}")
+    print(f"  legacy_hash      {bench(legacy_hash, samples, rounds):8.1f}")
+    print(f"  error_category   {bench(error_category, samples, rounds):8.1f}")
+    print(f"  legacy_type      {bench(legacy_type, samples, rounds):8.1f}")
+    sys.exit(1 if problems or mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# ============================================
+# КОРПУС ДЛЯ ОТПЕЧАТКОВ ОШИБОК
+# ============================================
+# SAME — группы логов, которые ДОЛЖНЫ давать один отпечаток
+# (одна и та же программа у разных пользователей/в разное время: другие пути,
+# номера строк, адреса, данные). Разные группы ДОЛЖНЫ давать разные отпечатки.
+# DISTINCT — группы, где у каждого лога СВОЙ отпечаток: разный код с одинаковым
+# итоговым исключением.
+
+SAME = {
+    "py_module_not_found": [
+        'Traceback (most recent call last):\n  File "/home/alice/bot/main.py", line 3, in <module>\n    from aiogram import Bot\nModuleNotFoundError: No module named \'aiogram\'',
+        'Traceback (most recent call last):\n  File "/root/app/main.py", line 17, in <module>\n    from aiogram import Bot\nModuleNotFoundError: No module named \'aiogram\'',
+        'Traceback (most recent call last):\n  File "C:\\Users\\bob\\Desktop\\tg\\main.py", line 1, in <module>\n    from aiogram   import Bot\nModuleNotFoundError: No module named \'aiogram\'',
+    ],
+    "py_module_not_found_requests": [
+        'Traceback (most recent call last):\n  File "/srv/main.py", line 2, in <module>\n    import requests\nModuleNotFoundError: No module named \'requests\'',
+    ],
+    "py_connection": [
+        'Traceback (most recent call last):\n  File "/usr/local/lib/python3.11/site-packages/aiohttp/connector.py", line 1025, in _create_direct_connection\n    raise last_exc\naiohttp.client_exceptions.ClientConnectorError: Cannot connect to host api.telegram.org:443 ssl:default [Connect call failed (\'149.154.167.220\', 443)]',
+        '2024-05-01 12:00:01,123 - ERROR - update 884422 failed\nTraceback (most recent call last):\n  File "/opt/venv/lib/python3.12/site-packages/aiohttp/connector.py", line 1180, in _create_direct_connection\n    raise last_exc\naiohttp.client_exceptions.ClientConnectorError: Cannot connect to host api.telegram.org:443 ssl:default [Connect call failed (\'149.154.166.110\', 443)]',
+    ],
+    "py_key_error_data": [
+        'Traceback (most recent call last):\n  File "/app/handlers.py", line 40, in on_message\n    uid = payload["user id 1234"]\nKeyError: \'user id 1234\'',
+        'Traceback (most recent call last):\n  File "/app/handlers.py", line 41, in on_message\n    uid = payload["user id 98"]\nKeyError: \'user id 98\'',
+    ],
+    "py_object_repr": [
+        "TypeError: object of type <Response object at 0x7f3a2c1d9e80> is not JSON serializable",
+        "TypeError: object of type <Response object at 0x55d1c0ffee00> is not JSON serializable",
+    ],
+    "py_tempfile_pid": [
+        "PermissionError: [Errno 13] Permission denied: '/tmp/tmpk3j9x_2a/cache.sqlite' (pid 4121)",
+        "PermissionError: [Errno 13] Permission denied: '/tmp/tmpzz81qlw0/cache.sqlite' (pid 77)",
+    ],
+    "uuid_timestamp": [
+        "2024-06-01T10:22:33.123Z ValueError: job 1b4e28ba-2fa1-11d2-883f-0016d3cca427 has invalid state",
+        "2025-01-15T08:00:00+03:00 ValueError: job 6fa459ea-ee8a-3ca4-894e-db77e160355e has invalid state",
+    ],
+    "js_cannot_find_module": [
+        "Error: Cannot find module 'express'\nRequire stack:\n- /app/index.js\n    at Function.Module._resolveFilename (node:internal/modules/cjs/loader:933:15)\n    at Object.<anonymous> (/app/index.js:1:17)",
+        "Error: Cannot find module 'express'\nRequire stack:\n- /home/dev/server/index.js\n    at Function.Module._resolveFilename (node:internal/modules/cjs/loader:1039:15)\n    at Object.<anonymous> (/home/dev/server/index.js:3:15)",
+    ],
+    "js_type_error": [
+        "TypeError: Cannot read properties of undefined (reading 'chat')\n    at handler (/app/bot.js:10:21)",
+        "TypeError: Cannot read properties of undefined (reading 'chat')\n    at handler (/srv/other/bot.js:77:5)",
+    ],
+    "telegram_conflict": [
+        "aiogram.exceptions.TelegramConflictError: Telegram server says - Conflict: terminated by other getUpdates request; make sure that only one bot instance is running",
+    ],
+    "plain_text": [
+        "бот не отвечает после деплоя, в логах пусто",
+    ],
+}
+
+DISTINCT = {
+    "key_error_price": [
+        'Traceback (most recent call last):\n  File "/app/shop/cart.py", line 12, in total\n    return sum(item["price"] for item in items)\nKeyError: \'price\'',
+        'Traceback (most recent call last):\n  File "/srv/parser/feed.py", line 88, in parse_offer\n    offer.cost = row["price"]\nKeyError: \'price\'',
+        'Traceback (most recent call last):\n  File "/srv/parser/feed.py", line 91, in parse_offer\n    offer.old_cost = prev["price"]\nKeyError: \'price\'',
+    ],
+    "none_subscriptable": [
+        'Traceback (most recent call last):\n  File "/home/u/bot/handlers.py", line 30, in on_start\n    name = user["name"]\nTypeError: \'NoneType\' object is not subscriptable',
+        'Traceback (most recent call last):\n  File "/home/u/bot/db.py", line 14, in get_balance\n    return row[0]\nTypeError: \'NoneType\' object is not subscriptable',
+    ],
+    "same_assert_template": [
+        'Traceback (most recent call last):\n  File "/ci/tests/test_cart.py", line 20, in test_total\n    assert cart.total() == 30\nAssertionError: assert 25 == 30',
+        'Traceback (most recent call last):\n  File "/ci/tests/test_cart.py", line 31, in test_discount\n    assert cart.discount() == 5\nAssertionError: assert 0 == 5',
+        'Traceback (most recent call last):\n  File "/ci/tests/test_cart.py", line 40, in test_discount\n    assert cart.items_count() == 5\nAssertionError: assert 0 == 5',
+    ],
+    "pasted_code_without_traceback": [
+        "def total(items):\n    return sum(i['price'] for i in items)\n\nKeyError: 'price'",
+        "row = cursor.fetchone()\nprint(row['price'])\n\nKeyError: 'price'",
+    ],
+}
@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from bench.updates import UpdateGenerator
+
+# ============================================
+# НАГРУЗОЧНЫЙ ТЕСТ БЕЗ РЕАЛЬНЫХ API
+# ============================================
+# Поднимает bench.mock_api отдельным процессом, направляет на него бота
+# (модели и Bot API) и гоняет handle_msg (через dp.feed_update) и /api/fix
+# с заданной параллельностью. Горячие ошибки заранее кладутся в базу знаний,
+# поэтому смесь «hit» почти не ходит к модели, а «miss» ходит всегда.
+# База, сессии и трассы — во временном каталоге.
+#
+#   python -m bench.load_test --requests 500 --concurrency 50
+#   python -m bench.load_test --save baseline.json
+#   python -m bench.load_test --baseline baseline.json   # код 1 при регрессии
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIXES = {"hit": 0.9, "miss": 0.1}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(args, port: int) -> subprocess.Popen:
+    cmd = [
+        sys.executable, "-m", "bench.mock_api", "--port", str(port),
+        "--ttft", str(args.ttft), "--tokens-per-sec", str(args.tokens_per_sec),
+        "--rate-429", str(args.rate_429), "--tg-latency", str(args.tg_latency),
+    ]
+    proc = subprocess.Popen(cmd, cwd=REPO)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return proc
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("mock_api не запустился")
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+async def run_load(items, concurrency: int, call) -> dict:
+    """Замкнутый цикл: concurrency воркеров берут следующий запрос, как только готов предыдущий"""
+    latencies: list[float] = []
+    outcomes: Counter = Counter()
+    items = iter(items)
+
+    async def worker():
+        for item in items:
+            started = time.perf_counter()
+            try:
+                outcome = await call(item)
+            except Exception as e:
+                outcome = f"error:{type(e).__name__}"
+            latencies.append((time.perf_counter() - started) * 1000)
+            outcomes[outcome] += 1
+
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / wall, 1),
+        "p50": round(percentile(latencies, 50), 1),
+        "p95": round(percentile(latencies, 95), 1),
+        "p99": round(percentile(latencies, 99), 1),
+        "max": round(latencies[-1], 1) if latencies else 0.0,
+        "rss_before_mb": round(rss_before, 1),
+        "rss_after_mb": round(rss_mb(), 1),
+        "outcomes": dict(outcomes),
+    }
+
+
+async def llm_calls(mock: httpx.AsyncClient) -> int:
+    stats = (await mock.get("/stats")).json()
+    return sum(v for k, v in stats.items() if k.startswith("llm:") and k not in ("llm:429", "llm:5xx"))
+
+
+async def bench(args, mock_url: str) -> dict:
+    app_module = importlib.import_module("main")
+    from aiogram.types import Update
+
+    logging.getLogger().setLevel(logging.WARNING)
+    app, bot, dp = app_module.app, app_module.bot, app_module.dp
+    api = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None)
+    mock = httpx.AsyncClient(base_url=mock_url)
+
+    async def fix(item) -> str:
+        user_id, text, _ = item
+        r = await api.post("/api/fix", json={"code": text, "user_id": user_id})
+        return r.json().get("source", "?") if r.status_code == 200 else f"http:{r.status_code}"
+
+    async def message(item) -> str:
+        data, _ = item
+        await dp.feed_update(bot, Update.model_validate(data, context={"bot": bot}))
+        return "ok"
+
+    results = {}
+    async with app.router.lifespan_context(app):
+        # Горячие ошибки: один проход через модель, затем высокая уверенность,
+        # чтобы база отвечала на них сама
+        generators = {mix: UpdateGenerator(args.users, ratio, args.hot_errors, args.doc_ratio, seed=i + 1)
+                      for i, (mix, ratio) in enumerate(MIXES.items()) if mix in args.mix}
+        for gen in generators.values():
+            for text in gen.hot:
+                await fix((1, text, True))
+        await app_module.kb_writes.flush()
+        async with app_module.kb_pool.writer() as db:
+            await db.execute("UPDATE solutions SET confidence = 0.9")
+
+        for target in args.target:
+            for mix, gen in generators.items():
+                calls_before = await llm_calls(mock)
+                if target == "api":
+                    result = await run_load(gen.texts(args.requests), args.concurrency, fix)
+                else:
+                    result = await run_load(gen.updates(args.requests), args.concurrency, message)
+                result["llm_calls"] = await llm_calls(mock) - calls_before
+                results[f"{target}:{mix}"] = result
+                print_result(f"{target}:{mix}", result)
+        await app_module.kb_writes.flush()
+
+    await api.aclose()
+    await mock.aclose()
+    print(f"\nПиковый RSS процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    return results
+
+
+def print_result(name: str, r: dict):
+    outcomes = " ".join(f"{k}={v}" for k, v in sorted(r["outcomes"].items()))
+    print(f"\n{name}  ({r['requests']} запросов)")
+    print(f"  пропускная способность  {r['rps']:8.1f} req/s")
+    print(f"  задержка, мс            p50 {r['p50']:.1f}  p95 {r['p95']:.1f}  p99 {r['p99']:.1f}  max {r['max']:.1f}")
+    print(f"  вызовов модели          {r['llm_calls']}   исходы: {outcomes}")
+    print(f"  RSS, MB                 {r['rss_before_mb']:.1f} → {r['rss_after_mb']:.1f}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ("p95", "p99"):
+            if base[key] and r[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {base[key]} → {r[key]} мс")
+        if base["rps"] and r["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {base['rps']} → {r['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота и /api/fix на заглушке API")
+    parser.add_argument("--target", nargs="+", choices=("telegram", "api"), default=["telegram", "api"])
+    parser.add_argument("--mix", nargs="+", choices=tuple(MIXES), default=list(MIXES))
+    parser.add_argument("--requests", type=int, default=300, help="запросов на прогон")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--hot-errors", type=int, default=20, help="горячих ошибок в базе знаний")
+    parser.add_argument("--doc-ratio", type=float, default=0.0, help="доля сообщений с документом")
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tokens-per-sec", type=float, default=300)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.02)
+    parser.add_argument("--save", help="записать результаты в JSON")
+    parser.add_argument("--baseline", help="сравнить с сохранённым JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля")
+    args = parser.parse_args()
+
+    port = free_port()
+    mock_url = f"http://127.0.0.1:{port}"
+    mock_proc = start_mock(args, port)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    # Конфиг читается при импорте main — окружение задаётся до него
+    os.environ.update({
+        "GROQ_BASE_URL": f"{mock_url}/openai/v1",
+        "OPENROUTER_BASE_URL": f"{mock_url}/api/v1",
+        "TELEGRAM_API_URL": mock_url,
+        "GROQ_API_KEY": "bench",
+        "HTTP2_ENABLED": "0",
+        "BOT_MODE": "webhook",
+        "WEBHOOK_BASE_URL": mock_url,
+        "DB_PATH": os.path.join(workdir, "knowledge_base.db"),
+        "TRACE_FILE": os.path.join(workdir, "traces.jsonl"),
+    })
+    # Лимиты на пользователя мешали бы мерить сам конвейер; переопределяются из окружения
+    os.environ.setdefault("USER_RATE_PER_MIN", "1000000")
+    os.environ.setdefault("USER_BURST", "1000000")
+    # Клиент бенча без initData — для API все запросы одного анонимного клиента (IP)
+    os.environ.setdefault("USER_MAX_INFLIGHT", "1000000")
+    sys.path.insert(0, REPO)
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    os.chdir(workdir)  # bothost.db и прочие файлы с относительными путями
+
+    try:
+        results = asyncio.run(bench(args, mock_url))
+    finally:
+        mock_proc.terminate()
+        mock_proc.wait()
+    print(f"Рабочий каталог: {workdir}")
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# ============================================
+# ЗАГЛУШКА GROQ/OPENROUTER И TELEGRAM BOT API
+# ============================================
+# Отвечает как настоящие API, но без сети и квоты: задержки, доля 429/503
+# и скорость генерации задаются флагами. Бенчмарк направляет на неё бота через
+# GROQ_BASE_URL, OPENROUTER_BASE_URL и TELEGRAM_API_URL.
+#
+#   python -m bench.mock_api --port 8900 --ttft 0.3 --tokens-per-sec 300 --rate-429 0.02
+
+ANSWER = """🔍 **Проблема:** модуль не установлен в окружении, из которого запускается бот.
+
+🔧 **Решение:**
+```python
+import subprocess
+import sys
+
+subprocess.check_call([sys.executable, "-m", "pip", "install", "aiogram"])
+```
+
+💡 **Совет:** фиксируй зависимости в requirements.txt и ставь их в venv."""
+
+settings = argparse.Namespace(
+    ttft=0.3, tokens_per_sec=300.0, answer_tokens=250, jitter=0.3,
+    rate_429=0.0, rate_5xx=0.0, tg_latency=0.02, doc_kb=256,
+)
+calls: Counter = Counter()
+app = FastAPI()
+
+
+def _jitter(seconds: float) -> float:
+    return max(0.0, seconds * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+
+
+def _answer() -> str:
+    # Ответ нужной длины: шаблон + слова-заполнители (~1 токен на слово)
+    filler = settings.answer_tokens - len(ANSWER) // 4
+    return ANSWER + ("\n\n" + " ".join(["detail"] * filler) if filler > 0 else "")
+
+
+@app.get("/health")
+async def health(): return {"status": "ok"}
+
+
+@app.get("/stats")
+async def stats(): return dict(calls)
+
+
+# ---------- chat completions ----------
+
+@app.post("/{prefix:path}/chat/completions")
+async def chat_completions(req: Request):
+    payload = await req.json()
+    model = payload.get("model", "mock")
+    calls[f"llm:{model}"] += 1
+    roll = random.random()
+    if roll < settings.rate_429:
+        calls["llm:429"] += 1
+        await asyncio.sleep(_jitter(settings.ttft) / 4)
+        return JSONResponse({"error": {"message": "Rate limit reached"}}, status_code=429, headers={"retry-after": "1"})
+    if roll < settings.rate_429 + settings.rate_5xx:
+        calls["llm:5xx"] += 1
+        await asyncio.sleep(_jitter(settings.ttft))
+        return JSONResponse({"error": {"message": "Service unavailable"}}, status_code=503)
+
+    answer = _answer()
+    words = answer.split(" ")
+    prompt_tokens = sum(len(m.get("content") or "") for m in payload.get("messages", [])) // 4
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+    generation = len(words) / settings.tokens_per_sec
+
+    if not payload.get("stream"):
+        await asyncio.sleep(_jitter(settings.ttft) + _jitter(generation))
+        return {
+            "id": "chatcmpl-mock", "object": "chat.completion", "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def events():
+        await asyncio.sleep(_jitter(settings.ttft))
+        step = 8  # слов в чанке
+        pause = generation * step / len(words)
+        for i in range(0, len(words), step):
+            text = " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")
+            chunk = {"id": "chatcmpl-mock", "model": model, "choices": [{"index": 0, "delta": {"content": text}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(_jitter(pause))
+        # usage — в последнем чанке, как у Groq
+        yield f"data: {json.dumps({'id': 'chatcmpl-mock', 'choices': [], 'x_groq': {'usage': usage}})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# ---------- Telegram Bot API ----------
+
+_message_id = 0
+
+
+def _message(fields: dict) -> dict:
+    global _message_id
+    _message_id += 1
+    return {
+        "message_id": int(fields.get("message_id") or _message_id),
+        "date": int(time.time()),
+        "chat": {"id": int(fields.get("chat_id") or 0), "type": "private"},
+        "text": fields.get("text", ""),
+    }
+
+
+@app.post("/bot{token}/{method}")
+async def bot_api(token: str, method: str, req: Request):
+    calls[f"tg:{method}"] += 1
+    fields = {}
+    if req.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        fields = {k: v[0] for k, v in parse_qs((await req.body()).decode()).items()}
+    else:
+        await req.body()  # multipart (отправка файла) — поля не нужны
+    method = method.lower()
+    if method == "getupdates":
+        # Long polling без апдейтов: держим запрос, как настоящий сервер
+        await asyncio.sleep(min(float(fields.get("timeout") or 0), 5))
+        return {"ok": True, "result": []}
+    await asyncio.sleep(_jitter(settings.tg_latency))
+    if method in ("sendmessage", "editmessagetext", "senddocument"):
+        return {"ok": True, "result": _message(fields)}
+    if method == "getfile":
+        file_id = fields.get("file_id", "doc")
+        return {"ok": True, "result": {
+            "file_id": file_id, "file_unique_id": file_id, "file_size": settings.doc_kb * 1024,
+            "file_path": f"documents/{file_id}.log",
+        }}
+    if method == "getme":
+        return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Mock", "username": "mock_bot"}}
+    return {"ok": True, "result": True}
+
+
+@app.get("/file/bot{token}/{path:path}")
+async def bot_file(token: str, path: str):
+    # Лог заданного размера: шум, повторяющиеся предупреждения и трейсбек в конце
+    calls["tg:file"] += 1
+    lines, size, i = [], 0, 0
+    while size < settings.doc_kb * 1024:
+        line = f"2024-06-01 12:00:{i % 60:02d},{i % 1000:03d} INFO worker-{i % 8} processed job {i} in {i % 97} ms"
+        if i % 50 == 0:
+            line = f"2024-06-01 12:00:{i % 60:02d} WARNING retrying request {i}: timeout"
+        lines.append(line)
+        size += len(line) + 1
+        i += 1
+    lines.append('Traceback (most recent call last):\n  File "/app/main.py", line 3, in <module>\n'
+                 "    from aiogram import Bot\nModuleNotFoundError: No module named 'aiogram'")
+    return Response("\n".join(lines), media_type="text/plain")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка LLM и Bot API для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--ttft", type=float, default=settings.ttft, help="до первого токена, сек")
+    parser.add_argument("--tokens-per-sec", type=float, default=settings.tokens_per_sec)
+    parser.add_argument("--answer-tokens", type=int, default=settings.answer_tokens)
+    parser.add_argument("--jitter", type=float, default=settings.jitter, help="разброс задержек, доля")
+    parser.add_argument("--rate-429", type=float, default=settings.rate_429)
+    parser.add_argument("--rate-5xx", type=float, default=settings.rate_5xx)
+    parser.add_argument("--tg-latency", type=float, default=settings.tg_latency, help="задержка Bot API, сек")
+    parser.add_argument("--doc-kb", type=int, default=settings.doc_kb, help="размер присылаемых документов")
+    args = parser.parse_args()
+    vars(settings).update({k: v for k, v in vars(args).items() if k in vars(settings)})
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import random
+import string
+import time
+from typing import Iterator
+
+# ============================================
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ TELEGRAM
+# ============================================
+# Сообщения с логами ошибок от множества пользователей. Доля «горячих» ошибок
+# (hit_ratio) — повторы небольшого набора, который бенчмарк заранее кладёт в
+# базу знаний; остальные уникальны и уходят к модели.
+
+# База отвечает и по типу ошибки (error_category), поэтому горячие и новые ошибки
+# берутся из шаблонов разных категорий — иначе «новые» находились бы по типу
+HOT_TEMPLATES = [
+    'Traceback (most recent call last):\n  File "/app/{mod}.py", line {n}, in <module>\n'
+    "    import {pkg}\nModuleNotFoundError: No module named '{pkg}'",
+    'Traceback (most recent call last):\n  File "/srv/{mod}/handlers.py", line {n}, in {fn}\n'
+    "    value = payload[\"{key}\"]\nKeyError: '{key}'",
+]
+COLD_TEMPLATES = [
+    'Traceback (most recent call last):\n  File "/home/user/{mod}/bot.py", line {n}, in {fn}\n'
+    "    await {obj}.{attr}()\nAttributeError: '{cls}' object has no attribute '{attr}'",
+    "TypeError: Cannot read properties of undefined (reading '{attr}')\n    at {fn} (/app/{mod}.js:{n}:17)",
+    "aiogram.exceptions.TelegramBadRequest: Telegram server says - Bad Request: {words}",
+    "sqlite3.OperationalError: no such column: {key} in \"SELECT {key} FROM {obj}\"",
+]
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 10)))
+
+
+def error_log(rng: random.Random, templates: list[str] = COLD_TEMPLATES) -> str:
+    """Новая ошибка: шаблон + случайные имена и текст, чтобы не совпасть ни с чем в базе"""
+    names = {
+        "mod": _word(rng), "pkg": _word(rng), "fn": _word(rng), "key": _word(rng), "obj": _word(rng),
+        "attr": _word(rng), "cls": _word(rng).capitalize(), "n": rng.randint(1, 400),
+        "words": " ".join(_word(rng) for _ in range(6)),
+    }
+    text = rng.choice(templates).format(**names)
+    # Пояснение пользователя: делает тексты непохожими и для поиска похожих (MinHash)
+    return text + "\n\n" + " ".join(_word(rng) for _ in range(rng.randint(8, 20)))
+
+
+def make_update(update_id: int, user_id: int, text: str = "", document: bool = False) -> dict:
+    """Апдейт в формате Bot API (как в getUpdates/вебхуке)"""
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+    }
+    if document:
+        message["document"] = {
+            "file_id": f"doc{update_id}", "file_unique_id": f"doc{update_id}",
+            "file_name": "error.log", "mime_type": "text/plain", "file_size": 0,
+        }
+        message["caption"] = text or "упал после деплоя, лог во вложении"
+    else:
+        message["text"] = text
+    return {"update_id": update_id, "message": message}
+
+
+class UpdateGenerator:
+    def __init__(self, users: int = 500, hit_ratio: float = 0.5, hot_errors: int = 20,
+                 document_ratio: float = 0.0, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.hit_ratio = hit_ratio
+        self.document_ratio = document_ratio
+        self.hot = [error_log(self.rng, HOT_TEMPLATES) for _ in range(hot_errors)]
+        self._update_id = 0
+
+    def texts(self, count: int) -> Iterator[tuple[int, str, bool]]:
+        """(user_id, текст, горячая ли ошибка) — для /api/fix и для апдейтов"""
+        for _ in range(count):
+            user_id = 10_000 + self.rng.randrange(self.users)
+            if self.hot and self.rng.random() < self.hit_ratio:
+                yield user_id, self.rng.choice(self.hot), True
+            else:
+                yield user_id, error_log(self.rng), False
+
+    def updates(self, count: int) -> Iterator[tuple[dict, bool]]:
+        for user_id, text, hot in self.texts(count):
+            self._update_id += 1
+            document = self.rng.random() < self.document_ratio
+            yield make_update(self._update_id, user_id, "" if document else text, document), hot
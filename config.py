@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "7869311061:AAGPstYpuGk7CZTHBQ-_1IL7FCXDyUfIXPY")
@@ -5,4 +6,213 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "7869311061:AAGPstYpuGk7CZTHBQ-_1IL7FCXDyUfIX
 # OpenRouter — ОДИН КЛЮЧ = ВСЕ МОДЕЛИ
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "sk-or-v1-94c...c21")  # Твой ключ
 
+# Groq (текст + Whisper)
+GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+
 ADMIN_ID = 8473513085
+
+# ============================================
+# HTTP-клиенты к провайдерам (пул соединений)
+# ============================================
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL", "https://api.groq.com/openai/v1")
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Лимиты пула на провайдера
+GROQ_MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", "50"))
+GROQ_MAX_KEEPALIVE = int(os.getenv("GROQ_MAX_KEEPALIVE", "20"))
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "50"))
+OPENROUTER_MAX_KEEPALIVE = int(os.getenv("OPENROUTER_MAX_KEEPALIVE", "20"))
+
+# ============================================
+# Хеджирование запросов к моделям
+# ============================================
+# Через сколько секунд без первого байта запускать следующую модель параллельно
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") == "1"
+HEDGE_DELAY = float(os.getenv("HEDGE_DELAY", "4"))
+# Дедлайн одной попытки и общий бюджет запроса (сек)
+MODEL_DEADLINE = float(os.getenv("MODEL_DEADLINE", "60"))
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", "90"))
+# Персональные дедлайны: "llama-3.3-70b-versatile=45,gemma2-9b-it=20"
+MODEL_DEADLINES = {
+    model.strip(): float(seconds)
+    for model, seconds in (
+        item.split("=", 1) for item in os.getenv("MODEL_DEADLINES", "").split(",") if "=" in item
+    )
+}
+
+# ============================================
+# Circuit breaker моделей
+# ============================================
+HEALTH_WINDOW = float(os.getenv("HEALTH_WINDOW", "60"))            # окно статистики ошибок (сек)
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))  # доля ошибок для размыкания
+BREAKER_MIN_SAMPLES = int(os.getenv("BREAKER_MIN_SAMPLES", "4"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))      # сколько модель пропускается
+SLOW_MODEL_LATENCY = float(os.getenv("SLOW_MODEL_LATENCY", "20"))  # EWMA выше — модель уходит вниз
+
+# ============================================
+# Потоковые ответы
+# ============================================
+STREAM_ENABLED = os.getenv("STREAM_ENABLED", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # мин. интервал правок в Telegram
+
+# ============================================
+# База знаний (SQLite)
+# ============================================
+DB_PATH = os.getenv("DB_PATH", "knowledge_base.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))                   # соединений на чтение
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))   # page cache на соединение
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# In-memory кэш перед базой знаний. У каждого процесса свой; записи других
+# процессов (таблица kb_changes) сбрасывают его раз в SHARED_SYNC_INTERVAL
+KB_CACHE_MAX_ENTRIES = int(os.getenv("KB_CACHE_MAX_ENTRIES", "5000"))
+KB_CACHE_MAX_BYTES = int(os.getenv("KB_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+KB_CACHE_TTL = float(os.getenv("KB_CACHE_TTL", "600"))
+
+# Счётчики /api/stats и /start ведут триггеры (таблица kb_stats); сверка с COUNT(*), сек
+KB_STATS_RECONCILE_INTERVAL = float(os.getenv("KB_STATS_RECONCILE_INTERVAL", "3600"))
+
+# Поиск похожих ошибок (MinHash + LSH)
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "1") == "1"
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.6"))
+SIMILARITY_TOP_K = int(os.getenv("SIMILARITY_TOP_K", "5"))
+SIMILARITY_NUM_PERM = int(os.getenv("SIMILARITY_NUM_PERM", "64"))
+SIMILARITY_BANDS = int(os.getenv("SIMILARITY_BANDS", "16"))
+
+# ============================================
+# Несколько процессов / реплик
+# ============================================
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))                     # процессов uvicorn
+# Реплики на разных машинах сами не определяются: SHARED_STATE=1 и STATE_BACKEND=redis
+SHARED_STATE = WEB_WORKERS > 1 or os.getenv("SHARED_STATE", "0") == "1"
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite" if SHARED_STATE else "memory")  # memory | sqlite | redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")       # redis или совместимый (KeyDB, Valkey)
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "15"))        # аренда лидера (polling), сек
+SHARED_SYNC_INTERVAL = float(os.getenv("SHARED_SYNC_INTERVAL", "10"))  # сброс счётчиков, подгрузка индекса
+
+# ============================================
+# Сессии пользователей
+# ============================================
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", STATE_BACKEND)        # memory | sqlite | redis
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", str(6 * 3600)))
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+
+# ============================================
+# Бюджет токенов контекста
+# ============================================
+# Сколько входных токенов (system + история + запрос) отправлять модели
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+# Персональные бюджеты: "gemma2-9b-it=7000,mixtral-8x7b-32768=20000"
+MODEL_TOKEN_BUDGETS = {
+    model.strip(): int(tokens)
+    for model, tokens in (
+        item.split("=", 1) for item in os.getenv("MODEL_TOKEN_BUDGETS", "").split(",") if "=" in item
+    )
+}
+
+# ============================================
+# Отложенная запись в базу знаний
+# ============================================
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))           # записей в одной транзакции
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "0.5"))  # макс. задержка записи (сек)
+WRITE_QUEUE_MAX = int(os.getenv("WRITE_QUEUE_MAX", "10000"))           # больше — put() ждёт (backpressure)
+
+# ============================================
+# Режим получения апдейтов Telegram
+# ============================================
+BOT_MODE = os.getenv("BOT_MODE", "polling")                        # polling | webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")               # https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; по умолчанию — производный от токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:48]
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))            # одновременно обрабатываемых апдейтов
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))    # больше — отвечаем 503, Telegram повторит
+# Свой сервер Bot API (telegram-bot-api, заглушка bench.mock_api); пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "0") == "1"   # telegram-bot-api --local: файлы на диске
+# initData Mini App (подпись ботом) старше этого не принимается, сек
+WEBAPP_AUTH_MAX_AGE = int(os.getenv("WEBAPP_AUTH_MAX_AGE", str(24 * 3600)))
+
+# ============================================
+# Допуск запросов к ИИ (лимиты и честная очередь)
+# ============================================
+# Лимиты пользователя общие для всех процессов, если STATE_BACKEND sqlite/redis;
+# при memory — на процесс (один процесс, как раньше)
+USER_MAX_INFLIGHT = int(os.getenv("USER_MAX_INFLIGHT", "2"))          # одновременных запросов на пользователя
+USER_RATE_PER_MIN = float(os.getenv("USER_RATE_PER_MIN", "10"))       # пополнение token bucket
+USER_BURST = int(os.getenv("USER_BURST", "5"))                        # ёмкость token bucket
+ADMISSION_PERMIT_TTL = float(os.getenv("ADMISSION_PERMIT_TTL", "600"))  # допуск упавшего процесса освобождается через, сек
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))        # одновременных вызовов ИИ на процесс
+AI_QUEUE_MAX = int(os.getenv("AI_QUEUE_MAX", "500"))                  # ожидающих в очереди, больше — отказ
+# Веса в очереди (weighted round robin): "8473513085=4"; по умолчанию 1
+USER_WEIGHTS = {
+    int(user.strip()): int(weight)
+    for user, weight in (
+        item.split("=", 1) for item in os.getenv("USER_WEIGHTS", "").split(",") if "=" in item
+    )
+}
+
+# ============================================
+# Статика Mini App
+# ============================================
+# Минифицируется и сжимается (gzip, brotli — если установлен пакет brotli) при старте
+STATIC_DIR = os.getenv("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "3600"))        # файлы без ?v=<хэш>, сек
+STATIC_COMPRESS_MIN = int(os.getenv("STATIC_COMPRESS_MIN", "512"))  # меньше — не сжимаем
+
+# ============================================
+# Очередь задач ИИ (SQLite)
+# ============================================
+# Роли процесса: api — HTTP (Mini App, /api/*, вебхук), bot — приём апдейтов
+# Telegram, worker — выполнение задач. По умолчанию всё в одном процессе;
+# раздельно: ROLES=api,bot и ROLES=worker на той же базе знаний
+ROLES = {role.strip() for role in os.getenv("ROLES", "api,bot,worker").split(",") if role.strip()}
+JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE_ENABLED", "1") == "1"       # 0 — ИИ прямо в обработчике, как раньше
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "16"))                    # задач одновременно на процесс-воркер
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "30"))  # без продления задача снова в очереди
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))     # опрос базы, когда задач нет / ждём чужой воркер
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))            # сколько хранить завершённые задачи, сек
+JOB_PRIORITY_BOT = int(os.getenv("JOB_PRIORITY_BOT", "10"))          # больше — раньше
+JOB_PRIORITY_API = int(os.getenv("JOB_PRIORITY_API", "0"))
+JOB_PRIORITY_BATCH = int(os.getenv("JOB_PRIORITY_BATCH", "-10"))     # /api/fix/batch — после интерактивных
+
+# /api/fix/batch: ошибок в одном запросе и одновременных обращений к ИИ на запрос
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# ============================================
+# Трассировка запросов
+# ============================================
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))     # доля трасс, записываемых в файл
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))            # медленные и с ошибкой пишутся всегда
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "500"))                     # последних трасс в памяти для /traces
+# Токен для служебных эндпоинтов (/api/traces/slow); пустой — эндпоинты закрыты
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# ============================================
+# Логирование
+# ============================================
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Уровни по модулям: "hedging=ERROR,write_queue=DEBUG"; httpx и aiogram.event
+# пишут строку на каждый запрос/апдейт, поэтому по умолчанию приглушены
+LOG_LEVELS = {
+    name.strip(): level.strip().upper()
+    for name, level in (
+        item.split("=", 1)
+        for item in os.getenv("LOG_LEVELS", "httpx=WARNING,httpcore=WARNING,aiogram.event=WARNING").split(",")
+        if "=" in item
+    )
+}
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")                         # text | json
+LOG_FILE = os.getenv("LOG_FILE", "")                                 # пусто — только stderr
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))           # переполнение — запись отбрасывается
+# Одинаковых предупреждений/ошибок (по шаблону сообщения) за окно, остальные считаются
+LOG_REPEAT_LIMIT = int(os.getenv("LOG_REPEAT_LIMIT", "5"))
+LOG_REPEAT_WINDOW = float(os.getenv("LOG_REPEAT_WINDOW", "60"))
@@ -0,0 +1,144 @@
+import logging
+import re
+
+from config import CONTEXT_TOKEN_BUDGET, MODEL_TOKEN_BUDGETS
+
+logger = logging.getLogger(__name__)
+
+# ============================================
+# СБОРКА КОНТЕКСТА ПОД БЮДЖЕТ ТОКЕНОВ
+# ============================================
+# Токены считаются локально, без токенизатора: ~4 символа ASCII на токен,
+# не-ASCII (кириллица) — ~2.5 символа. Число не-ASCII символов = байты UTF-8
+# минус символы, это считается без цикла по строке.
+# Порядок приоритетов: system prompt целиком → текст пользователя (большие логи
+# ужимаются до хвоста трейсбека и строк с ошибками) → история от новой к старой.
+
+MESSAGE_OVERHEAD = 4          # служебные токены роли/разделителей на сообщение
+MIN_USER_TOKENS = 512         # столько получает запрос, даже если system prompt съел весь бюджет
+HISTORY_SHARE = 0.2           # доля бюджета, которую запрос оставляет истории
+MAX_LINE_CHARS = 500          # длиннее — строка обрезается (минифицированный JS, base64)
+TAIL_SHARE = 0.5              # доля бюджета лога под хвост (последний трейсбек)
+HEAD_SHARE = 0.1              # начало лога: команда запуска, версии
+ERROR_CONTEXT = 1             # строк вокруг строки с ошибкой
+
+_ERROR_LINE = re.compile(
+    r"error|exception|traceback|fatal|critical|panic|failed|errno|refused|denied|"
+    r"not found|cannot|can't|undefined|unexpected|ошибка",
+    re.I,
+)
+
+
+def estimate_tokens(text: str) -> int:
+    chars = len(text)
+    wide = len(text.encode()) - chars
+    return int((chars - wide) / 4 + wide / 2.5) + 1
+
+
+def token_budget(model_id: str) -> int:
+    return MODEL_TOKEN_BUDGETS.get(model_id, CONTEXT_TOKEN_BUDGET)
+
+
+def shrink_log(text: str, max_tokens: int) -> str:
+    """Ужимает лог до max_tokens: хвост, строки с ошибками (с соседними), начало"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    budget = int(max_tokens * len(text) / tokens)  # бюджет в символах этого текста
+    lines = [
+        line if len(line) <= MAX_LINE_CHARS else line[:MAX_LINE_CHARS] + " …"
+        for line in text.splitlines()
+    ]
+    keep: set[int] = set()
+    used = 0
+
+    def take(i: int) -> bool:
+        nonlocal used
+        if i in keep:
+            return True
+        cost = len(lines[i]) + 1
+        if used + cost > budget:
+            return False
+        keep.add(i)
+        used += cost
+        return True
+
+    # 1. Хвост: итоговое исключение и самые глубокие кадры
+    for i in range(len(lines) - 1, -1, -1):
+        if used + len(lines[i]) + 1 > budget * TAIL_SHARE or not take(i):
+            break
+    # 2. Начало лога
+    for i in range(len(lines)):
+        if used + len(lines[i]) + 1 > budget * (TAIL_SHARE + HEAD_SHARE) or not take(i):
+            break
+    # 3. Строки с ошибками, с конца — последние ближе к причине
+    for i in range(len(lines) - 1, -1, -1):
+        if used >= budget:
+            break
+        if i not in keep and _ERROR_LINE.search(lines[i]):
+            for j in range(max(0, i - ERROR_CONTEXT), min(len(lines), i + ERROR_CONTEXT + 1)):
+                take(j)
+    # 4. Остаток бюджета — дальше от хвоста
+    for i in range(len(lines) - 1, -1, -1):
+        if i not in keep and not take(i):
+            break
+
+    out, skipped = [], 0
+    for i, line in enumerate(lines):
+        if i in keep:
+            if skipped:
+                out.append(f"… [пропущено строк: {skipped}] …")
+                skipped = 0
+            out.append(line)
+        else:
+            skipped += 1
+    if skipped:
+        out.append(f"… [пропущено строк: {skipped}] …")
+    return "\n".join(out)
+
+
+def clip_reply(text: str, max_tokens: int) -> str:
+    """Сокращает старый ответ ассистента до начала — там суть решения"""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:int(max_tokens * len(text) / tokens)].rsplit("\n", 1)[0] + "\n…"
+
+
+def build_messages(system: str, history: list[dict], user_text: str, budget: int) -> tuple[list[dict], int]:
+    """Возвращает (messages, оценка входных токенов), уложенные в budget"""
+    used = estimate_tokens(system) + MESSAGE_OVERHEAD
+    available = budget - used
+    if available < MIN_USER_TOKENS:
+        logger.warning("System prompt (%d tokens) leaves %d of %d for the request", used, available, budget)
+        available = MIN_USER_TOKENS
+
+    user_limit = int(available * (1 - HISTORY_SHARE)) if history else available
+    user_text = shrink_log(user_text, user_limit - MESSAGE_OVERHEAD)
+    user_tokens = estimate_tokens(user_text) + MESSAGE_OVERHEAD
+    used += user_tokens
+    left = available - user_tokens
+
+    # История парами (вопрос, ответ) от новой к старой; не влезающая пара
+    # ужимается, а если не влезает и так — она и всё, что старше, отбрасываются
+    kept: list[dict] = []
+    for start in range(len(history) - 2, -1, -2):
+        pair = history[start:start + 2]
+        cost = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in pair)
+        if cost > left:
+            half = left // 2 - MESSAGE_OVERHEAD
+            if half <= 0:
+                break
+            pair = [
+                {**m, "content": shrink_log(m["content"], half) if m["role"] == "user" else clip_reply(m["content"], half)}
+                for m in pair
+            ]
+            cost = sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD for m in pair)
+            if cost > left:
+                break
+        kept[:0] = pair
+        left -= cost
+        used += cost
+
+    messages = [{"role": "system", "content": system}] + kept + [{"role": "user", "content": user_text}]
+    return messages, used
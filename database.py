@@ -1,6 +1,7 @@
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy import Integer, String, DateTime, func, select, BigInteger
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import datetime
 
 DATABASE_URL = "sqlite+aiosqlite:///bothost.db"
@@ -44,6 +45,18 @@ async def increment_stats(tg_id: int):
             user.request_count += 1
             await session.commit()
 
+async def add_tokens(tg_id: int, tokens: int):
+    # Один upsert: параллельные запросы одного пользователя (и первые два для нового)
+    # не теряют приращения и не падают на UNIQUE
+    stmt = sqlite_insert(User).values(telegram_id=tg_id, tokens_used=tokens)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={"tokens_used": User.tokens_used + stmt.excluded.tokens_used},
+    )
+    async with async_session() as session:
+        await session.execute(stmt)
+        await session.commit()
+
 async def get_stats():
     async with async_session() as session:
         total = await session.scalar(select(func.count(User.id)))
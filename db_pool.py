@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiosqlite
+
+from config import DB_PATH, DB_READERS, DB_CACHE_SIZE_KB, DB_MMAP_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================
+# ПУЛ СОЕДИНЕНИЙ SQLITE (WAL)
+# ============================================
+# Долгоживущие соединения вместо aiosqlite.connect() на каждую операцию:
+#   - N читателей работают параллельно (WAL не блокирует чтение записью);
+#   - один писатель, записи сериализуются через lock;
+#   - у каждого соединения свой кэш подготовленных запросов (cached_statements),
+#     поэтому одинаковый SQL не компилируется заново.
+class SQLitePool:
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self._readers: Optional[asyncio.Queue] = None
+        self._all: list[aiosqlite.Connection] = []
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path, cached_statements=256)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA journal_mode = WAL")
+        # В WAL режиме NORMAL безопасен: fsync только на checkpoint, не на каждый commit
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        await conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        await conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        await conn.execute("PRAGMA busy_timeout = 5000")
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # Писатель первым — он переводит файл в WAL
+            self._writer = await self._connect()
+            self._readers = asyncio.Queue()
+            for _ in range(self.readers_count):
+                self._readers.put_nowait(await self._connect())
+            logger.info("SQLite pool ready: %s (1 writer, %d readers)", self.path, self.readers_count)
+
+    async def close(self):
+        async with self._open_lock:
+            connections, self._all = self._all, []
+            self._writer, self._readers = None, None
+            for conn in connections:
+                await conn.close()
+
+    @asynccontextmanager
+    async def reader(self):
+        if self._writer is None:
+            await self.open()
+        queue = self._readers
+        conn = await queue.get()
+        try:
+            yield conn
+        finally:
+            queue.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Единственный писатель: commit при выходе, rollback при исключении"""
+        if self._writer is None:
+            await self.open()
+        async with self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+
+
+kb_pool = SQLitePool(DB_PATH)
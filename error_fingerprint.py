@@ -0,0 +1,154 @@
+import hashlib
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+# ============================================
+# НОРМАЛИЗАЦИЯ ТРЕЙСБЕКОВ И ОТПЕЧАТОК ОШИБКИ
+# ============================================
+# Все регулярки скомпилированы один раз при импорте.
+# Отпечаток = тип исключения + кадр библиотеки (если ошибка в ней) + самый
+# глубокий кадр кода пользователя (файл и функция) + шаблон сообщения + строки
+# кода пользователя. Из шаблона и кода вычищено то, что отличается между
+# запусками одной программы: пути, адреса памяти, время, PID, UUID, временные
+# файлы, номера строк, данные в кавычках. Разный код с одинаковым итоговым
+# исключением (KeyError: 'price' в двух программах) — разные отпечатки: от
+# отпечатка зависят точные ответы базы знаний и singleflight.
+
+# Порядок важен: сначала длинные/специфичные шаблоны, потом общие.
+# Третье поле — без чего шаблон не может совпасть: подстроки (хоть одна),
+# DIGIT — цифра, DIGIT_SEP — цифра-разделитель-цифра (даты, время, :10:21).
+# Текст уже в нижнем регистре; проверка дешевле прогона регулярки впустую
+DIGIT, DIGIT_SEP = "digit", "digit_sep"
+_NOISE = [
+    (re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b"), "<uuid>", ("-",)),
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}[t ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:z|[+-]\d{2}:?\d{2})?"), "<ts>", DIGIT_SEP),
+    (re.compile(r"\b\d{4}[-/.]\d{2}[-/.]\d{2}\b|\b\d{2}[-/.]\d{2}[-/.]\d{4}\b"), "<date>", DIGIT_SEP),
+    (re.compile(r"\b\d{1,2}:\d{2}:\d{2}(?:[.,]\d+)?\b"), "<time>", DIGIT_SEP),
+    (re.compile(r"\b0x[0-9a-f]+\b"), "<addr>", ("0x",)),
+    (re.compile(r"\b(?:pid|process|thread)[\s=:#]*\d+\b"), "pid <n>", ("pid", "process", "thread")),
+    (re.compile(r"\b(?:tmp|temp)[\w\-]{4,}"), "<tmp>", ("tmp", "temp")),
+    (re.compile(r"\b[a-z]:\\(?:[^\\\s\"'<>|:*?]+\\)*"), "<path>/", (":\\",)),
+    (re.compile(r"(?:~|\.{1,2})?(?:/[\w.\-@+]+)+/"), "<path>/", ("/",)),
+    (re.compile(r"\bline \d+"), "line <n>", ("line ",)),
+    (re.compile(r":\d+:\d+\b"), ":<n>:<n>", DIGIT_SEP),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "<n>", DIGIT),
+]
+_DIGIT = re.compile(r"\d")
+_DIGIT_SEP = re.compile(r"\d[-/.:]\d")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r"\s+")
+# Значения в кавычках: имена (модулей, ключей, атрибутов) оставляем — от них зависит
+# решение; данные (с пробелами, цифрами, длинные) заменяем на <val>
+_QUOTED = re.compile(r"'([^'\n]{0,200})'|\"([^\"\n]{0,200})\"")
+_IDENTIFIER = re.compile(r"[A-Za-z_][\w.\-]{0,63}")
+
+# Python: Foo.BarError: message / KeyError: 'x'; JS: TypeError: x is not a function
+_EXCEPTION_LINE = re.compile(
+    r"^\s*(?:[\w.]+\.)?((?:[A-Z]\w*)?(?:Error|Exception|Warning|Exit|Interrupt|Fault))\b:?\s*(.*)$",
+    re.M,
+)
+# Кадр Python и строка кода под ним (если есть; следующий File — не код)
+_PY_FRAME = re.compile(r'File "([^"]+)", line \d+, in ([\w<>.]+)(?:\r?\n[ \t]+(?!File ")(\S[^\n]*))?')
+_JS_FRAME = re.compile(r"^\s*at (?:([\w$.<>\[\] ]+?) \()?([^()\s]+?)(?::\d+){1,2}\)?\s*$", re.M)
+_PATH_SEP = re.compile(r"[\\/]")
+# Кадр внутри библиотеки говорит о причине; кадр в файле пользователя — нет (main.py vs bot.py)
+_LIBRARY_PATH = re.compile(r"site-packages|dist-packages|node_modules|[\\/]lib[\\/]python|<frozen|^node:", re.I)
+
+# Категории ошибок для solutions.error_type (порядок = приоритет)
+_CATEGORIES = [
+    ("ModuleNotFoundError", re.compile(r"ModuleNotFoundError|No module named", re.I)),
+    ("ImportError", re.compile(r"ImportError|cannot import", re.I)),
+    ("SyntaxError", re.compile(r"SyntaxError|invalid syntax", re.I)),
+    ("TypeError", re.compile(r"TypeError", re.I)),
+    ("AttributeError", re.compile(r"AttributeError", re.I)),
+    ("KeyError", re.compile(r"KeyError", re.I)),
+    ("ValueError", re.compile(r"ValueError", re.I)),
+    ("ConnectionError", re.compile(r"ConnectionError|Connection refused", re.I)),
+    ("AuthError", re.compile(r"401|403|Unauthorized", re.I)),
+]
+
+
+class ParsedError(NamedTuple):
+    exc_type: Optional[str]
+    library_frame: str   # самый глубокий кадр, если он в библиотеке
+    user_frame: str      # самый глубокий кадр кода пользователя
+    template: str
+    code: str            # строки кода пользователя (или весь текст без строки исключения)
+
+
+def _basename(path: str) -> str:
+    return _PATH_SEP.split(path)[-1]
+
+
+def _quoted(match: re.Match) -> str:
+    value = match.group(1) if match.group(1) is not None else match.group(2)
+    return f"'{value}'" if _IDENTIFIER.fullmatch(value) else "'<val>'"
+
+
+def normalize(text: str) -> str:
+    """Убирает из текста всё пользовательское, приводит к нижнему регистру"""
+    if "'" in text or '"' in text:
+        text = _QUOTED.sub(_quoted, text)
+    text = text.lower()
+    hints = {DIGIT: _DIGIT.search(text) is not None}
+    hints[DIGIT_SEP] = hints[DIGIT] and _DIGIT_SEP.search(text) is not None
+    for pattern, replacement, needs in _NOISE:
+        if hints[needs] if isinstance(needs, str) else any(map(text.__contains__, needs)):
+            text = pattern.sub(replacement, text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def _normalize_code(line: str) -> str:
+    # Строка кода: данные в кавычках и числа — шум, имена и операторы — нет
+    return _SPACES.sub(" ", _NUMBER.sub("<n>", _QUOTED.sub(_quoted, line))).strip()
+
+
+def parse(text: str) -> ParsedError:
+    # Последнее исключение в тексте — итоговое (в Python оно внизу трейсбека)
+    exc_type, message = None, ""
+    for match in _EXCEPTION_LINE.finditer(text):
+        exc_type, message = match.group(1), match.group(2)
+
+    # Кадры от самого глубокого: в Python — снизу вверх, в JS — сверху вниз
+    frames = [(path, func, code) for path, func, code in _PY_FRAME.findall(text)][::-1]
+    if not frames and "at " in text:
+        frames = [(m.group(2), m.group(1) or "<anonymous>", "") for m in _JS_FRAME.finditer(text)]
+
+    library_frame, user_frame, code = "", "", []
+    for i, (path, func, line) in enumerate(frames):
+        in_library = bool(_LIBRARY_PATH.search(path))
+        if in_library:
+            if i == 0:
+                library_frame = f"{_basename(path)}:{func}"
+            continue
+        if not user_frame:
+            user_frame = f"{_basename(path)}:{func}"
+        if line:
+            code.append(_normalize_code(line))
+    if not frames and exc_type:
+        # Трейсбека нет: кодом считается всё, что прислали кроме самой ошибки
+        rest = "\n".join(line for line in text.splitlines() if not _EXCEPTION_LINE.match(line))
+        code = [normalize(rest)] if rest.strip() else []
+
+    template = normalize(message if exc_type else text)
+    return ParsedError(exc_type, library_frame, user_frame, template, "\n".join(code))
+
+
+# Один и тот же текст за запрос считается несколько раз: поиск в базе,
+# ключ singleflight, сохранение решения
+@lru_cache(maxsize=256)
+def fingerprint(text: str) -> str:
+    parsed = parse(text)
+    if parsed.exc_type:
+        key = f"{parsed.exc_type}|{parsed.library_frame}|{parsed.user_frame}|{parsed.template}|{parsed.code}"
+    else:
+        key = parsed.template
+    return hashlib.md5(key.encode()).hexdigest()[:16]
+
+
+def error_category(text: str) -> str:
+    for category, pattern in _CATEGORIES:
+        if pattern.search(text):
+            return category
+    return "UnknownError"
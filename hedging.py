@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from http_client import UpstreamError
+from metrics import UPSTREAM_SECONDS, UPSTREAM_TTFT_SECONDS
+from model_health import ModelHealthRegistry
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================
+# ХЕДЖИРОВАННЫЕ ЗАПРОСЫ К МОДЕЛЯМ
+# ============================================
+# Запускаем основную модель. Если за hedge_delay от неё не пришёл первый байт —
+# параллельно стартуем следующую по списку. Ошибка модели (429, 5xx, таймаут)
+# сразу запускает следующую. Побеждает первый успешный ответ, остальные
+# попытки отменяются. Весь запрос ограничен общим бюджетом budget.
+#
+# attempt(model, first_byte) должен:
+#   - вызвать first_byte.set(), как только провайдер начал отвечать;
+#   - вернуть результат или бросить исключение при неудаче.
+
+Attempt = Callable[[Any, asyncio.Event], Awaitable[Any]]
+
+
+class _FirstByte(asyncio.Event):
+    """Event первого байта, который при первом set() сообщает время до него (TTFT)"""
+
+    def __init__(self, on_first: Callable[[], None]):
+        super().__init__()
+        self._on_first = on_first
+
+    def set(self):
+        if not self.is_set():
+            self._on_first()
+        super().set()
+
+
+async def hedged_race(
+    models: list,
+    attempt: Attempt,
+    *,
+    hedge_delay: Optional[float],
+    deadline_for: Callable[[Any], float],
+    budget: float,
+    name_of: Callable[[Any], str] = str,
+    key_of: Callable[[Any], str] = str,
+    health: Optional[ModelHealthRegistry] = None,
+) -> Optional[tuple[Any, Any]]:
+    """
+    Возвращает (модель, результат) первой успешной попытки или None.
+    hedge_delay=None — последовательный режим (следующая модель только после ошибки).
+    health — реестр здоровья: открытые модели пропускаются, исходы попыток записываются
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget
+    queue = health.rank(models, key_of) if health else list(models)
+    running: dict[asyncio.Task, tuple[Any, asyncio.Event]] = {}
+
+    async def timed(model, first_byte: asyncio.Event, started: float):
+        if health:
+            health.begin(key_of(model))
+        try:
+            result = await asyncio.wait_for(attempt(model, first_byte), deadline_for(model))
+        except asyncio.CancelledError:
+            UPSTREAM_SECONDS.labels(key_of(model), "cancelled").observe(loop.time() - started)
+            raise  # проигравшая попытка — не ошибка модели
+        except Exception as e:
+            if isinstance(e, UpstreamError):
+                status = str(e.status_code)
+            elif isinstance(e, asyncio.TimeoutError):
+                status = "timeout"
+            else:
+                status = "error"
+            UPSTREAM_SECONDS.labels(key_of(model), status).observe(loop.time() - started)
+            if health:
+                if isinstance(e, UpstreamError):
+                    health.record_failure(key_of(model), e.status_code, e.retry_after)
+                else:
+                    health.record_failure(key_of(model))
+            raise
+        UPSTREAM_SECONDS.labels(key_of(model), "200").observe(loop.time() - started)
+        if health:
+            health.record_success(key_of(model), loop.time() - started)
+        return result
+
+    def launch():
+        model = queue.pop(0)
+        started = loop.time()
+        first_byte = _FirstByte(
+            lambda: UPSTREAM_TTFT_SECONDS.labels(key_of(model)).observe(loop.time() - started)
+        )
+        task = asyncio.create_task(timed(model, first_byte, started))
+        running[task] = (model, first_byte)
+
+    try:
+        while queue or running:
+            if not running:
+                launch()
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.warning("Hedged request budget %.1fs exhausted", budget)
+                return None
+
+            # Хеджируем, только пока ни одна попытка не начала отвечать
+            responding = any(ev.is_set() for _, ev in running.values())
+            if hedge_delay is None or responding or not queue:
+                timeout = remaining
+            else:
+                timeout = min(hedge_delay, remaining)
+
+            done, _ = await asyncio.wait(
+                running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            failed = False
+            for task in done:
+                model, _ = running.pop(task)
+                error = task.exception()
+                if error is None:
+                    return model, task.result()
+                failed = True
+                logger.warning(
+                    "Model %s failed: %r", name_of(model), error,
+                    extra={"status": getattr(error, "status_code", type(error).__name__)},
+                )
+
+            if not queue:
+                continue
+            responding = any(ev.is_set() for _, ev in running.values())
+            if failed or (not done and hedge_delay is not None and not responding):
+                launch()
+        return None
+    finally:
+        for task in running:
+            task.cancel()
@@ -0,0 +1,84 @@
+from typing import Optional
+
+import httpx
+
+from config import (
+    GROQ_BASE_URL,
+    OPENROUTER_BASE_URL,
+    HTTP2_ENABLED,
+    HTTP_KEEPALIVE_EXPIRY,
+    GROQ_MAX_CONNECTIONS,
+    GROQ_MAX_KEEPALIVE,
+    OPENROUTER_MAX_CONNECTIONS,
+    OPENROUTER_MAX_KEEPALIVE,
+)
+
+# ============================================
+# ОБЩИЕ HTTP/2 КЛИЕНТЫ (один пул на провайдера)
+# ============================================
+# Клиенты живут всё время работы процесса: TLS-рукопожатие и соединения
+# переиспользуются между сообщениями. Открываются в lifespan (open_clients),
+# закрываются при остановке (close_clients).
+PROVIDERS = {
+    "groq": {
+        "base_url": GROQ_BASE_URL,
+        "max_connections": GROQ_MAX_CONNECTIONS,
+        "max_keepalive": GROQ_MAX_KEEPALIVE,
+    },
+    "openrouter": {
+        "base_url": OPENROUTER_BASE_URL,
+        "max_connections": OPENROUTER_MAX_CONNECTIONS,
+        "max_keepalive": OPENROUTER_MAX_KEEPALIVE,
+    },
+}
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _build_client(provider: str) -> httpx.AsyncClient:
+    cfg = PROVIDERS[provider]
+    return httpx.AsyncClient(
+        base_url=cfg["base_url"],
+        http2=HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=cfg["max_connections"],
+            max_keepalive_connections=cfg["max_keepalive"],
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        # Таймаут задаётся на каждый запрос, здесь только подключение
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+
+
+def get_client(provider: str) -> httpx.AsyncClient:
+    """
+    Возвращает общий клиент провайдера (создаёт лениво, если lifespan ещё не открыл)
+    """
+    client = _clients.get(provider)
+    if client is None or client.is_closed:
+        client = _clients[provider] = _build_client(provider)
+    return client
+
+
+async def open_clients():
+    for provider in PROVIDERS:
+        get_client(provider)
+
+
+async def close_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+class UpstreamError(Exception):
+    """Провайдер ответил не 200 (429, 5xx и т.д.)"""
+
+    def __init__(self, status_code: int, body: str = "", retry_after: Optional[str] = None):
+        super().__init__(f"HTTP {status_code}: {body[:200]}")
+        self.status_code = status_code
+        try:
+            self.retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            self.retry_after = None
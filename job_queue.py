@@ -0,0 +1,345 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from config import (
+    JOB_WORKERS,
+    JOB_MAX_ATTEMPTS,
+    JOB_VISIBILITY_TIMEOUT,
+    JOB_POLL_INTERVAL,
+    JOB_RETENTION,
+)
+from db_pool import kb_pool
+
+logger = logging.getLogger(__name__)
+
+# Прогресс задачи: ("delta", полный текст ответа) или ("queue", место в очереди)
+OnProgress = Callable[[str, object], None]
+Handler = Callable[[dict, OnProgress], Awaitable[dict]]
+
+
+class RetryableJobError(Exception):
+    """Задачу стоит повторить позже (все модели недоступны и т.п.)"""
+
+
+# ============================================
+# ОЧЕРЕДЬ ЗАДАЧ ИИ В SQLITE
+# ============================================
+# Фронтенды (бот, /api/fix) ставят задачу и ждут результат, воркеры (в этом
+# или другом процессе на той же базе) забирают задачи по приоритету.
+# Базу опрашивает один цикл на процесс, задачи выполняются в пределах
+# JOB_WORKERS одновременно. Взятая задача невидима JOB_VISIBILITY_TIMEOUT
+# секунд; воркер продлевает невидимость каждую треть таймаута и заодно
+# сохраняет частичный ответ — только если задачу ждут не в этом процессе
+# (своим ожидающим прогресс передаётся в памяти). Упал процесс —
+# задача снова становится видимой и достаётся другому воркеру. Ошибка —
+# повтор с паузой 2^попытка сек, после max_attempts — failed.
+# Ожидающий в том же процессе получает прогресс и результат сразу, без
+# чтения базы; из другого процесса — опросом раз в JOB_POLL_INTERVAL.
+class JobQueue:
+    def __init__(
+        self,
+        pool,
+        workers: int = JOB_WORKERS,
+        visibility_timeout: float = JOB_VISIBILITY_TIMEOUT,
+        poll_interval: float = JOB_POLL_INTERVAL,
+    ):
+        self.pool = pool
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._handlers: dict[str, Handler] = {}
+        self._loop_task: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(workers)
+        self._wakeup = asyncio.Event()
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._listeners: dict[int, OnProgress] = {}
+        self._running: dict[int, dict] = {}  # задачи этого процесса -> их прогресс
+        self._stopping = False
+        self.busy = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    # ---------- постановка и ожидание ----------
+
+    async def submit(self, kind: str, payload: dict, priority: int = 0, max_attempts: int = JOB_MAX_ATTEMPTS) -> tuple[int, str]:
+        """(id — для wait/get внутри процесса, token — для клиентов снаружи)"""
+        now = time.time()
+        # id идут подряд — наружу отдаётся только случайный token
+        token = secrets.token_urlsafe(16)
+        async with self.pool.writer() as db:
+            cursor = await db.execute(
+                "INSERT INTO jobs (kind, priority, payload, max_attempts, visible_at, created_at, updated_at, token) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, priority, json.dumps(payload, ensure_ascii=False), max_attempts, now, now, now, token),
+            )
+            job_id = cursor.lastrowid
+        self._wakeup.set()
+        return job_id, token
+
+    async def find(self, token: str) -> Optional[int]:
+        async with self.pool.reader() as db:
+            row = await (await db.execute("SELECT id FROM jobs WHERE token = ?", (token,))).fetchone()
+        return row[0] if row else None
+
+    async def get(self, job_id: int) -> Optional[dict]:
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                "SELECT id, kind, priority, status, attempts, max_attempts, progress, result, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            )
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["progress"] = json.loads(job["progress"]) if job["progress"] else None
+        if job_id in self._running and job["status"] == "running":
+            # Свежее, чем в базе: в базу прогресс пишется редко или вовсе не пишется
+            state = self._running[job_id]["state"]
+            job["progress"] = list(state) if state else job["progress"]
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        if job["status"] == "queued":
+            job["position"] = await self.position(job_id, job["priority"])
+        return job
+
+    async def position(self, job_id: int, priority: int) -> int:
+        """Место в очереди: 1 — следующая"""
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority > ? OR (priority = ? AND id < ?))",
+                (priority, priority, job_id),
+            )
+            return (await cursor.fetchone())[0] + 1
+
+    async def wait(self, job_id: int, on_progress: Optional[OnProgress] = None, timeout: Optional[float] = None) -> dict:
+        """Ждёт завершения задачи, возвращает её строку (status done/failed)"""
+        loop = asyncio.get_running_loop()
+        future = self._waiters.setdefault(job_id, loop.create_future())
+        if on_progress:
+            self._listeners[job_id] = on_progress
+        deadline = loop.time() + timeout if timeout else None
+        seen = None
+        try:
+            while True:
+                wait = self.poll_interval if deadline is None else min(self.poll_interval, deadline - loop.time())
+                if wait <= 0:
+                    raise asyncio.TimeoutError
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), wait)
+                except asyncio.TimeoutError:
+                    pass
+                if not future.done() and job_id in self._running:
+                    continue  # выполняется здесь: результат придёт через future, прогресс — через listener
+                # Результат и прогресс чужого воркера видны только в базе
+                job = await self.get(job_id)
+                if job is None:
+                    raise KeyError(job_id)
+                if job["status"] in ("done", "failed"):
+                    return job
+                if on_progress and job_id not in self._running:
+                    state = ("queue", job["position"]) if job["status"] == "queued" else tuple(job["progress"] or ())
+                    if state and state != seen:
+                        seen = state
+                        on_progress(*state)
+        finally:
+            self._waiters.pop(job_id, None)
+            self._listeners.pop(job_id, None)
+
+    # ---------- воркеры ----------
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    def start(self):
+        if self._loop_task is None:
+            self._stopping = False
+            self._loop_task = asyncio.create_task(self._claim_loop())
+
+    async def stop(self, timeout: float = 10):
+        """Новые задачи не берутся, взятые доделываются timeout секунд, остальные возвращаются в очередь"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._loop_task is None:
+            return
+        # Цикл может ждать свободный слот — будить его незачем, просто снимаем
+        self._loop_task.cancel()
+        await asyncio.gather(self._loop_task, return_exceptions=True)
+        self._loop_task = None
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _claim_loop(self):
+        while not self._stopping:
+            await self._slots.acquire()
+            try:
+                job = await self._claim() if not self._stopping else None
+            except Exception as e:
+                logger.warning("Job claim failed: %r", e)
+                job = None
+            if job is None:
+                self._slots.release()
+                if self._stopping:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._run_slot(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            # Сразу пробуем следующую: в очереди может быть ещё работа
+            self._wakeup.set()
+
+    async def _run_slot(self, job: dict):
+        self.busy += 1
+        try:
+            await self._run(job)
+        finally:
+            self.busy -= 1
+            self._slots.release()
+
+    async def _claim(self) -> Optional[dict]:
+        kinds = tuple(self._handlers)
+        if not kinds:
+            return None
+        now = time.time()
+        marks = ",".join("?" * len(kinds))
+        # Дешёвая проверка читателем: пустая очередь не берёт блокировку записи
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                f"SELECT 1 FROM jobs WHERE status IN ('queued', 'running') AND visible_at <= ? AND kind IN ({marks}) LIMIT 1",
+                (now, *kinds),
+            )
+            if await cursor.fetchone() is None:
+                return None
+        async with self.pool.writer() as db:
+            cursor = await db.execute(
+                f"""
+                UPDATE jobs SET status = 'running', locked_by = ?, attempts = attempts + 1,
+                                visible_at = ?, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status IN ('queued', 'running') AND visible_at <= ? AND kind IN ({marks})
+                    ORDER BY priority DESC, id LIMIT 1
+                )
+                RETURNING id, kind, payload, attempts, max_attempts
+                """,
+                (self.worker_id, now + self.visibility_timeout, now, now, *kinds),
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+        return dict(row) if row else None
+
+    async def _run(self, job: dict):
+        job_id = job["id"]
+        if job["attempts"] > job["max_attempts"]:
+            # Воркер, взявший задачу в прошлый раз, пропал (таймаут невидимости)
+            await self._finish(job_id, "failed", error="visibility timeout")
+            return
+        progress = {"state": None, "saved": None}
+        self._running[job_id] = progress
+
+        def on_progress(kind: str, value):
+            progress["state"] = (kind, value)
+            listener = self._listeners.get(job_id)
+            if listener:
+                listener(kind, value)
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, progress))
+        try:
+            result = await self._handlers[job["kind"]](json.loads(job["payload"]), on_progress)
+        except asyncio.CancelledError:
+            # Остановка процесса: задачу сразу отдаём другим воркерам, не ждём таймаута
+            await asyncio.shield(self._finish(job_id, "queued", error="worker stopped"))
+            raise
+        except Exception as e:
+            retry = isinstance(e, RetryableJobError) and job["attempts"] < job["max_attempts"]
+            if not isinstance(e, RetryableJobError):
+                logger.error("Job %d (%s) failed: %r", job_id, job["kind"], e)
+            await self._finish(job_id, "queued" if retry else "failed", error=repr(e), retry_in=2 ** job["attempts"])
+        else:
+            await self._finish(job_id, "done", result=result)
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+
+    async def _heartbeat(self, job_id: int, progress: dict):
+        # Продление невидимости + частичный ответ, если ждут из другого процесса
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            state = progress["state"] if job_id not in self._waiters else progress["saved"]
+            now = time.time()
+            try:
+                async with self.pool.writer() as db:
+                    await db.execute(
+                        "UPDATE jobs SET visible_at = ?, updated_at = ?, progress = COALESCE(?, progress) "
+                        "WHERE id = ? AND locked_by = ? AND status = 'running'",
+                        (now + self.visibility_timeout, now,
+                         json.dumps(state, ensure_ascii=False) if state != progress["saved"] else None,
+                         job_id, self.worker_id),
+                    )
+                progress["saved"] = state
+            except Exception as e:
+                logger.warning("Job %d heartbeat failed: %r", job_id, e)
+
+    async def _finish(self, job_id: int, status: str, result: Optional[dict] = None,
+                      error: Optional[str] = None, retry_in: float = 0):
+        now = time.time()
+        async with self.pool.writer() as db:
+            # Только свою задачу: после таймаута невидимости её мог забрать другой воркер
+            cursor = await db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, visible_at = ?, updated_at = ?, locked_by = NULL "
+                "WHERE id = ? AND locked_by = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                 now + retry_in, now, job_id, self.worker_id),
+            )
+            owned = cursor.rowcount
+        if not owned:
+            logger.warning("Job %d was taken over by another worker", job_id)
+            return
+        if status == "queued":
+            self.retried += 1
+            return
+        if status == "done":
+            self.completed += 1
+        else:
+            self.failed += 1
+        future = self._waiters.get(job_id)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def purge(self, older_than: float = JOB_RETENTION):
+        async with self.pool.writer() as db:
+            await db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - older_than,),
+            )
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers if self._loop_task else 0,
+            "busy": self.busy,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "waiting": len(self._waiters),
+        }
+
+
+jobs = JobQueue(kb_pool)
@@ -0,0 +1,101 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import KB_CACHE_MAX_ENTRIES, KB_CACHE_MAX_BYTES, KB_CACHE_TTL
+
+
+# ============================================
+# LRU/TTL КЭШ ПЕРЕД БАЗОЙ ЗНАНИЙ
+# ============================================
+# Ключ — нормализованный хэш ошибки, значение — строка solutions.
+# Ограничен и по числу записей, и по памяти; устаревает по TTL.
+# Записи в solutions обязаны вызывать invalidate(error_hash); записи других
+# процессов приходят через журнал kb_changes (main.sync_kb_cache).
+class KBCache:
+    def __init__(self, max_entries: int = KB_CACHE_MAX_ENTRIES, max_bytes: int = KB_CACHE_MAX_BYTES, ttl: float = KB_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, int, dict]] = OrderedDict()
+        # error_hash строки -> ключи, под которыми она лежит (поиск по типу ошибки отдаёт чужие строки)
+        self._by_row: dict[str, set[str]] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _sizeof(row: dict) -> int:
+        return sys.getsizeof(row) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in row.items())
+
+    def get(self, key: str) -> Optional[dict]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, _, row = item
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return row
+
+    def put(self, key: str, row: dict):
+        size = self._sizeof(row)
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (time.monotonic() + self.ttl, size, row)
+        self._by_row.setdefault(row.get("error_hash"), set()).add(key)
+        self.bytes += size
+        while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, size, row = self._data.pop(key)
+        self.bytes -= size
+        keys = self._by_row.get(row.get("error_hash"))
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self._by_row[row.get("error_hash")]
+
+    def invalidate(self, error_hash: str):
+        """Сбрасывает запись по ключу и все записи, где лежит строка с этим хэшем"""
+        keys = set(self._by_row.get(error_hash, ()))
+        if error_hash in self._data:
+            keys.add(error_hash)
+        for key in keys:
+            self._remove(key)
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self._data.clear()
+        self._by_row.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+kb_cache = KBCache()
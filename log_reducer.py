@@ -0,0 +1,315 @@
+import codecs
+import re
+import zlib
+from collections import OrderedDict, deque
+from typing import AsyncIterable, Optional
+
+# ============================================
+# ПОТОКОВОЕ СЖАТИЕ БОЛЬШИХ ЛОГОВ
+# ============================================
+# Лог читается кусками и разбирается построчно, в памяти держится только
+# ограниченное: начало лога, хвост, последние MAX_BLOCKS уникальных блоков
+# ошибок (трейсбек/стек + соседние строки) и кольцо строк перед текущей.
+# Повторы подряд схлопываются в счётчик, одинаковые блоки — в один с числом
+# повторов, длинные стеки — до первых и последних кадров.
+
+PASSTHROUGH_CHARS = 64 * 1024   # короче — лог отдаётся как есть
+MAX_LINE_CHARS = 500
+HEAD_LINES = 20
+TAIL_LINES = 40
+CONTEXT_BEFORE = 5
+CONTEXT_AFTER = 3
+FRAMES_HEAD = 2                 # первые кадры стека — точка входа
+FRAMES_TAIL = 8                 # последние — место падения
+ENTRY_LINES = 3                 # кадр + строка кода (+ ^^^ у Python 3.11)
+TRAILER_LINES = 10              # сообщение исключения после кадров
+MAX_BLOCKS = 20
+SEEN_LINES = 50_000             # память дедупликации строк (ключи crc32)
+
+_TRACEBACK_START = re.compile(r"Traceback \(most recent call last\)|^\s*(?:During handling|The above exception)")
+# Python: File "x.py", line 1; JS/Java/Go: at fn (file.js:1:2) / at x.Y(Y.java:10) / file.go:12 +0x1d
+_FRAME = re.compile(r'File "[^"]+", line \d+|(?:^|\s)at \S.*:\d+\)?\s*$|^\s+\S+\.go:\d+')
+_EXCEPTION = re.compile(r"^\s*(?:[\w.]+\.)?(?:[A-Z]\w*)?(?:Error|Exception|Warning|Exit|Interrupt|Fault)\b")
+_ERROR_LINE = re.compile(r"\b(?:error|fatal|critical|panic|exception|failed|errno)\b|ошибка", re.I)
+# Предфильтр: строка, где нет ни одного из признаков выше, — обычная (это почти весь лог)
+_SIGNAL = re.compile("|".join(p.pattern for p in (_TRACEBACK_START, _FRAME, _EXCEPTION, _ERROR_LINE)), re.I | re.M)
+_DIGITS = str.maketrans("", "", "0123456789")
+# Префиксы docker compose ("app-1  | ") и docker logs -t ("2024-01-01T00:00:00.123Z ")
+_PREFIX = re.compile(r"^(?:[\w.\-]+\s+\| ?|\d{4}-\d\d-\d\dT[\d:.]+Z )")
+
+
+def _key(line: str) -> int:
+    # Строки, отличающиеся только числами (время, PID, номера), считаем одинаковыми
+    return zlib.crc32(line.translate(_DIGITS).encode())
+
+
+class _Block:
+    __slots__ = ("context", "head", "tail", "skipped", "trailer", "after", "last_frame", "repeats", "message_lines")
+
+    def __init__(self, context: list[str]):
+        self.context = context
+        self.head: list[list[str]] = []
+        self.tail: deque = deque(maxlen=FRAMES_TAIL)
+        self.skipped = 0
+        self.trailer: list[str] = []
+        self.after = 0          # > 0 — собираем строки после исключения
+        self.last_frame: Optional[int] = None
+        self.repeats = 0
+        self.message_lines = 0  # строк сообщения исключения в trailer (дальше — контекст после)
+
+    def add_frame(self, line: str):
+        # Рекурсия: одинаковые кадры подряд — один кадр со счётчиком
+        key = hash(line)
+        if key == self.last_frame:
+            self.repeats += 1
+            return
+        self._flush_repeats()
+        self.last_frame = key
+        entry = [line]
+        if len(self.head) < FRAMES_HEAD:
+            self.head.append(entry)
+        else:
+            if len(self.tail) == self.tail.maxlen:
+                self.skipped += 1
+            self.tail.append(entry)
+
+    def add_line(self, line: str, continuation: bool = False):
+        # continuation — строка с отступом после кадра (код, ^^^), идёт в кадр
+        frames = self.tail or self.head
+        if continuation and self.repeats:
+            return  # код повторённого кадра
+        if continuation and frames and not self.trailer and self.repeats == 0 and len(frames[-1]) < ENTRY_LINES:
+            frames[-1].append(line)
+        elif len(self.trailer) < TRAILER_LINES + CONTEXT_AFTER:
+            self._flush_repeats()
+            self.trailer.append(line)
+
+    def _flush_repeats(self):
+        if self.repeats:
+            frames = self.tail or self.head
+            frames[-1].append(f"  [кадр повторён ещё {self.repeats} раз]")
+            self.repeats = 0
+
+    def render(self) -> str:
+        self._flush_repeats()
+        lines = list(self.context)
+        for entry in self.head:
+            lines.extend(entry)
+        if self.skipped:
+            lines.append(f"  … [пропущено кадров: {self.skipped}] …")
+        for entry in self.tail:
+            lines.extend(entry)
+        lines.extend(self.trailer)
+        return "\n".join(lines)
+
+    def signature(self) -> int:
+        # Контекст в ключ не входит: тот же трейсбек с разными соседями — повтор
+        frames = [line for entry in (*self.head, *self.tail) for line in entry]
+        return _key("\n".join(frames + self.trailer[:self.message_lines or TRAILER_LINES]))
+
+
+class LogReducer:
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._partial = ""
+        self._skip_to_newline = False
+        self._raw: Optional[list[str]] = []     # пока лог короткий — храним целиком
+        self._raw_chars = 0
+
+        self.lines = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self._head: list[str] = []
+        self._tail: deque = deque(maxlen=TAIL_LINES)
+        self._before: deque = deque(maxlen=CONTEXT_BEFORE)
+        self._seen: set[int] = set()
+        self._last_key: Optional[int] = None
+        self._repeats = 0
+
+        self._block: Optional[_Block] = None
+        self._pending_error: Optional[list[str]] = None
+        # signature -> [текст, повторы]; порядок — последнее появление
+        self._blocks: OrderedDict[int, list] = OrderedDict()
+
+    # ---------- ввод ----------
+
+    def feed(self, chunk: bytes):
+        self.bytes += len(chunk)
+        self.feed_text(self._decoder.decode(chunk))
+
+    def feed_text(self, text: str):
+        if self._raw is not None:
+            self._raw.append(text)
+            self._raw_chars += len(text)
+            if self._raw_chars > PASSTHROUGH_CHARS:
+                self._raw = None
+        text = self._partial + text
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            if self._skip_to_newline:
+                self._skip_to_newline = False
+                continue
+            self._line(line)
+        # Гигантская строка без переводов (минифицированный файл) не копится в памяти
+        if len(self._partial) > MAX_LINE_CHARS:
+            if not self._skip_to_newline:
+                self._line(self._partial)
+                self._skip_to_newline = True
+            self._partial = ""
+
+    def close(self):
+        tail = self._partial + self._decoder.decode(b"", final=True)
+        self._partial = ""
+        if tail and not self._skip_to_newline:
+            self._line(tail)
+        self._flush_repeats()
+        self._close_block()
+        self._flush_pending()
+
+    # ---------- разбор ----------
+
+    def _line(self, line: str):
+        line = line.rstrip("\r\n\t ")
+        if len(line) > MAX_LINE_CHARS:
+            line = line[:MAX_LINE_CHARS] + " …"
+        self.lines += 1
+
+        key = _key(line)
+        if key == self._last_key:
+            self._repeats += 1
+            self.duplicates += 1
+            return
+        self._flush_repeats()
+        self._last_key = key
+        self._classify(line, key)
+
+    def _flush_repeats(self):
+        if self._repeats:
+            repeats, self._repeats = self._repeats, 0
+            self._classify(f"  [строка повторена ещё {repeats} раз]", None)
+
+    def _classify(self, line: str, key: Optional[int]):
+        body = _PREFIX.sub("", line, 1)
+        block = self._block
+        if block is None and self._pending_error is None and not _SIGNAL.search(body):
+            self._plain(line, key)
+            return
+        if block is not None:
+            if block.after:
+                if _TRACEBACK_START.search(body) or _FRAME.search(body) or _EXCEPTION.search(body) or _ERROR_LINE.search(body):
+                    self._close_block()
+                else:
+                    block.add_line(line)
+                    block.after -= 1
+                    if not block.after:
+                        self._close_block()
+                    return
+            elif _FRAME.search(body):
+                block.add_frame(line)
+                return
+            elif body[:1].isspace() or not body:
+                block.add_line(line, continuation=True)
+                return
+            elif _EXCEPTION.search(body) or _ERROR_LINE.search(body):
+                block.add_line(line)
+                block.message_lines = len(block.trailer)
+                block.after = CONTEXT_AFTER
+                return
+            else:
+                self._close_block()
+
+        if _TRACEBACK_START.search(body):
+            self._flush_pending()
+            self._open_block([line])
+            return
+        if _FRAME.search(body):
+            # Стек без заголовка (JS/Java): строка ошибки прямо перед ним — заголовок
+            header = self._pending_error or []
+            self._pending_error = None
+            self._open_block(header)
+            self._block.add_frame(line)
+            return
+
+        self._flush_pending()
+        if _ERROR_LINE.search(body) or _EXCEPTION.search(body):
+            self._pending_error = [line]
+            return
+        self._plain(line, key)
+
+    def _plain(self, line: str, key: Optional[int]):
+        # Обычная строка: начало лога, пока до первой ошибки; потом контекст и хвост,
+        # повторы по всему логу отбрасываем
+        if len(self._head) < HEAD_LINES and not self._blocks:
+            self._head.append(line)
+            return
+        if key is not None:
+            if key in self._seen:
+                self.duplicates += 1
+                return
+            if len(self._seen) >= SEEN_LINES:
+                self._seen.clear()
+            self._seen.add(key)
+        self._before.append(line)
+        self._tail.append(line)
+
+    def _open_block(self, header: list[str]):
+        context = list(self._before) + header
+        self._before.clear()
+        self._tail.clear()  # хвост — только то, что после последней ошибки
+        self._block = _Block(context)
+
+    def _close_block(self):
+        block, self._block = self._block, None
+        if block is not None:
+            self._remember(block.signature(), block.render())
+
+    def _flush_pending(self):
+        if self._pending_error is not None:
+            line = self._pending_error[0]
+            self._pending_error = None
+            context = list(self._before)
+            self._before.clear()
+            self._tail.clear()
+            self._remember(_key(line), "\n".join(context + [line]))
+
+    def _remember(self, signature: int, text: str):
+        entry = self._blocks.get(signature)
+        if entry is not None:
+            entry[1] += 1
+            self._blocks.move_to_end(signature)
+            return
+        self._blocks[signature] = [text, 1]
+        if len(self._blocks) > MAX_BLOCKS:
+            self._blocks.popitem(last=False)
+
+    # ---------- результат ----------
+
+    def result(self) -> str:
+        self.close()
+        if self._raw is not None:
+            return "".join(self._raw)
+        parts = [f"[лог сокращён: {self.lines} строк, показаны начало, блоки ошибок и конец]"]
+        parts.append("\n".join(self._head))
+        for text, count in self._blocks.values():
+            parts.append("…")
+            parts.append(text if count == 1 else f"{text}\n  [этот блок встретился {count} раз]")
+        if self._tail:
+            parts.append("…")
+            parts.append("\n".join(self._tail))
+        return "\n".join(parts)
+
+
+def reduce_log(text: str) -> str:
+    if len(text) <= PASSTHROUGH_CHARS:
+        return text
+    reducer = LogReducer()
+    reducer.feed_text(text)
+    return reducer.result()
+
+
+async def reduce_stream(chunks: AsyncIterable[bytes]) -> str:
+    reducer = LogReducer()
+    async for chunk in chunks:
+        reducer.feed(chunk)
+    return reducer.result()
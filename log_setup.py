@@ -0,0 +1,164 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import time
+from typing import Optional
+from logging.handlers import QueueHandler, QueueListener
+
+from config import (
+    LOG_LEVEL,
+    LOG_LEVELS,
+    LOG_FORMAT,
+    LOG_FILE,
+    LOG_QUEUE_SIZE,
+    LOG_REPEAT_LIMIT,
+    LOG_REPEAT_WINDOW,
+)
+
+# ============================================
+# ЛОГИРОВАНИЕ БЕЗ БЛОКИРОВКИ EVENT LOOP
+# ============================================
+# Логгеры кладут записи в очередь, в поток/файл их пишет отдельный поток
+# (QueueListener). В event loop остаётся только подстановка аргументов в
+# шаблон; трейсбеки и форматирование строки — в потоке записи. Повторы одного
+# предупреждения (по шаблону, не по тексту) сверх LOG_REPEAT_LIMIT за окно
+# отбрасываются и считаются — во время падения провайдера каждая попытка
+# модели иначе писала бы строку. Поля из extra={...} выводятся как key=value
+# (или ключами JSON при LOG_FORMAT=json).
+
+MAX_REPEAT_KEYS = 1000
+
+# Атрибуты любой LogRecord; всё остальное пришло из extra (color_message — копия
+# сообщения с ANSI-цветами от uvicorn)
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "color_message"}
+
+
+def _extras(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _STANDARD}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        extras = _extras(record)
+        if extras:
+            line += " " + " ".join(f"{k}={v}" for k, v in extras.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_extras(record),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RepeatFilter(logging.Filter):
+    """Пропускает limit одинаковых WARNING+ за window секунд; число отброшенных
+    добавляется полем suppressed к первой записи следующего окна"""
+
+    def __init__(self, limit: int = LOG_REPEAT_LIMIT, window: float = LOG_REPEAT_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.suppressed = 0
+        self._seen: dict[tuple, list] = {}  # (логгер, уровень, шаблон) -> [начало окна, записей]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.limit <= 0:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        entry = self._seen.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            if entry is not None and entry[1] > self.limit:
+                record.suppressed = entry[1] - self.limit
+            if entry is None and len(self._seen) >= MAX_REPEAT_KEYS:
+                self._seen.clear()
+            self._seen[key] = [now, 1]
+            return True
+        entry[1] += 1
+        if entry[1] <= self.limit:
+            return True
+        self.suppressed += 1
+        return False
+
+
+class AsyncQueueHandler(QueueHandler):
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляем сразу (объекты могут измениться), exc_info оставляем —
+        # трейсбек отформатирует поток записи
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listeners: list[QueueListener] = []
+_root_handler: Optional[AsyncQueueHandler] = None
+repeat_filter = RepeatFilter()
+
+
+def offload(*handlers: logging.Handler) -> AsyncQueueHandler:
+    """Обёртка над обычными обработчиками: запись — в отдельном потоке"""
+    q: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return AsyncQueueHandler(q)
+
+
+def setup_logging():
+    global _root_handler
+    if _root_handler is not None:
+        return
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+    handlers: list[logging.Handler] = [logging.StreamHandler()]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _root_handler = offload(*handlers)
+    _root_handler.addFilter(repeat_filter)
+    root = logging.getLogger()
+    root.handlers[:] = [_root_handler]
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level)
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает очередь и останавливает потоки записи"""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def stats() -> dict:
+    return {
+        "dropped": _root_handler.dropped if _root_handler else 0,
+        "suppressed": repeat_filter.suppressed,
+    }
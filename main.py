@@ -1,12 +1,14 @@
 import asyncio
+import hashlib
+import hmac
 import os
 import json
-import hashlib
-import httpx
 import logging
+import signal
+import time
 from datetime import datetime
-from contextlib import asynccontextmanager
-from typing import Optional, Tuple, List
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Callable, Optional, Tuple, List
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
@@ -18,29 +20,89 @@ from aiogram.types import (
     MenuButtonWebApp
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.utils.web_app import safe_parse_webapp_init_data
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
-import aiosqlite
+from config import (
+    GROQ_API_KEY,
+    HEDGE_ENABLED,
+    HEDGE_DELAY,
+    MODEL_DEADLINE,
+    MODEL_DEADLINES,
+    REQUEST_BUDGET,
+    STREAM_ENABLED,
+    SESSION_SWEEP_INTERVAL,
+    SIMILARITY_ENABLED,
+    SIMILARITY_THRESHOLD,
+    SIMILARITY_TOP_K,
+    KB_STATS_RECONCILE_INTERVAL,
+    KB_CACHE_TTL,
+    ADMIN_TOKEN,
+    BOT_MODE,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    TELEGRAM_API_URL,
+    TELEGRAM_API_LOCAL,
+    WEBAPP_AUTH_MAX_AGE,
+    WEB_WORKERS,
+    SHARED_STATE,
+    SHARED_SYNC_INTERVAL,
+    ROLES,
+    JOB_QUEUE_ENABLED,
+    JOB_PRIORITY_BOT,
+    JOB_PRIORITY_API,
+    JOB_PRIORITY_BATCH,
+    BATCH_MAX_ITEMS,
+    BATCH_CONCURRENCY,
+)
+from http_client import get_client, open_clients, close_clients, UpstreamError
+from db_pool import kb_pool
+from write_queue import kb_writes
+from kb_cache import kb_cache
+from error_fingerprint import fingerprint, error_category
+from similarity import kb_index, signature_to_blob, blob_to_signature
+from singleflight import SingleFlight
+from session_store import SessionStore
+from migrations import migrate
+from hedging import hedged_race
+from model_health import model_health
+from streaming import ThrottledEditor, SSEStream, sse_event
+from context_builder import build_messages, estimate_tokens, token_budget
+from log_reducer import reduce_log, reduce_stream
+from database import init_db, add_tokens
+from webhook import UpdateWorkers
+from admission import admission, ai_scheduler, AdmissionRejected
+from metrics import (
+    REQUESTS,
+    REQUEST_SECONDS,
+    KB_LOOKUP_SECONDS,
+    KB_CACHE_REQUESTS,
+    TelegramMetricsMiddleware,
+    stats_collector,
+)
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from log_setup import setup_logging, stats as log_stats
+from shared_state import shared_state, SharedCounters, LeaderLease
+from tracing import start_trace, span, slowest, breakdown, current_trace_id
+from job_queue import jobs, RetryableJobError
+from static_assets import static_assets
 
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "7869311061:AAGPstYpuGk7CZTHBQ-_1IL7FCXDyUfIXPY")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "8473513085"))
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://supportbothost.bothost.ru")
 PORT = int(os.getenv("PORT", "3000"))
-GROQ_API_KEY = os.getenv("GROQ_API_KEY", "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")
 
-DB_PATH = "knowledge_base.db"
 
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -50,137 +112,246 @@ FREE_MODELS = [
     {"id": "gemma2-9b-it", "name": "Gemma 2 9B 💎"},
 ]
 
-user_context = {}
-last_fixed = {}
-pending_ratings = {}
-stats = {"requests": 0, "users": set(), "from_cache": 0, "from_ai": 0}
+# История (2 последних пары вопрос/ответ), последний код и ожидающая оценка
+sessions = SessionStore("bot", history_turns=2, turn_chars=1000)
+# requests, from_cache, from_ai, tokens_in, tokens_out — общие для всех воркеров
+counters = SharedCounters(shared_state)
+polling_lease = LeaderLease(shared_state, "polling")
+llm_flights = SingleFlight()
+# Фоновые записи, которые нужно дождаться при остановке
+background_tasks: set[asyncio.Task] = set()
 
 
 async def init_database():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS solutions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                error_hash TEXT UNIQUE,
-                error_text TEXT,
-                error_type TEXT,
-                solution TEXT,
-                code_snippet TEXT,
-                success_count INTEGER DEFAULT 1,
-                fail_count INTEGER DEFAULT 0,
-                confidence REAL DEFAULT 0.5,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS ratings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                error_hash TEXT,
-                rating TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                query TEXT,
-                response TEXT,
-                source TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.commit()
-        logger.info("✅ База данных готова")
+    await kb_pool.open()
+    async with kb_pool.writer() as db:
+        version = await migrate(db)
+    logger.info("✅ База данных готова (схема v%d)", version)
 
 def get_error_hash(text: str) -> str:
-    import re
-    normalized = re.sub(r'/[\w/]+/', '/PATH/', text)
-    normalized = re.sub(r'line \d+', 'line N', normalized)
-    normalized = normalized.lower().strip()
-    return hashlib.md5(normalized.encode()).hexdigest()[:16]
+    return fingerprint(text)
 
 def extract_error_type(text: str) -> str:
-    import re
-    patterns = {
-        "ModuleNotFoundError": r"ModuleNotFoundError|No module named",
-        "ImportError": r"ImportError|cannot import",
-        "SyntaxError": r"SyntaxError|invalid syntax",
-        "TypeError": r"TypeError",
-        "AttributeError": r"AttributeError",
-        "KeyError": r"KeyError",
-        "ValueError": r"ValueError",
-        "ConnectionError": r"ConnectionError|Connection refused",
-        "AuthError": r"401|403|Unauthorized",
-    }
-    for error_type, pattern in patterns.items():
-        if re.search(pattern, text, re.IGNORECASE):
-            return error_type
-    return "UnknownError"
+    return error_category(text)
 
 async def search_knowledge_base(error_text: str) -> Optional[dict]:
+    started = time.perf_counter()
+    row, result = await lookup_knowledge_base(error_text)
+    KB_LOOKUP_SECONDS.labels(result).observe(time.perf_counter() - started)
+    return row
+
+async def lookup_knowledge_base(error_text: str) -> Tuple[Optional[dict], str]:
+    """Возвращает (строка solutions, каким путём найдена) — путь идёт в метрики"""
     try:
         error_hash = get_error_hash(error_text)
+        cached = kb_cache.get(error_hash)
+        KB_CACHE_REQUESTS.labels("hit" if cached else "miss").inc()
+        if cached: return cached, "cache"
+
         error_type = extract_error_type(error_text)
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with kb_pool.reader() as db:
             cursor = await db.execute("SELECT * FROM solutions WHERE error_hash = ? AND confidence > 0.6", (error_hash,))
             exact = await cursor.fetchone()
-            if exact: return dict(exact)
+            if exact:
+                kb_cache.put(error_hash, dict(exact))
+                return dict(exact), "exact"
+
+            # Похожие ошибки (те же трейсбеки с другими путями, номерами, значениями)
+            if SIMILARITY_ENABLED:
+                matches = dict(kb_index.query(error_text[:1000], SIMILARITY_TOP_K, SIMILARITY_THRESHOLD))
+                if matches:
+                    placeholders = ",".join("?" * len(matches))
+                    cursor = await db.execute(f"SELECT * FROM solutions WHERE error_hash IN ({placeholders}) AND confidence > 0.6", tuple(matches))
+                    rows = [dict(row) for row in await cursor.fetchall()]
+                    if rows:
+                        best = max(rows, key=lambda row: (matches[row["error_hash"]], row["confidence"]))
+                        best["similarity"] = matches[best["error_hash"]]
+                        kb_cache.put(error_hash, best)
+                        return best, "similar"
             
             cursor = await db.execute("SELECT * FROM solutions WHERE error_type = ? AND confidence > 0.7 ORDER BY confidence DESC LIMIT 1", (error_type,))
             type_match = await cursor.fetchone()
-            if type_match: return dict(type_match)
+            if type_match:
+                kb_cache.put(error_hash, dict(type_match))
+                return dict(type_match), "type"
     except Exception as e:
-        logger.error(f"DB Search error: {e}")
-    return None
+        logger.error("DB Search error: %r", e)
+        return None, "error"
+    return None, "miss"
+
+async def bulk_lookup_knowledge_base(error_hashes: list[str]) -> dict[str, dict]:
+    """Точные совпадения для многих хэшей: кэш, остальное — одним запросом к базе"""
+    found: dict[str, dict] = {}
+    missing = []
+    for error_hash in error_hashes:
+        cached = kb_cache.get(error_hash)
+        KB_CACHE_REQUESTS.labels("hit" if cached else "miss").inc()
+        if cached:
+            found[error_hash] = cached
+        else:
+            missing.append(error_hash)
+    if missing:
+        started = time.perf_counter()
+        placeholders = ",".join("?" * len(missing))
+        async with kb_pool.reader() as db:
+            cursor = await db.execute(f"SELECT * FROM solutions WHERE error_hash IN ({placeholders}) AND confidence > 0.6", missing)
+            rows = [dict(row) for row in await cursor.fetchall()]
+        for row in rows:
+            kb_cache.put(row["error_hash"], row)
+            found[row["error_hash"]] = row
+        KB_LOOKUP_SECONDS.labels("bulk").observe(time.perf_counter() - started)
+    return found
+
+# Записи идут через kb_writes: ответ не ждёт commit, кэш и индекс
+# обновляются, когда запись реально применена
+SAVE_SOLUTION_SQL = """
+    INSERT INTO solutions (error_hash, error_text, error_type, solution, code_snippet, minhash)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(error_hash) DO UPDATE SET
+        solution = excluded.solution,
+        minhash = excluded.minhash,
+        updated_at = CURRENT_TIMESTAMP
+"""
 
 async def save_to_knowledge_base(error_text: str, solution: str, code_snippet: str = ""):
     try:
         error_hash = get_error_hash(error_text)
         error_type = extract_error_type(error_text)
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT INTO solutions (error_hash, error_text, error_type, solution, code_snippet)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(error_hash) DO UPDATE SET
-                    solution = excluded.solution,
-                    updated_at = CURRENT_TIMESTAMP
-            """, (error_hash, error_text[:1000], error_type, solution, code_snippet))
-            await db.commit()
+        signature = kb_index.signature(error_text[:1000])
+
+        def applied():
+            kb_cache.invalidate(error_hash)
+            kb_index.add(error_hash, signature)
+
+        await kb_writes.put(
+            SAVE_SOLUTION_SQL,
+            (error_hash, error_text[:1000], error_type, solution, code_snippet, signature_to_blob(signature)),
+            applied,
+        )
+    except Exception as e:
+        logger.error("DB Save error: %r", e)
+
+# Индекс догружается по id: при нескольких воркерах — новые строки от соседей
+index_loaded_id = 0
+index_lock = asyncio.Lock()
+
+async def load_similarity_index(batch: int = 500):
+    """
+    Загружает сигнатуры в память (при старте — все, потом — добавленные после);
+    строкам без сигнатуры (до миграции v3) считает их пачками в потоке и дописывает в базу
+    """
+    async with index_lock:
+        await _load_similarity_index(batch, index_loaded_id)
+
+async def _load_similarity_index(batch: int, last_id: int):
+    global index_loaded_id
+    loop = asyncio.get_running_loop()
+    loaded = 0
+    try:
+        while True:
+            async with kb_pool.reader() as db:
+                cursor = await db.execute("SELECT id, error_hash, error_text, minhash FROM solutions WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch))
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            last_id = index_loaded_id = rows[-1]["id"]
+            loaded += len(rows)
+
+            missing = [row for row in rows if row["minhash"] is None]
+            computed = await loop.run_in_executor(
+                None, lambda: [kb_index.signature(row["error_text"] or "") for row in missing]
+            )
+            for row in rows:
+                if row["minhash"] is not None:
+                    kb_index.add(row["error_hash"], blob_to_signature(row["minhash"]))
+            if missing:
+                async with kb_pool.writer() as db:
+                    await db.executemany(
+                        "UPDATE solutions SET minhash = ? WHERE id = ?",
+                        [(signature_to_blob(sig), row["id"]) for row, sig in zip(missing, computed)],
+                    )
+                for row, sig in zip(missing, computed):
+                    kb_index.add(row["error_hash"], sig)
+        if loaded:
+            logger.info("🔎 Индекс похожих ошибок: %d записей", len(kb_index))
     except Exception as e:
-        logger.error(f"DB Save error: {e}")
+        logger.error("Similarity index load error: %r", e)
 
-async def update_confidence(error_hash: str, is_positive: bool):
+# Изменения решений от других процессов (журнал kb_changes ведут триггеры):
+# их строки сбрасываются из kb_cache этого процесса
+kb_changes_seen = 0
+
+async def init_kb_changes():
+    global kb_changes_seen
+    async with kb_pool.reader() as db:
+        kb_changes_seen = (await (await db.execute("SELECT COALESCE(MAX(id), 0) FROM kb_changes")).fetchone())[0]
+
+async def sync_kb_cache():
+    global kb_changes_seen
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            if is_positive:
-                await db.execute("UPDATE solutions SET success_count = success_count + 1, confidence = MIN(1.0, confidence + 0.1) WHERE error_hash = ?", (error_hash,))
-            else:
-                await db.execute("UPDATE solutions SET fail_count = fail_count + 1, confidence = MAX(0.0, confidence - 0.15) WHERE error_hash = ?", (error_hash,))
-            await db.commit()
-    except: pass
+        async with kb_pool.reader() as db:
+            cursor = await db.execute("SELECT id, error_hash FROM kb_changes WHERE id > ? ORDER BY id", (kb_changes_seen,))
+            rows = await cursor.fetchall()
+        for row in rows:
+            kb_cache.invalidate(row["error_hash"])
+        if rows:
+            kb_changes_seen = rows[-1]["id"]
+    except Exception as e:
+        logger.error("KB cache sync error: %r", e)
+
+async def prune_kb_changes():
+    # Старше TTL кэша — таких записей в кэше уже нет
+    async with kb_pool.writer() as db:
+        await db.execute("DELETE FROM kb_changes WHERE changed_at < ?", (time.time() - KB_CACHE_TTL - SHARED_SYNC_INTERVAL,))
+
+async def update_confidence(error_hash: str, is_positive: bool):
+    if is_positive:
+        sql = "UPDATE solutions SET success_count = success_count + 1, confidence = MIN(1.0, confidence + 0.1) WHERE error_hash = ?"
+    else:
+        sql = "UPDATE solutions SET fail_count = fail_count + 1, confidence = MAX(0.0, confidence - 0.15) WHERE error_hash = ?"
+    await kb_writes.put(sql, (error_hash,), lambda: kb_cache.invalidate(error_hash))
 
 async def save_rating(user_id: int, error_hash: str, rating: str):
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("INSERT INTO ratings (user_id, error_hash, rating) VALUES (?, ?, ?)", (user_id, error_hash, rating))
-            await db.commit()
-    except: pass
+    await kb_writes.put("INSERT INTO ratings (user_id, error_hash, rating) VALUES (?, ?, ?)", (user_id, error_hash, rating))
+
+async def save_history(user_id: int, query: str, response: str, source: str):
+    await kb_writes.put(
+        "INSERT INTO user_history (user_id, query, response, source) VALUES (?, ?, ?, ?)",
+        (user_id, query[:1000], response, source),
+    )
+
+# Счётчики ведут триггеры (миграция v8) — чтение без сканирования таблиц
+KB_STATS_COUNTS = {
+    "total_solutions": "SELECT COUNT(*) FROM solutions",
+    "reliable_solutions": "SELECT COUNT(*) FROM solutions WHERE confidence > 0.7",
+    "positive_ratings": "SELECT COUNT(*) FROM ratings WHERE rating = 'good'",
+    "negative_ratings": "SELECT COUNT(*) FROM ratings WHERE rating = 'bad'",
+    "total_queries": "SELECT COUNT(*) FROM user_history",
+}
 
 async def get_knowledge_stats() -> dict:
+    stats = dict.fromkeys(KB_STATS_COUNTS, 0)
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            total = (await (await db.execute("SELECT COUNT(*) FROM solutions")).fetchone())[0]
-            reliable = (await (await db.execute("SELECT COUNT(*) FROM solutions WHERE confidence > 0.7")).fetchone())[0]
-            pos = (await (await db.execute("SELECT COUNT(*) FROM ratings WHERE rating = 'good'")).fetchone())[0]
-            neg = (await (await db.execute("SELECT COUNT(*) FROM ratings WHERE rating = 'bad'")).fetchone())[0]
-            queries = (await (await db.execute("SELECT COUNT(*) FROM user_history")).fetchone())[0]
-            return {"total_solutions": total, "reliable_solutions": reliable, "positive_ratings": pos, "negative_ratings": neg, "total_queries": queries}
-    except:
-        return {"total_solutions": 0, "reliable_solutions": 0, "positive_ratings": 0, "negative_ratings": 0, "total_queries": 0}
+        async with kb_pool.reader() as db:
+            rows = await (await db.execute("SELECT name, value FROM kb_stats")).fetchall()
+        stats.update((name, value) for name, value in rows if name in stats)
+    except Exception as e:
+        logger.error("KB stats error: %r", e)
+    return stats
+
+async def reconcile_knowledge_stats():
+    """Сверка kb_stats с настоящими COUNT(*): одним запросом под блокировкой записи"""
+    selects = " UNION ALL ".join(f"SELECT '{name}', ({sql})" for name, sql in KB_STATS_COUNTS.items())
+    async with kb_pool.writer() as db:
+        cursor = await db.execute(
+            f"INSERT INTO kb_stats (name, value) SELECT * FROM ({selects}) WHERE true "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value WHERE value != excluded.value "
+            "RETURNING name, value"
+        )
+        fixed = await cursor.fetchall()
+        await cursor.close()
+    if fixed:
+        logger.warning("KB stats drift corrected: %s", ", ".join(f"{name}={value}" for name, value in fixed))
 
 
 SYSTEM_PROMPT = """`Ты - NeuroCode AI, элитный ИИ-ассистент мирового класса. Ты объединяешь возможности лучших программистов, архитекторов ПО, DevOps инженеров и технических экспертов планеты.
@@ -671,70 +842,332 @@ bot/
 Ты создаёшь код, который можно сразу использовать в продакшене! 🚀`"""
 
 
-async def ask_ai(messages: list, user_id: int) -> Tuple[str, str, str]:
+def model_deadline(model: dict) -> float:
+    return MODEL_DEADLINES.get(model["id"], MODEL_DEADLINE)
+
+async def groq_completion(
+    model: dict,
+    full_messages: list,
+    first_byte: asyncio.Event,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, Optional[dict]]:
+    """Возвращает (ответ, usage из ответа API или None)"""
+    headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+    payload = {
+        "model": model["id"],
+        "messages": full_messages,
+        "temperature": 0.1,
+        "max_tokens": 4000,
+        "top_p": 0.95
+    }
+    if on_delta:
+        payload["stream"] = True
+    with span("upstream", model=model["id"], stream=bool(on_delta)) as sp:
+        answer, usage = await _groq_request(model, headers, payload, first_byte, on_delta)
+        sp.set(completion_tokens=(usage or {}).get("completion_tokens"))
+        return answer, usage
+
+async def _groq_request(model: dict, headers: dict, payload: dict, first_byte: asyncio.Event, on_delta) -> Tuple[str, Optional[dict]]:
+    # stream() — чтобы узнать момент первого байта до чтения всего тела
+    async with get_client("groq").stream(
+        "POST",
+        "/chat/completions",
+        timeout=model_deadline(model),
+        headers=headers,
+        json=payload
+    ) as response:
+        if response.status_code != 200:
+            body = await response.aread()
+            raise UpstreamError(
+                response.status_code, body.decode(errors="ignore"), response.headers.get("retry-after")
+            )
+        if not on_delta:
+            first_byte.set()
+            data = json.loads(await response.aread())
+            return data["choices"][0]["message"]["content"], data.get("usage")
+
+        # SSE: data: {...}\n\n ... data: [DONE]
+        # usage приходит в последнем чанке: у Groq — в x_groq.usage
+        answer, usage = "", None
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = line[5:].strip()
+            if chunk == "[DONE]":
+                break
+            data = json.loads(chunk)
+            usage = data.get("usage") or data.get("x_groq", {}).get("usage") or usage
+            choices = data.get("choices")
+            delta = choices[0]["delta"].get("content") if choices else None
+            if delta:
+                first_byte.set()
+                answer += delta
+                on_delta(answer)
+        if not answer:
+            raise UpstreamError(200, "empty stream")
+        return answer, usage
+
+async def add_tokens_safe(user_id: int, tokens: int):
+    try:
+        await add_tokens(user_id, tokens)
+    except Exception as e:
+        logger.warning("Token accounting failed: %r", e)
+
+def record_usage(user_id: int, usage: Optional[dict], estimated_in: int, answer: str):
+    # Без usage от API — локальная оценка; токены списываются тому, чей запрос ушёл к модели
+    if usage:
+        tokens_in, tokens_out = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    else:
+        tokens_in, tokens_out = estimated_in, estimate_tokens(answer)
+    counters.incr("tokens_in", tokens_in)
+    counters.incr("tokens_out", tokens_out)
+    if user_id:
+        # Запись в базу пользователей — фоном, ответ её не ждёт
+        task = asyncio.create_task(add_tokens_safe(user_id, tokens_in + tokens_out))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def ask_ai(
+    messages: list,
+    user_id: int,
+    on_delta: Optional[Callable[[str], None]] = None,
+    on_queue: Optional[Callable[[int], None]] = None,
+) -> Tuple[str, str, str, Optional[str]]:
+    """
+    (ответ, модель, источник, error_hash показанного решения — для оценки)
+    on_delta — включает stream: true, вызывается с полным текстом ответа по мере генерации
+    on_queue — вызывается с местом в очереди к ИИ, пока запрос ждёт слот
+    """
+    started = time.perf_counter()
+    source = "error"
+    try:
+        with start_trace("ask_ai") as sp:
+            answer, model, source, error_hash = await answer_ai(messages, user_id, on_delta, on_queue)
+            sp.set(source=source, model=model)
+        return answer, model, source, error_hash
+    finally:
+        REQUESTS.labels(source).inc()
+        REQUEST_SECONDS.labels(source).observe(time.perf_counter() - started)
+
+def cached_answer(row: dict) -> str:
+    answer = row["solution"]
+    # Добавляем пометку, если её нет
+    if "💾" not in answer:
+        answer += f"\n\n_💾 Ответ из базы знаний (уверенность: {int(row['confidence']*100)}%)_"
+    return answer
+
+async def answer_cached(user_query: str, user_id: int) -> Optional[Tuple[str, str, str, str]]:
+    """
+    Ответ из базы знаний, если она достаточно уверена: (ответ, модель, источник, error_hash).
+    error_hash — строки, которую показали (могла найтись по похожести): оценка относится к ней
+    """
+    with span("kb.search") as sp:
+        cached = await search_knowledge_base(user_query)
+        sp.set(found=bool(cached))
+    if not cached or cached["confidence"] <= 0.7:
+        return None
+    counters.incr("from_cache")
+    answer = cached_answer(cached)
+    await save_history(user_id, user_query, answer, "cache")
+    return answer, "🧠 Личная AI", "cache", cached["error_hash"]
+
+async def answer_ai(
+    messages: list,
+    user_id: int,
+    on_delta: Optional[Callable[[str], None]],
+    on_queue: Optional[Callable[[int], None]],
+) -> Tuple[str, str, str, Optional[str]]:
     user_query = messages[1]["content"]
     
     # 1. Поиск в базе
-    cached = await search_knowledge_base(user_query)
-    if cached and cached["confidence"] > 0.7:
-        stats["from_cache"] += 1
-        error_hash = get_error_hash(user_query)
-        pending_ratings[user_id] = error_hash
-        answer = cached["solution"]
-        # Добавляем пометку, если её нет
-        if "💾" not in answer:
-            answer += f"\n\n_💾 Ответ из базы знаний (уверенность: {int(cached['confidence']*100)}%)_"
-        return answer, "🧠 Личная AI", "cache"
+    cached = await answer_cached(user_query, user_id)
+    if cached:
+        return cached
     
     # 2. Groq
-    stats["from_ai"] += 1
-    if user_id not in user_context: user_context[user_id] = []
-    
-    history = user_context[user_id][-4:]
-    full_messages = [{"role": "system", "content": messages[0]["content"]}] + history + [{"role": "user", "content": messages[1]["content"]}]
-    
-    headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-
-    async with httpx.AsyncClient(timeout=90.0) as client:
-        for model in FREE_MODELS:
+    counters.incr("from_ai")
+    with span("history"):
+        history = await sessions.history(user_id)
+    # Контекст под бюджет модели; у моделей с одинаковым бюджетом он общий
+    contexts: dict[int, tuple[list, int]] = {}
+
+    def context_for(model: dict) -> tuple[list, int]:
+        budget = token_budget(model["id"])
+        if budget not in contexts:
+            contexts[budget] = build_messages(messages[0]["content"], history, messages[1]["content"], budget)
+        return contexts[budget]
+
+    async def generate(publish_all: Callable[[str], None]) -> Optional[tuple]:
+        # При хеджировании токены могут идти от двух моделей сразу —
+        # показываем пользователю только ту, что начала отвечать первой
+        streaming = {"owner": None}
+
+        def publisher(model: dict) -> Callable[[str], None]:
+            def publish(text: str):
+                if streaming["owner"] in (None, model["id"]):
+                    streaming["owner"] = model["id"]
+                    publish_all(text)
+            return publish
+
+        async def attempt(model: dict, first_byte: asyncio.Event) -> tuple:
             try:
-                response = await client.post(
-                    "https://api.groq.com/openai/v1/chat/completions",
-                    headers=headers,
-                    json={
-                        "model": model["id"],
-                        "messages": full_messages,
-                        "temperature": 0.1, 
-                        "max_tokens": 4000,
-                        "top_p": 0.95
-                    }
+                full_messages, _ = context_for(model)
+                return await groq_completion(model, full_messages, first_byte, publisher(model) if on_delta else None)
+            except BaseException:
+                if streaming["owner"] == model["id"]:
+                    streaming["owner"] = None
+                raise
+
+        # Слот в честной очереди занимает только тот, кто реально идёт к ИИ
+        async with ai_scheduler.slot(user_id, on_queue):
+            with span("llm") as sp:
+                winner = await hedged_race(
+                    FREE_MODELS,
+                    attempt,
+                    hedge_delay=HEDGE_DELAY if HEDGE_ENABLED else None,
+                    deadline_for=model_deadline,
+                    budget=REQUEST_BUDGET,
+                    name_of=lambda m: m["name"],
+                    key_of=lambda m: m["id"],
+                    health=model_health,
                 )
-                if response.status_code == 200:
-                    answer = response.json()["choices"][0]["message"]["content"]
-                    user_context[user_id].append({"role": "user", "content": messages[1]["content"][:1000]})
-                    user_context[user_id].append({"role": "assistant", "content": answer[:1000]})
-                    
-                    code_snippet = ""
-                    if "```" in answer:
-                        try: code_snippet = answer.split("```")[1]
-                        except: pass
-                    
-                    await save_to_knowledge_base(user_query, answer, code_snippet)
-                    error_hash = get_error_hash(user_query)
-                    pending_ratings[user_id] = error_hash
-                    
-                    stats["requests"] += 1
-                    stats["users"].add(user_id)
-                    
-                    return answer, model["name"], "groq"
-                elif response.status_code == 429:
-                    await asyncio.sleep(1)
-                    continue
-            except Exception as e:
-                logger.error(f"AI Error {model['name']}: {e}")
-                continue
-
-    return "❌ Серверы AI перегружены. Попробуй через 30 секунд.", "Ошибка", "error"
+                sp.set(model=winner[0]["id"] if winner else None)
+        if not winner:
+            return None
+        model, (answer, usage) = winner
+        record_usage(user_id, usage, context_for(model)[1], answer)
+        code_snippet = ""
+        if "```" in answer:
+            try: code_snippet = answer.split("```")[1]
+            except: pass
+        with span("kb.save"):
+            await save_to_knowledge_base(user_query, answer, code_snippet)
+        return model, answer
+
+    # Одинаковые ошибки от разных пользователей в одно время — один вызов ИИ на всех,
+    # но только при одинаковом промпте: общий отпечаток у разных логов (тот же шаблон
+    # сообщения) или своя история диалога — уже другой ответ
+    error_hash = get_error_hash(user_query)
+    prompt = json.dumps([messages[0]["content"], history, user_query], ensure_ascii=False)
+    flight_key = (error_hash, hashlib.sha256(prompt.encode()).hexdigest())
+    with span("singleflight") as sp:
+        winner, shared = await llm_flights.do(flight_key, generate, on_delta)
+        sp.set(shared=shared)
+    if winner:
+        model, answer = winner
+        with span("session.update"):
+            await sessions.add_turn(user_id, messages[1]["content"], answer)
+            await save_history(user_id, user_query, answer, "groq")
+
+        counters.incr("requests")
+
+        return answer, model["name"], "groq", error_hash
+
+    return "❌ Серверы AI перегружены. Попробуй через 30 секунд.", "Ошибка", "error", None
+
+# ============================================
+# ЗАДАЧИ ИИ
+# ============================================
+# Бот и /api/fix не зовут модель сами: ставят задачу "fix" и ждут её.
+# Выполняют задачи процессы с ролью worker (job_queue), поэтому медленные
+# ответы провайдеров не занимают event loop HTTP и приёма апдейтов.
+# Попадание в базу знаний отвечается сразу, без очереди. Сессии у ролей
+# могут быть разные: error_hash для оценки возвращает ask_ai, он приходит
+# в результате задачи, ожидание оценки ставит фронтенд.
+
+async def fix_job(payload: dict, progress) -> dict:
+    msg = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": payload["text"]}]
+    with start_trace("job.fix", origin=payload.get("trace")):
+        try:
+            ans, model, source, error_hash = await ask_ai(
+                msg,
+                payload["user_id"],
+                (lambda text: progress("delta", text)) if payload.get("stream") else None,
+                lambda position: progress("queue", position),
+            )
+        except AdmissionRejected as e:
+            # Очередь к ИИ переполнена: решает фронтенд, ждать или отказать
+            return {"rejected": e.reason, "retry_after": e.retry_after}
+    if source == "error":
+        raise RetryableJobError("all models failed")
+    return {"answer": ans, "model": model, "source": source, "error_hash": error_hash}
+
+jobs.register("fix", fix_job)
+
+def job_answer(job: dict) -> Tuple[str, str, str, Optional[str]]:
+    result = job["result"] or {}
+    if "rejected" in result:
+        raise AdmissionRejected(result["rejected"], result["retry_after"])
+    if job["status"] != "done":
+        return "❌ Серверы AI перегружены. Попробуй через 30 секунд.", "Ошибка", "error", None
+    return result["answer"], result["model"], result["source"], result.get("error_hash")
+
+async def submit_fix(text: str, user_id: int, priority: int, stream: bool = False) -> tuple[int, str]:
+    return await jobs.submit("fix", {"text": text, "user_id": user_id, "stream": stream, "trace": current_trace_id()}, priority)
+
+async def cached_fix(text: str, user_id: int) -> Optional[Tuple[str, str, str, str]]:
+    started = time.perf_counter()
+    result = await answer_cached(text, user_id)
+    if result:
+        await sessions.set_pending_rating(user_id, result[3])
+        REQUESTS.labels("cache").inc()
+        REQUEST_SECONDS.labels("cache").observe(time.perf_counter() - started)
+    return result
+
+async def settle_fix_job(job_id: int, user_id: int, permit: AsyncExitStack):
+    # Задача без ожидающего клиента (/api/fix async): оценка и допуск — по её завершении
+    try:
+        _, _, _, error_hash = job_answer(await jobs.wait(job_id))
+        if error_hash:
+            await sessions.set_pending_rating(user_id, error_hash)
+    except AdmissionRejected:
+        pass
+    except Exception as e:
+        logger.warning("Job %d settle failed: %r", job_id, e)
+    finally:
+        await permit.aclose()
+
+# Ожидания async-задач; при остановке отменяются — сами задачи остаются в очереди
+job_watchers: set[asyncio.Task] = set()
+
+def watch_fix_job(job_id: int, user_id: int, permit: AsyncExitStack):
+    task = asyncio.create_task(settle_fix_job(job_id, user_id, permit))
+    job_watchers.add(task)
+    task.add_done_callback(job_watchers.discard)
+
+async def run_fix(
+    text: str,
+    user_id: int,
+    priority: int,
+    on_delta: Optional[Callable[[str], None]] = None,
+    on_queue: Optional[Callable[[int], None]] = None,
+) -> Tuple[str, str, str, Optional[str]]:
+    """Ответ ИИ через очередь задач (или напрямую при JOB_QUEUE_ENABLED=0): (ответ, модель, источник, error_hash)"""
+    if not JOB_QUEUE_ENABLED:
+        msg = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": text}]
+        ans, model, source, error_hash = await ask_ai(msg, user_id, on_delta, on_queue)
+        if error_hash:
+            await sessions.set_pending_rating(user_id, error_hash)
+        return ans, model, source, error_hash
+
+    cached = await cached_fix(text, user_id)
+    if cached:
+        return cached
+
+    def on_progress(kind: str, value):
+        if kind == "delta" and on_delta:
+            on_delta(value)
+        elif kind == "queue" and on_queue:
+            on_queue(value)
+
+    with span("job.wait") as sp:
+        job_id, _ = await submit_fix(text, user_id, priority, stream=on_delta is not None)
+        job = await jobs.wait(job_id, on_progress)
+        sp.set(job_id=job_id, status=job["status"], attempts=job["attempts"])
+    ans, model, source, error_hash = job_answer(job)
+    if error_hash:
+        await sessions.set_pending_rating(user_id, error_hash)
+    return ans, model, source, error_hash
 
 
 MINI_APP_HTML = """
@@ -745,7 +1178,7 @@ MINI_APP_HTML = """
   <meta name="viewport" content="width=device-width, initial-scale=1.0, maximum-scale=1.0, user-scalable=no">
   <title>BotHost AI</title>
   <script src="https://telegram.org/js/telegram-web-app.js"></script>
-  <script src="https://cdn.tailwindcss.com"></script>
+  <link rel="stylesheet" href="/static/app.css">
   <link href="https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@400;600&family=Inter:wght@400;600&display=swap" rel="stylesheet">
   <style>
     :root { --primary: #00ff88; --bg-dark: #0a0a0f; --bg-card: #12121a; }
@@ -841,15 +1274,30 @@ MINI_APP_HTML = """
       timer = setInterval(() => document.getElementById('timer').innerText = (sec += 0.1).toFixed(1) + " сек", 100);
       
       try {
-        const res = await fetch(`${BASE_URL}/api/fix`, {
+        const res = await fetch(`${BASE_URL}/api/fix/stream`, {
           method: "POST",
-          headers: {"Content-Type": "application/json"},
-          body: JSON.stringify({code: input, user_id: tg.initDataUnsafe?.user?.id || 0})
+          headers: {"Content-Type": "application/json", "X-Telegram-Init-Data": tg.initData || ""},
+          body: JSON.stringify({code: input})
         });
         
+        if (res.status === 429) {
+          const err = await res.json();
+          throw new Error(`${err.error}. Попробуй через ${err.retry_after} сек.`);
+        }
         if (!res.ok) throw new Error("Ошибка сервера: " + res.status);
         
-        const data = await res.json();
+        // Токены рисуем по мере прихода (не чаще кадра)
+        let latest = "", pending = false;
+        const data = await readStream(res, text => {
+          latest = text;
+          if (pending) return;
+          pending = true;
+          requestAnimationFrame(() => {
+            pending = false;
+            showResult();
+            document.getElementById("result-content").innerHTML = formatText(latest);
+          });
+        });
         if (data.error) throw new Error(data.error);
         
         resultText = data.fixed_code; 
@@ -858,13 +1306,12 @@ MINI_APP_HTML = """
         document.getElementById("result-content").innerHTML = formatText(resultText);
         document.getElementById("source-badge").textContent = data.source === "cache" ? "💾 База" : "🌐 Groq";
         
-        clearInterval(timer);
-        document.getElementById("loading-screen").classList.add("hidden");
-        document.getElementById("result-screen").classList.remove("hidden");
+        showResult();
         try { tg.HapticFeedback.notificationOccurred("success"); } catch(e){}
       } catch(e) {
         clearInterval(timer);
         document.getElementById("loading-screen").classList.add("hidden");
+        document.getElementById("result-screen").classList.add("hidden");
         document.getElementById("input-screen").classList.remove("hidden");
         const errMsg = document.getElementById("error-msg");
         errMsg.textContent = "Ошибка: " + e.message;
@@ -873,6 +1320,36 @@ MINI_APP_HTML = """
       }
     }
 
+    function showResult() {
+      clearInterval(timer);
+      document.getElementById("loading-screen").classList.add("hidden");
+      document.getElementById("result-screen").classList.remove("hidden");
+    }
+
+    // Читает SSE из /api/fix/stream: delta/reset — текст, done — итог
+    async function readStream(res, onText) {
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buf = "", text = "";
+      while (true) {
+        const {value, done} = await reader.read();
+        if (done) break;
+        buf += decoder.decode(value, {stream: true});
+        let idx;
+        while ((idx = buf.indexOf("\\n\\n")) >= 0) {
+          const line = buf.slice(0, idx);
+          buf = buf.slice(idx + 2);
+          if (!line.startsWith("data:")) continue;
+          const ev = JSON.parse(line.slice(5));
+          if (ev.type === "delta") { text += ev.text; onText(text); }
+          else if (ev.type === "reset") { text = ev.text; onText(text); }
+          else if (ev.type === "done") return ev;
+          else if (ev.type === "error") return {error: ev.error};
+        }
+      }
+      throw new Error("Соединение прервано");
+    }
+
     function formatText(text) {
       // Простой парсер Markdown для красивого отображения
       let html = text
@@ -901,12 +1378,39 @@ MINI_APP_HTML = """
 """
 
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+)
+bot.session.middleware(TelegramMetricsMiddleware())
 dp = Dispatcher()
+update_workers = UpdateWorkers(dp, bot)
+
+# Очереди и кэши в /metrics
+stats_collector.add("kb_cache", kb_cache.stats)
+stats_collector.add("singleflight", llm_flights.stats)
+stats_collector.add("sessions", sessions.stats)
+stats_collector.add("write_queue", kb_writes.stats)
+stats_collector.add("webhook_updates", update_workers.stats)
+stats_collector.add("ai_scheduler", ai_scheduler.stats)
+stats_collector.add("admission", admission.stats)
+stats_collector.add("logging", log_stats)
+stats_collector.add("polling", polling_lease.stats)
+stats_collector.add("jobs", jobs.stats)
+stats_collector.add("static", static_assets.stats)
+
+def extract_code(answer: str) -> str:
+    if "```" in answer:
+        try: return answer.split("```")[1].split("\n", 1)[1]
+        except: pass
+    return ""
 
-def get_kb(show_rating=True):
+def get_kb(show_rating=True, error_hash: Optional[str] = None):
     btns = []
-    if show_rating: btns.append([InlineKeyboardButton(text="👍 Помогло", callback_data="rate_good"), InlineKeyboardButton(text="👎 Нет", callback_data="rate_bad")])
+    # Хэш в callback_data: оценку обработает любой воркер, без состояния сессии
+    suffix = f":{error_hash}" if error_hash else ""
+    if show_rating: btns.append([InlineKeyboardButton(text="👍 Помогло", callback_data="rate_good" + suffix), InlineKeyboardButton(text="👎 Нет", callback_data="rate_bad" + suffix)])
     btns.append([InlineKeyboardButton(text="📥 Скачать", callback_data="download"), InlineKeyboardButton(text="📋 Копировать", callback_data="copy")])
     btns.append([InlineKeyboardButton(text="🔄 Новый", callback_data="new")])
     return InlineKeyboardMarkup(inline_keyboard=btns)
@@ -948,61 +1452,114 @@ async def cmd_start(m: types.Message):
         ])
     )
 
+@dp.message(Command("traces"))
+async def cmd_traces(m: types.Message):
+    """Админу: самые медленные из последних запросов и куда ушло время"""
+    if m.from_user.id != ADMIN_ID: return
+    traces = slowest(5)
+    if not traces:
+        return await m.answer("Трасс пока нет", parse_mode=None)
+    lines = []
+    for i, trace in enumerate(traces, 1):
+        stages = ", ".join(f"{name} {ms / 1000:.1f}с" for name, ms in breakdown(trace, 4))
+        lines.append(f"{i}. {trace['duration_ms'] / 1000:.1f}с {trace['name']} [{trace['trace_id']}]\n   {stages}")
+    await m.answer("🐢 Самые медленные запросы:\n\n" + "\n".join(lines), parse_mode=None)
+
+async def iter_file(file_path: str, chunk_size: int = 65536):
+    if bot.session.api.is_local:
+        # Локальный Bot API сервер: файл уже на диске
+        with open(bot.session.api.wrap_local_file.to_local(file_path), "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+        return
+    url = bot.session.api.file_url(bot.token, file_path)
+    async for chunk in bot.session.stream_content(url, timeout=60, chunk_size=chunk_size):
+        yield chunk
+
 @dp.message(F.text | F.document)
 async def handle_msg(m: types.Message):
     if m.text and m.text.startswith("/"): return
-    
-    thinking = await m.answer("🧠 **Анализирую...**")
-    await bot.send_chat_action(m.chat.id, "typing")
+    with start_trace("telegram.message", user_id=m.from_user.id, document=bool(m.document)):
+        try:
+            async with admission.admit(m.from_user.id):
+                await answer_msg(m)
+        except AdmissionRejected as e:
+            await m.answer(f"⏳ {e.reason}. Попробуй через {e.retry_after} сек.")
+
+async def answer_msg(m: types.Message):
+    with span("telegram.thinking"):
+        thinking = await m.answer("🧠 **Анализирую...**")
+        await bot.send_chat_action(m.chat.id, "typing")
     
     text = m.text or m.caption or ""
     if m.document:
-        try:
-            f = await bot.get_file(m.document.file_id)
-            c = await bot.download_file(f.file_path)
-            text += "\n" + c.read().decode('utf-8', errors='ignore')
-        except: pass
+        with span("download", size=m.document.file_size):
+            try:
+                f = await bot.get_file(m.document.file_id)
+                # Файл не держим целиком: куски сразу идут в редуктор лога
+                text += "\n" + await reduce_stream(iter_file(f.file_path))
+            except: pass
 
     if len(text) < 5:
         await thinking.delete()
         return await m.answer("❌ Пришли лог ошибки!")
 
-    # Формируем промпт
-    msg = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": text[:30000]}]
-    
-    ans, model, source = await ask_ai(msg, m.from_user.id)
+    # Место в очереди и токены по мере генерации показываем, правя сообщение "Анализирую..."
+    editor = ThrottledEditor(lambda t: thinking.edit_text(t, parse_mode=None))
+    try:
+        ans, model, source, error_hash = await run_fix(
+            text,
+            m.from_user.id,
+            JOB_PRIORITY_BOT,
+            editor.push if STREAM_ENABLED else None,
+            lambda position: editor.push(f"⏳ В очереди: {position}", cursor=False),
+        )
+    except AdmissionRejected:
+        await thinking.delete()
+        raise
+    finally:
+        await editor.close()
     
     # Пытаемся извлечь чистый код для скачивания
-    code_only = ""
-    if "```" in ans:
-        try: code_only = ans.split("```")[1].split("\n", 1)[1]
-        except: pass
-    last_fixed[m.from_user.id] = code_only if code_only else ans
+    code_only = extract_code(ans)
+    await sessions.set_last_fixed(m.from_user.id, code_only if code_only else ans)
+    kb = get_kb(error_hash=error_hash)
 
-    await thinking.delete()
-    
     src_text = "💾 База" if source == "cache" else "🌐 Groq"
-    try: await m.answer(ans + f"\n\n_⚡ {model} | {src_text}_", reply_markup=get_kb())
-    except: await m.answer(ans[:4000], parse_mode=None, reply_markup=get_kb())
+    with span("telegram.send"):
+        try: await thinking.edit_text(ans + f"\n\n_⚡ {model} | {src_text}_", reply_markup=kb)
+        except:
+            try: await thinking.edit_text(ans[:4000], parse_mode=None, reply_markup=kb)
+            except:
+                await thinking.delete()
+                await m.answer(ans[:4000], parse_mode=None, reply_markup=kb)
         
 
-@dp.callback_query(F.data == "rate_good")
+async def rated_hash(cb: types.CallbackQuery) -> Optional[str]:
+    # Старые кнопки без хэша — оценка из сессии
+    _, _, error_hash = cb.data.partition(":")
+    if error_hash:
+        # Ожидание в сессии — для последнего ответа, а оценивать могут и более старый
+        return error_hash
+    return await sessions.pop_pending_rating(cb.from_user.id)
+
+@dp.callback_query(F.data.startswith("rate_good"))
 async def cb_good(cb: types.CallbackQuery):
     try:
-        if cb.from_user.id in pending_ratings:
-            await update_confidence(pending_ratings[cb.from_user.id], True)
-            await save_rating(cb.from_user.id, pending_ratings[cb.from_user.id], "good")
-            del pending_ratings[cb.from_user.id]
+        error_hash = await rated_hash(cb)
+        if error_hash:
+            await update_confidence(error_hash, True)
+            await save_rating(cb.from_user.id, error_hash, "good")
         await cb.answer("👍 Спасибо!")
         await cb.message.edit_reply_markup(reply_markup=get_kb(False))
     except: await cb.answer()
 
-@dp.callback_query(F.data == "rate_bad")
+@dp.callback_query(F.data.startswith("rate_bad"))
 async def cb_bad(cb: types.CallbackQuery):
     try:
-        if cb.from_user.id in pending_ratings:
-            await update_confidence(pending_ratings[cb.from_user.id], False)
-            del pending_ratings[cb.from_user.id]
+        error_hash = await rated_hash(cb)
+        if error_hash:
+            await update_confidence(error_hash, False)
         await cb.answer("👎 Учту.")
         await cb.message.edit_reply_markup(reply_markup=get_kb(False))
     except: await cb.answer()
@@ -1010,8 +1567,9 @@ async def cb_bad(cb: types.CallbackQuery):
 @dp.callback_query(F.data == "download")
 async def cb_dl(cb: types.CallbackQuery):
     try:
-        if cb.from_user.id in last_fixed:
-            f = BufferedInputFile(last_fixed[cb.from_user.id].encode('utf-8'), filename="fix.py")
+        fixed = await sessions.last_fixed(cb.from_user.id)
+        if fixed:
+            f = BufferedInputFile(fixed.encode('utf-8'), filename="fix.py")
             await bot.send_document(cb.message.chat.id, f, caption="✅ Файл с решением")
             await cb.answer()
         else: await cb.answer("Нет данных")
@@ -1020,8 +1578,9 @@ async def cb_dl(cb: types.CallbackQuery):
 @dp.callback_query(F.data == "copy")
 async def cb_cp(cb: types.CallbackQuery):
     try:
-        if cb.from_user.id in last_fixed:
-            await cb.message.answer(f"```\n{last_fixed[cb.from_user.id][:4000]}\n```", parse_mode="Markdown")
+        fixed = await sessions.last_fixed(cb.from_user.id)
+        if fixed:
+            await cb.message.answer(f"```\n{fixed[:4000]}\n```", parse_mode="Markdown")
             await cb.answer()
         else: await cb.answer("Нет данных")
     except: await cb.answer()
@@ -1038,54 +1597,403 @@ async def cb_all(cb: types.CallbackQuery):
 
 
 
+# Фоновые циклы, которые останавливаются при выключении
+background_loops: list[asyncio.Task] = []
+
+async def sync_shared_state():
+    # Решения, сохранённые другими воркерами, — в индекс похожих и мимо кэша
+    while True:
+        await asyncio.sleep(SHARED_SYNC_INTERVAL)
+        await sync_kb_cache()
+        if SIMILARITY_ENABLED:
+            await load_similarity_index()
+
+async def reconcile_stats_loop():
+    while True:
+        await asyncio.sleep(KB_STATS_RECONCILE_INTERVAL)
+        try:
+            await reconcile_knowledge_stats()
+        except Exception as e:
+            logger.error("KB stats reconcile error: %r", e)
+
+async def sweep_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        # Одна ошибка (база занята и т.п.) не должна останавливать уборку навсегда
+        try:
+            await sessions.sweep()
+            await admission.sweep()
+            await prune_kb_changes()
+            if JOB_QUEUE_ENABLED:
+                await jobs.purge()
+        except Exception as e:
+            logger.error("Sweep error: %r", e)
+
+async def start_updates():
+    if "bot" not in ROLES:
+        return
+    if BOT_MODE == "webhook":
+        # Вебхук не удаляем при остановке — его обслуживают и другие реплики
+        update_workers.start()
+        url = (WEBHOOK_BASE_URL or WEBAPP_URL).rstrip("/") + WEBHOOK_PATH
+        try:
+            await bot.set_webhook(url, secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types())
+            logger.info("🔗 Webhook: %s", url)
+        except Exception as e:
+            logger.error("set_webhook failed: %r", e)
+        return
+    # Polling — только у процесса-лидера, иначе Telegram ответит Conflict
+    background_loops.append(asyncio.create_task(polling_lease.run(start_polling, stop_polling)))
+
+async def start_polling():
+    try:
+        # getUpdates не работает, пока установлен вебхук
+        await bot.delete_webhook()
+    except Exception as e:
+        logger.warning("delete_webhook failed: %r", e)
+    # Сессию бота не закрываем: после потери лидерства она нужна для ответов
+    task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False), name="polling")
+    # Лидерство может меняться много раз — завершённый polling из списка убираем
+    background_loops.append(task)
+    task.add_done_callback(polling_done)
+
+def polling_done(task: asyncio.Task):
+    if task in background_loops:
+        background_loops.remove(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Polling failed: %r", task.exception())
+
+async def stop_polling():
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        pass  # ещё не успел запуститься
+
+def build_static():
+    static_assets.load_dir()
+    static_assets.add("/", MINI_APP_HTML, "text/html", "no-cache")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_database()
-    asyncio.create_task(dp.start_polling(bot))
+    await init_db()
+    if "api" in ROLES:
+        # Сжатие (brotli 11) — заметная работа CPU, не в event loop
+        await asyncio.to_thread(build_static)
+    kb_writes.start()
+    await open_clients()
+    if SHARED_STATE:
+        await init_kb_changes()
+    if SIMILARITY_ENABLED:
+        background_loops.append(asyncio.create_task(load_similarity_index()))
+    background_loops.append(asyncio.create_task(sweep_sessions()))
+    background_loops.append(asyncio.create_task(counters.run()))
+    background_loops.append(asyncio.create_task(reconcile_stats_loop()))
+    if SHARED_STATE:
+        background_loops.append(asyncio.create_task(sync_shared_state()))
+    if JOB_QUEUE_ENABLED and "worker" in ROLES:
+        jobs.start()
+    await start_updates()
     yield
+    if BOT_MODE == "webhook":
+        await update_workers.stop()
+    await jobs.stop()
+    for task in job_watchers:
+        task.cancel()
+    await asyncio.gather(*job_watchers, return_exceptions=True)
+    for task in background_loops:
+        task.cancel()
+    await asyncio.gather(*background_loops, return_exceptions=True)
+    await close_clients()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await kb_writes.close()
+    await kb_pool.close()
 
 app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
 @app.get("/", response_class=HTMLResponse)
-async def root(): return HTMLResponse(content=MINI_APP_HTML)
+async def root(req: Request): return static_assets.response("/", req) or HTMLResponse(content=MINI_APP_HTML)
+
+@app.get("/static/{path:path}")
+async def static_file(path: str, req: Request):
+    return static_assets.response(f"/static/{path}", req) or JSONResponse({"error": "not found"}, status_code=404)
 
 @app.get("/health")
 async def health(): return {"status": "ok"}
 
+@app.get("/api/traces/slow")
+async def api_traces_slow(req: Request, limit: int = 10, name: Optional[str] = None):
+    token = req.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return slowest(min(limit, 100), name)
+
+@app.get("/metrics")
+async def metrics(): return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/api/stats")
-async def api_stats(): return await get_knowledge_stats()
+async def api_stats(): return {**await get_knowledge_stats(), "cache": kb_cache.stats(), "singleflight": llm_flights.stats(), "sessions": sessions.stats(), "writes": kb_writes.stats(), "updates": update_workers.stats(), "admission": admission.stats(), "scheduler": ai_scheduler.stats(), "jobs": jobs.stats(), "counters": await counters.totals()}
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(req: Request):
+    """Апдейт ставится в очередь воркеров, Telegram получает ответ сразу"""
+    if BOT_MODE != "webhook":
+        return JSONResponse({"error": "webhook disabled"}, status_code=404)
+    if "bot" not in ROLES:
+        # Апдейты здесь некому разбирать — Telegram повторит, попадёт на реплику с ролью bot
+        return JSONResponse({"error": "bot role disabled"}, status_code=503)
+    token = req.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    try:
+        update = types.Update.model_validate(await req.json(), context={"bot": bot})
+    except Exception as e:
+        # Не-2xx Telegram повторяет — битый апдейт повторять незачем
+        logger.warning("Bad update: %r", e)
+        return {"ok": False}
+    if not update_workers.submit(update):
+        return JSONResponse({"error": "busy"}, status_code=503)
+    return {"ok": True}
+
+@app.get("/api/models/health")
+async def api_models_health(): return model_health.snapshot()
+
+def request_user(req: Request) -> int:
+    """
+    Telegram id из initData Mini App (заголовок X-Telegram-Init-Data), подписанного ботом.
+    user_id в теле запроса клиент пишет какой хочет — без подписи клиент анонимный (0)
+    """
+    init_data = req.headers.get("X-Telegram-Init-Data", "")
+    if not init_data:
+        return 0
+    try:
+        parsed = safe_parse_webapp_init_data(BOT_TOKEN, init_data)
+    except Exception:
+        return 0
+    if time.time() - parsed.auth_date.timestamp() > WEBAPP_AUTH_MAX_AGE or parsed.user is None:
+        return 0
+    return parsed.user.id
+
+def admission_key(req: Request, uid: int):
+    # Анонимные клиенты ограничиваются по IP: новый user_id в теле не даёт новых лимитов
+    return uid or f"ip:{req.client.host if req.client else ''}"
+
+def rejected_response(e: AdmissionRejected) -> JSONResponse:
+    return JSONResponse({"error": e.reason, "retry_after": e.retry_after}, status_code=429, headers={"Retry-After": str(e.retry_after)})
 
 @app.post("/api/fix")
 async def api_fix(req: Request):
     try:
         data = await req.json()
-        code, uid = data.get("code", ""), data.get("user_id", 0)
-        
-        msg = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": code[:30000]}]
-        ans, model, source = await ask_ai(msg, uid)
+        code, uid = data.get("code", ""), request_user(req)
         
-        code_only = ""
-        if "```" in ans:
-            try: code_only = ans.split("```")[1].split("\n", 1)[1]
-            except: pass
-            
-        return {"fixed_code": ans, "code_only": code_only, "model": model, "source": source}
+        with start_trace("api.fix", user_id=uid):
+            with span("reduce_log", chars=len(code)):
+                text = reduce_log(code)
+            async with AsyncExitStack() as permit:
+                await permit.enter_async_context(admission.admit(admission_key(req, uid)))
+                if data.get("async") and JOB_QUEUE_ENABLED:
+                    result = await cached_fix(text, uid)
+                    if result is None:
+                        # Без ожидания: результат — GET /api/jobs/{token}; допуск держится до конца задачи
+                        job_id, token = await submit_fix(text, uid, JOB_PRIORITY_API, stream=True)
+                        watch_fix_job(job_id, uid, permit.pop_all())
+                        return JSONResponse({"job_id": token}, status_code=202, headers={"Location": f"/api/jobs/{token}"})
+                else:
+                    result = await run_fix(text, uid, JOB_PRIORITY_API)
+                ans, model, source, _ = result
+            trace_id = current_trace_id()
+        return JSONResponse(
+            {"fixed_code": ans, "code_only": extract_code(ans), "model": model, "source": source},
+            headers={"X-Trace-Id": trace_id} if trace_id else None,
+        )
+    except AdmissionRejected as e:
+        return rejected_response(e)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
+@app.post("/api/fix/stream")
+async def api_fix_stream(req: Request):
+    """SSE-вариант /api/fix: события delta/reset по мере генерации, в конце done"""
+    try:
+        data = await req.json()
+        code, uid = data.get("code", ""), request_user(req)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    # Допуск держится, пока идёт задача, а не пока открыт поток
+    permit = AsyncExitStack()
+    try:
+        await permit.enter_async_context(admission.admit(admission_key(req, uid)))
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    text = reduce_log(code)
+    stream = SSEStream()
+    # Задача не отменяется при обрыве клиента — ответ всё равно попадёт в базу знаний
+    async def run():
+        async with permit:
+            with start_trace("api.fix_stream", user_id=uid):
+                return await run_fix(text, uid, JOB_PRIORITY_API, stream.push, lambda position: stream.push(f"⏳ В очереди: {position}"))
+
+    task = asyncio.create_task(run())
+
+    async def events():
+        try:
+            async for event in stream.events(task):
+                yield event
+            ans, model, source, _ = task.result()
+            yield sse_event({"type": "done", "fixed_code": ans, "code_only": extract_code(ans), "model": model, "source": source})
+        except Exception as e:
+            yield sse_event({"type": "error", "error": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/api/fix/batch")
+async def api_fix_batch(req: Request):
+    """
+    {"items": ["лог", {"id": "test_x", "code": "лог"}, ...]} -> NDJSON.
+    Одинаковые ошибки (отпечаток и текст) решаются один раз; строка результата на
+    каждый элемент, в порядке готовности; последняя строка — {"type": "done"}
+    """
+    try:
+        data = await req.json()
+        items, uid = data.get("items"), request_user(req)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if not isinstance(items, list) or not items:
+        return JSONResponse({"error": "items: непустой список"}, status_code=400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"не больше {BATCH_MAX_ITEMS} элементов"}, status_code=413)
+
+    # Допуск — один на весь пакет, держится до последнего ответа
+    permit = AsyncExitStack()
+    try:
+        await permit.enter_async_context(admission.admit(admission_key(req, uid)))
+    except AdmissionRejected as e:
+        return rejected_response(e)
+
+    # (отпечаток, текст без разницы в пробелах) -> (текст для модели, номера элементов).
+    # Один отпечаток у разных текстов — разные элементы: общий шаблон сообщения
+    # (assert <n> == <n>) ещё не значит одно и то же падение
+    groups: dict[tuple[str, str], tuple[str, list[int]]] = {}
+    hits: dict[str, dict] = {}
+    results: asyncio.Queue = asyncio.Queue()
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def solve(error_hash: str, text: str):
+        if error_hash in hits:
+            ans = cached_answer(hits[error_hash])
+            REQUESTS.labels("cache").inc()
+            await save_history(uid, text, ans, "cache")
+            return ans, "🧠 Личная AI", "cache", error_hash
+        async with limit:
+            # Похожие и по типу ошибки ищутся уже внутри — как в /api/fix
+            return await run_fix(text, uid, JOB_PRIORITY_BATCH)
+
+    async def run_group(error_hash: str, text: str, indexes: list[int]):
+        try:
+            ans, model, source, _ = await solve(error_hash, text)
+            line = {"type": "result", "fingerprint": error_hash, "fixed_code": ans, "code_only": extract_code(ans), "model": model, "source": source}
+        except Exception as e:
+            line = {"type": "error", "fingerprint": error_hash, "error": str(e)}
+        for index in indexes:
+            item = items[index]
+            await results.put({"index": index, "id": item.get("id") if isinstance(item, dict) else None, **line})
+
+    # Задачи не отменяются при обрыве клиента — ответы всё равно попадут в базу знаний
+    async def run_all():
+        try:
+            with start_trace("api.fix_batch", user_id=uid, items=len(items)):
+                with span("reduce_log"):
+                    for index, item in enumerate(items):
+                        code = item.get("code", "") if isinstance(item, dict) else str(item)
+                        text = reduce_log(code)
+                        key = (get_error_hash(text), " ".join(text.split()))
+                        groups.setdefault(key, (text, []))[1].append(index)
+                with span("kb.bulk_search", unique=len(groups)) as sp:
+                    try:
+                        found = await bulk_lookup_knowledge_base(list({h for h, _ in groups}))
+                    except Exception as e:
+                        logger.error("DB bulk search error: %r", e)
+                        found = {}
+                    hits.update((h, row) for h, row in found.items() if row["confidence"] > 0.7)
+                    sp.set(hits=len(hits))
+                counters.incr("from_cache", sum(len(indexes) for (h, _), (_, indexes) in groups.items() if h in hits))
+                await asyncio.gather(*(run_group(h, text, indexes) for (h, _), (text, indexes) in groups.items()))
+        except Exception as e:
+            logger.error("Batch error: %r", e)
+            await results.put({"type": "error", "error": str(e)})
+        finally:
+            await permit.aclose()
+            await results.put(None)
+
+    task = asyncio.create_task(run_all())
+
+    async def lines():
+        while (line := await results.get()) is not None:
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+        yield json.dumps({"type": "done", "items": len(items), "unique": len(groups), "cache_hits": len(hits)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+@app.get("/api/jobs/{token}")
+async def api_job(token: str):
+    job_id = await jobs.find(token)
+    job = await jobs.get(job_id) if job_id is not None else None
+    if job is None:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    data = {"job_id": token, "status": job["status"], "attempts": job["attempts"]}
+    if job["status"] == "queued":
+        data["position"] = job["position"]
+    elif job["status"] == "running" and job["progress"] and job["progress"][0] == "delta":
+        data["partial"] = job["progress"][1]
+    elif job["status"] in ("done", "failed"):
+        try:
+            ans, model, source, _ = job_answer(job)
+            data.update(fixed_code=ans, code_only=extract_code(ans), model=model, source=source)
+        except AdmissionRejected as e:
+            data.update(status="rejected", error=e.reason, retry_after=e.retry_after)
+    return data
+
 @app.post("/api/rate")
 async def api_rate(req: Request):
     try:
         data = await req.json()
-        uid, rating = data.get("user_id", 0), data.get("rating", "good")
-        if uid in pending_ratings:
-            await update_confidence(pending_ratings[uid], rating == "good")
-            await save_rating(uid, pending_ratings[uid], rating)
+        uid, rating = request_user(req), data.get("rating", "good")
+        error_hash = await sessions.pending_rating(uid)
+        if error_hash:
+            await update_confidence(error_hash, rating == "good")
+            await save_rating(uid, error_hash, rating)
         return {"status": "ok"}
     except: return {"status": "error"}
 
+async def run_headless():
+    """Процесс без HTTP (ROLES=worker или ROLES=bot,worker с polling): до SIGTERM/SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with lifespan(app):
+        await stop.wait()
+
 if __name__ == "__main__":
-    logger.info(f"🚀 BotHost AI Running on port {PORT}...")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    # log_config=None: логи uvicorn идут через общую очередь (log_setup)
+    if "api" not in ROLES:
+        if "bot" in ROLES and BOT_MODE == "webhook":
+            raise SystemExit("BOT_MODE=webhook требует роль api")
+        logger.info("🚀 BotHost AI roles: %s", ",".join(sorted(ROLES)))
+        asyncio.run(run_headless())
+        raise SystemExit
+    logger.info("🚀 BotHost AI Running on port %d...", PORT)
+    if WEB_WORKERS > 1:
+        # Каждый воркер импортирует main заново; polling достаётся одному (polling_lease)
+        uvicorn.run("main:app", host="0.0.0.0", port=PORT, workers=WEB_WORKERS, log_config=None)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT, log_config=None)
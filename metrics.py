@@ -0,0 +1,71 @@
+import time
+from typing import Callable
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import GetUpdates
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+# ============================================
+# МЕТРИКИ PROMETHEUS (/metrics)
+# ============================================
+# Гистограммы задержек по стадиям запроса и счётчики исходов. Текущее
+# состояние очередей и кэшей берётся из их stats() в момент сбора метрик.
+
+# Задержки ИИ — от долей секунды до бюджета запроса
+_SLOW_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 90)
+# Быстрые стадии: база, кэш, запись
+_FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+REQUESTS = Counter("bot_requests_total", "Answered requests", ["source"])
+REQUEST_SECONDS = Histogram("bot_request_seconds", "ask_ai latency", ["source"], buckets=_SLOW_BUCKETS)
+
+KB_LOOKUP_SECONDS = Histogram("kb_lookup_seconds", "Knowledge base lookup latency", ["result"], buckets=_FAST_BUCKETS)
+KB_CACHE_REQUESTS = Counter("kb_cache_requests_total", "Knowledge base cache lookups", ["result"])
+
+UPSTREAM_SECONDS = Histogram("upstream_request_seconds", "Model call latency", ["model", "status"], buckets=_SLOW_BUCKETS)
+UPSTREAM_TTFT_SECONDS = Histogram("upstream_ttft_seconds", "Time to first byte from model", ["model"], buckets=_SLOW_BUCKETS)
+
+TELEGRAM_SECONDS = Histogram("telegram_request_seconds", "Bot API call latency", ["method", "status"], buckets=_FAST_BUCKETS + (2, 5))
+
+DB_WRITE_SECONDS = Histogram("db_write_batch_seconds", "Write-behind batch commit latency", buckets=_FAST_BUCKETS)
+DB_WRITE_BATCH = Histogram("db_write_batch_size", "Writes per batch", buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+class StatsCollector:
+    """Отдаёт числовые поля stats() компонентов как gauge: <name>_<поле>"""
+
+    def __init__(self):
+        self._sources: dict[str, Callable[[], dict]] = {}
+
+    def add(self, name: str, stats: Callable[[], dict]):
+        self._sources[name] = stats
+
+    def collect(self):
+        for name, stats in self._sources.items():
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield GaugeMetricFamily(f"{name}_{key}", f"{name} {key}", value=value)
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время вызовов Bot API; getUpdates (long polling) не считается"""
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_SECONDS.labels(getattr(method, "__api_method__", type(method).__name__), status).observe(
+                time.perf_counter() - started
+            )
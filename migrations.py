@@ -0,0 +1,279 @@
+import logging
+from typing import Awaitable, Callable, Union
+
+import aiosqlite
+
+from error_fingerprint import fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================
+# МИГРАЦИИ СХЕМЫ БАЗЫ ЗНАНИЙ
+# ============================================
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# один раз и в одной транзакции с обновлением версии. Новые изменения схемы —
+# только новой записью в конце списка, старые не редактировать.
+# Шаг миграции — SQL-строка или async-функция, принимающая соединение.
+
+Step = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+
+async def _rehash_solutions(db: aiosqlite.Connection):
+    # Хэши, посчитанные прежним алгоритмом, пересчитываем через error_fingerprint.
+    # При совпадении нового хэша у двух строк остаётся первая (UPDATE OR IGNORE),
+    # вторая доступна через поиск похожих
+    rows = await (await db.execute("SELECT error_hash, error_text FROM solutions")).fetchall()
+    for old_hash, error_text in rows:
+        new_hash = fingerprint(error_text or "")
+        if new_hash == old_hash:
+            continue
+        cursor = await db.execute("UPDATE OR IGNORE solutions SET error_hash = ? WHERE error_hash = ?", (new_hash, old_hash))
+        if cursor.rowcount:
+            await db.execute("UPDATE ratings SET error_hash = ? WHERE error_hash = ?", (new_hash, old_hash))
+
+MIGRATIONS: list[tuple[int, str, list[Step]]] = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS solutions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            error_hash TEXT UNIQUE,
+            error_text TEXT,
+            error_type TEXT,
+            solution TEXT,
+            code_snippet TEXT,
+            success_count INTEGER DEFAULT 1,
+            fail_count INTEGER DEFAULT 0,
+            confidence REAL DEFAULT 0.5,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ratings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            error_hash TEXT,
+            rating TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            query TEXT,
+            response TEXT,
+            source TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "lookup and stats indexes", [
+        # search_knowledge_base: WHERE error_type = ? AND confidence > 0.7 ORDER BY confidence DESC LIMIT 1
+        # — поиск по индексу и сразу первая строка, без сортировки
+        "CREATE INDEX IF NOT EXISTS idx_solutions_type_confidence ON solutions(error_type, confidence DESC)",
+        # get_knowledge_stats: COUNT(*) ... WHERE confidence > 0.7 / WHERE rating = ?
+        # — покрывающие индексы, таблица не читается
+        "CREATE INDEX IF NOT EXISTS idx_solutions_confidence ON solutions(confidence)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_rating ON ratings(rating)",
+        "ANALYZE",
+    ]),
+    (3, "minhash signatures for similarity search", [
+        # Сигнатуры заполняются при сохранении и фоном для старых строк (load_similarity_index)
+        "ALTER TABLE solutions ADD COLUMN minhash BLOB",
+    ]),
+    (4, "rehash solutions with error_fingerprint", [
+        _rehash_solutions,
+    ]),
+    (5, "persistent user sessions", [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            namespace TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (namespace, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at)",
+    ]),
+    (6, "shared state for several workers", [
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (7, "ai job queue", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            visible_at REAL NOT NULL,
+            locked_by TEXT,
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """,
+        # claim: WHERE status IN ('queued', 'running') AND visible_at <= ? ORDER BY priority DESC, id
+        "CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, priority DESC, id)",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs(updated_at)",
+    ]),
+    (8, "materialized knowledge base stats", [
+        "CREATE TABLE IF NOT EXISTS kb_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID",
+        """
+        INSERT OR REPLACE INTO kb_stats (name, value)
+        SELECT 'total_solutions', COUNT(*) FROM solutions
+        UNION ALL SELECT 'reliable_solutions', COUNT(*) FROM solutions WHERE confidence > 0.7
+        UNION ALL SELECT 'positive_ratings', COUNT(*) FROM ratings WHERE rating = 'good'
+        UNION ALL SELECT 'negative_ratings', COUNT(*) FROM ratings WHERE rating = 'bad'
+        UNION ALL SELECT 'total_queries', COUNT(*) FROM user_history
+        """,
+        # Триггеры срабатывают и на записи других процессов; upsert решения
+        # (ON CONFLICT DO UPDATE) — это UPDATE, а не INSERT
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_solutions_insert AFTER INSERT ON solutions BEGIN
+            UPDATE kb_stats SET value = value + 1 WHERE name = 'total_solutions';
+            UPDATE kb_stats SET value = value + 1 WHERE name = 'reliable_solutions' AND NEW.confidence > 0.7;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_solutions_delete AFTER DELETE ON solutions BEGIN
+            UPDATE kb_stats SET value = value - 1 WHERE name = 'total_solutions';
+            UPDATE kb_stats SET value = value - 1 WHERE name = 'reliable_solutions' AND OLD.confidence > 0.7;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_solutions_confidence AFTER UPDATE OF confidence ON solutions
+        WHEN (OLD.confidence > 0.7) != (NEW.confidence > 0.7) BEGIN
+            UPDATE kb_stats SET value = value + (CASE WHEN NEW.confidence > 0.7 THEN 1 ELSE -1 END)
+            WHERE name = 'reliable_solutions';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_ratings_insert AFTER INSERT ON ratings BEGIN
+            UPDATE kb_stats SET value = value + 1
+            WHERE name = CASE NEW.rating WHEN 'good' THEN 'positive_ratings' WHEN 'bad' THEN 'negative_ratings' END;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_ratings_delete AFTER DELETE ON ratings BEGIN
+            UPDATE kb_stats SET value = value - 1
+            WHERE name = CASE OLD.rating WHEN 'good' THEN 'positive_ratings' WHEN 'bad' THEN 'negative_ratings' END;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_history_insert AFTER INSERT ON user_history BEGIN
+            UPDATE kb_stats SET value = value + 1 WHERE name = 'total_queries';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_stats_history_delete AFTER DELETE ON user_history BEGIN
+            UPDATE kb_stats SET value = value - 1 WHERE name = 'total_queries';
+        END
+        """,
+    ]),
+    # Отпечаток стал строже (кадр и код пользователя) — хэши считаются заново
+    (9, "rehash solutions with user frame and code in fingerprint", [_rehash_solutions]),
+    # Журнал изменённых решений: по нему процессы сбрасывают свой kb_cache
+    (10, "knowledge base change feed", [
+        """
+        CREATE TABLE IF NOT EXISTS kb_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            error_hash TEXT NOT NULL,
+            changed_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_kb_changes_changed_at ON kb_changes(changed_at)",
+        # Новая строка тоже меняет ответ: кэш мог держать под её хэшем похожую или по типу
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_changes_solutions_insert AFTER INSERT ON solutions BEGIN
+            INSERT INTO kb_changes (error_hash, changed_at) VALUES (NEW.error_hash, (julianday('now') - 2440587.5) * 86400.0);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_changes_solutions_update AFTER UPDATE OF solution, confidence, error_hash ON solutions BEGIN
+            INSERT INTO kb_changes (error_hash, changed_at) VALUES (OLD.error_hash, (julianday('now') - 2440587.5) * 86400.0);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS kb_changes_solutions_delete AFTER DELETE ON solutions BEGIN
+            INSERT INTO kb_changes (error_hash, changed_at) VALUES (OLD.error_hash, (julianday('now') - 2440587.5) * 86400.0);
+        END
+        """,
+    ]),
+    # Лимиты допуска, общие для процессов (STATE_BACKEND=sqlite)
+    (11, "shared admission limits", [
+        """
+        CREATE TABLE IF NOT EXISTS admission_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS admission_permits (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_admission_permits_key ON admission_permits(key, expires_at)",
+    ]),
+    # Задачи снаружи (GET /api/jobs/...) — по случайному токену, а не по id подряд
+    (12, "job access tokens", [
+        "ALTER TABLE jobs ADD COLUMN token TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_token ON jobs(token)",
+    ]),
+]
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    return (await (await db.execute("PRAGMA user_version")).fetchone())[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Доводит схему до последней версии, возвращает итоговую версию"""
+    version = await get_schema_version(db)
+    for target, description, steps in MIGRATIONS:
+        if target <= version:
+            continue
+        # IMMEDIATE — сразу блокировка записи: воркеры стартуют одновременно,
+        # миграцию выполняет первый, остальные после ожидания видят новую версию
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            if await get_schema_version(db) >= target:
+                await db.rollback()
+                version = target
+                continue
+            for step in steps:
+                if isinstance(step, str):
+                    await db.execute(step)
+                else:
+                    await step(db)
+            await db.execute(f"PRAGMA user_version = {target}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            logger.exception("Migration %d (%s) failed", target, description)
+            raise
+        logger.info("DB migrated to v%d: %s", target, description)
+        version = target
+    return version
@@ -0,0 +1,151 @@
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+from config import (
+    BREAKER_COOLDOWN,
+    BREAKER_ERROR_RATE,
+    BREAKER_MIN_SAMPLES,
+    HEALTH_WINDOW,
+    SLOW_MODEL_LATENCY,
+)
+
+# ============================================
+# ЗДОРОВЬЕ МОДЕЛЕЙ + CIRCUIT BREAKER
+# ============================================
+# closed    — модель работает, запросы идут как обычно
+# open      — модель недавно падала/отдавала 429, её пропускаем до конца cooldown
+# half_open — cooldown прошёл, пропускаем одну пробную попытку:
+#             успех закрывает breaker, ошибка снова открывает
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Статусы перегрузки — открываем breaker сразу, без набора статистики
+OVERLOAD_STATUSES = {429, 503, 529}
+EWMA_ALPHA = 0.3
+MAX_COOLDOWN = 300.0
+
+
+class ModelHealth:
+    def __init__(self):
+        self.state = CLOSED
+        self.events: deque = deque(maxlen=100)  # (время, успех)
+        self.latency_ewma: Optional[float] = None
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probe_started = 0.0
+        self.last_status: Optional[int] = None
+
+    def error_rate(self, now: float) -> tuple[float, int]:
+        while self.events and now - self.events[0][0] > HEALTH_WINDOW:
+            self.events.popleft()
+        total = len(self.events)
+        if not total:
+            return 0.0, 0
+        failures = sum(1 for _, ok in self.events if not ok)
+        return failures / total, total
+
+    def current_state(self, now: float) -> str:
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+        return self.state
+
+    def trip(self, now: float, cooldown: float):
+        self.state = OPEN
+        self.open_until = now + min(cooldown, MAX_COOLDOWN)
+
+
+class ModelHealthRegistry:
+    def __init__(self):
+        self._models: dict[str, ModelHealth] = {}
+
+    def _get(self, key: str) -> ModelHealth:
+        health = self._models.get(key)
+        if health is None:
+            health = self._models[key] = ModelHealth()
+        return health
+
+    def begin(self, key: str):
+        """Отмечает старт попытки (нужно для пробы в half_open)"""
+        health = self._get(key)
+        if health.current_state(time.monotonic()) == HALF_OPEN:
+            health.probe_started = time.monotonic()
+
+    def record_success(self, key: str, latency: float):
+        now = time.monotonic()
+        health = self._get(key)
+        health.events.append((now, True))
+        health.consecutive_failures = 0
+        health.last_status = 200
+        if health.latency_ewma is None:
+            health.latency_ewma = latency
+        else:
+            health.latency_ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * health.latency_ewma
+        if health.state != CLOSED:
+            health.state = CLOSED
+            health.events.clear()
+            health.events.append((now, True))
+
+    def record_failure(self, key: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        now = time.monotonic()
+        health = self._get(key)
+        health.events.append((now, False))
+        health.consecutive_failures += 1
+        health.last_status = status
+
+        state = health.current_state(now)
+        if state == HALF_OPEN:
+            # Проба не удалась — снова открываем, cooldown растёт с числом ошибок подряд
+            health.trip(now, BREAKER_COOLDOWN * health.consecutive_failures)
+            return
+        if status in OVERLOAD_STATUSES:
+            health.trip(now, max(BREAKER_COOLDOWN, retry_after or 0))
+            return
+        rate, samples = health.error_rate(now)
+        if samples >= BREAKER_MIN_SAMPLES and rate >= BREAKER_ERROR_RATE:
+            health.trip(now, BREAKER_COOLDOWN)
+
+    def rank(self, models: list, key_of: Callable[[Any], str] = str) -> list:
+        """
+        Убирает открытые модели и двигает медленные/пробные вниз (порядок внутри групп сохраняется).
+        Если открыты все — возвращает их в порядке скорейшего восстановления
+        """
+        now = time.monotonic()
+        available = []
+        for index, model in enumerate(models):
+            health = self._models.get(key_of(model))
+            if health is None:
+                available.append(((0, 0, index), model))
+                continue
+            state = health.current_state(now)
+            if state == OPEN:
+                continue
+            if state == HALF_OPEN and now - health.probe_started < BREAKER_COOLDOWN:
+                continue  # проба уже идёт
+            slow = health.latency_ewma is not None and health.latency_ewma > SLOW_MODEL_LATENCY
+            available.append(((state == HALF_OPEN, slow, index), model))
+
+        if not available:
+            return sorted(models, key=lambda m: self._get(key_of(m)).open_until)
+        available.sort(key=lambda item: item[0])
+        return [model for _, model in available]
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        result = {}
+        for key, health in self._models.items():
+            rate, samples = health.error_rate(now)
+            state = health.current_state(now)
+            result[key] = {
+                "state": state,
+                "error_rate": round(rate, 3),
+                "samples": samples,
+                "latency_ewma_ms": None if health.latency_ewma is None else int(health.latency_ewma * 1000),
+                "consecutive_failures": health.consecutive_failures,
+                "last_status": health.last_status,
+                "reopens_in_sec": round(health.open_until - now, 1) if state == OPEN else 0,
+            }
+        return result
+
+
+model_health = ModelHealthRegistry()
@@ -0,0 +1,284 @@
+import json
+import logging
+import sys
+import time
+import zlib
+from collections import OrderedDict, deque
+from typing import Optional
+
+from config import (
+    SESSION_BACKEND,
+    SESSION_IDLE_TTL,
+    SESSION_MEMORY_BUDGET,
+    SHARED_STATE,
+)
+
+logger = logging.getLogger(__name__)
+
+# Тексты длиннее порога храним сжатыми
+COMPRESS_MIN = 256
+
+
+def _pack(text: str) -> bytes:
+    data = text.encode()
+    if len(data) > COMPRESS_MIN:
+        return b"z" + zlib.compress(data, 6)
+    return b"r" + data
+
+
+def _unpack(blob: bytes) -> str:
+    if blob[:1] == b"z":
+        return zlib.decompress(blob[1:]).decode()
+    return blob[1:].decode()
+
+
+# ============================================
+# СЕССИИ ПОЛЬЗОВАТЕЛЕЙ
+# ============================================
+# История диалога, последний исправленный код и ожидающая оценка.
+# История ограничена history_turns парами вопрос/ответ, тексты обрезаны
+# и сжаты. Сессии без активности дольше SESSION_IDLE_TTL выселяются,
+# при превышении общего бюджета памяти — самые давние (LRU).
+class Session:
+    __slots__ = ("history", "last_fixed", "pending_rating", "last_seen", "size")
+
+    def __init__(self, max_messages: int):
+        self.history: deque = deque(maxlen=max_messages)  # (role, packed)
+        self.last_fixed: Optional[bytes] = None
+        self.pending_rating: Optional[str] = None
+        self.last_seen = time.time()
+        self.size = 0
+
+    def measure(self) -> int:
+        self.size = (
+            sys.getsizeof(self)
+            + sum(len(packed) + 64 for _, packed in self.history)
+            + (len(self.last_fixed) if self.last_fixed else 0)
+            + 64
+        )
+        return self.size
+
+    def dump(self) -> bytes:
+        return zlib.compress(json.dumps({
+            "h": [[role, _unpack(packed)] for role, packed in self.history],
+            "f": _unpack(self.last_fixed) if self.last_fixed else None,
+            "p": self.pending_rating,
+            "t": self.last_seen,
+        }, ensure_ascii=False).encode())
+
+    @classmethod
+    def load(cls, blob: bytes, max_messages: int) -> "Session":
+        data = json.loads(zlib.decompress(blob))
+        session = cls(max_messages)
+        for role, text in data["h"]:
+            session.history.append((role, _pack(text)))
+        session.last_fixed = _pack(data["f"]) if data["f"] else None
+        session.pending_rating = data["p"]
+        session.last_seen = data["t"]
+        return session
+
+
+class MemoryBackend:
+    """Без персистентности: сессии живут только в памяти процесса"""
+
+    async def load(self, namespace: str, user_id: int) -> Optional[bytes]:
+        return None
+
+    async def save(self, namespace: str, user_id: int, blob: bytes, updated_at: float):
+        pass
+
+    async def purge(self, older_than: float):
+        pass
+
+
+class SQLiteBackend:
+    """Сессии в таблице sessions базы знаний — переживают перезапуск"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def load(self, namespace: str, user_id: int) -> Optional[bytes]:
+        async with self.pool.reader() as db:
+            cursor = await db.execute(
+                "SELECT data FROM sessions WHERE namespace = ? AND user_id = ? AND updated_at > ?",
+                (namespace, user_id, time.time() - SESSION_IDLE_TTL),
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def save(self, namespace: str, user_id: int, blob: bytes, updated_at: float):
+        async with self.pool.writer() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO sessions (namespace, user_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                (namespace, user_id, blob, updated_at),
+            )
+
+    async def purge(self, older_than: float):
+        async with self.pool.writer() as db:
+            await db.execute("DELETE FROM sessions WHERE updated_at < ?", (older_than,))
+
+
+class RedisBackend:
+    """Сессии в redis — общие для реплик на разных машинах; устаревание — TTL ключа"""
+
+    def __init__(self, client, prefix: str = "bot:session:"):
+        self.redis = client
+        self.prefix = prefix
+
+    async def load(self, namespace: str, user_id: int) -> Optional[bytes]:
+        return await self.redis.get(f"{self.prefix}{namespace}:{user_id}")
+
+    async def save(self, namespace: str, user_id: int, blob: bytes, updated_at: float):
+        await self.redis.set(f"{self.prefix}{namespace}:{user_id}", blob, ex=int(SESSION_IDLE_TTL))
+
+    async def purge(self, older_than: float):
+        pass
+
+
+def make_backend(name: str = SESSION_BACKEND):
+    if name == "sqlite":
+        from db_pool import kb_pool
+        return SQLiteBackend(kb_pool)
+    if name == "redis":
+        from shared_state import redis_client
+        return RedisBackend(redis_client())
+    if SHARED_STATE:
+        logger.warning("SESSION_BACKEND=memory with several workers: sessions are not shared")
+    return MemoryBackend()
+
+
+class SessionStore:
+    def __init__(
+        self,
+        namespace: str,
+        history_turns: int,
+        turn_chars: int,
+        backend=None,
+        idle_ttl: float = SESSION_IDLE_TTL,
+        memory_budget: int = SESSION_MEMORY_BUDGET,
+    ):
+        self.namespace = namespace
+        self.max_messages = history_turns * 2
+        self.turn_chars = turn_chars
+        self.backend = backend or make_backend()
+        # Несколько процессов: сессию мог изменить другой воркер, память — только на время вызова
+        self.shared = SHARED_STATE and not isinstance(self.backend, MemoryBackend)
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self._sessions: OrderedDict[int, Session] = OrderedDict()
+        self.bytes = 0
+        self.created = 0
+        self.evicted = 0
+
+    async def _get(self, user_id: int, create: bool = True) -> Optional[Session]:
+        if self.shared:
+            self._drop(user_id)
+        session = self._sessions.get(user_id)
+        now = time.time()
+        if session is not None and now - session.last_seen > self.idle_ttl:
+            self._drop(user_id)
+            session = None
+        if session is None:
+            try:
+                blob = await self.backend.load(self.namespace, user_id)
+            except Exception as e:
+                logger.warning("Session load failed: %r", e)
+                blob = None
+            if blob:
+                session = Session.load(blob, self.max_messages)
+            elif not create:
+                return None
+            else:
+                session = Session(self.max_messages)
+                self.created += 1
+            self._sessions[user_id] = session
+            self.bytes += session.measure()
+        self._sessions.move_to_end(user_id)
+        session.last_seen = now
+        return session
+
+    async def _commit(self, user_id: int, session: Session):
+        old = session.size
+        self.bytes += session.measure() - old
+        try:
+            await self.backend.save(self.namespace, user_id, session.dump(), session.last_seen)
+        except Exception as e:
+            logger.warning("Session save failed: %r", e)
+        self._enforce_budget()
+
+    def _drop(self, user_id: int):
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            self.bytes -= session.size
+
+    def _enforce_budget(self):
+        while self.bytes > self.memory_budget and len(self._sessions) > 1:
+            user_id = next(iter(self._sessions))
+            self._drop(user_id)
+            self.evicted += 1
+
+    async def history(self, user_id: int) -> list[dict]:
+        session = await self._get(user_id, create=False)
+        if session is None:
+            return []
+        return [{"role": role, "content": _unpack(packed)} for role, packed in session.history]
+
+    async def add_turn(self, user_id: int, question: str, answer: str):
+        session = await self._get(user_id)
+        session.history.append(("user", _pack(question[:self.turn_chars])))
+        session.history.append(("assistant", _pack(answer[:self.turn_chars])))
+        await self._commit(user_id, session)
+
+    async def clear_history(self, user_id: int):
+        session = await self._get(user_id, create=False)
+        if session is not None:
+            session.history.clear()
+            await self._commit(user_id, session)
+
+    async def last_fixed(self, user_id: int) -> Optional[str]:
+        session = await self._get(user_id, create=False)
+        if session is None or session.last_fixed is None:
+            return None
+        return _unpack(session.last_fixed)
+
+    async def set_last_fixed(self, user_id: int, text: str):
+        session = await self._get(user_id)
+        session.last_fixed = _pack(text)
+        await self._commit(user_id, session)
+
+    async def pending_rating(self, user_id: int) -> Optional[str]:
+        session = await self._get(user_id, create=False)
+        return session.pending_rating if session else None
+
+    async def set_pending_rating(self, user_id: int, error_hash: str):
+        session = await self._get(user_id)
+        session.pending_rating = error_hash
+        await self._commit(user_id, session)
+
+    async def pop_pending_rating(self, user_id: int) -> Optional[str]:
+        session = await self._get(user_id, create=False)
+        if session is None or session.pending_rating is None:
+            return None
+        error_hash, session.pending_rating = session.pending_rating, None
+        await self._commit(user_id, session)
+        return error_hash
+
+    async def sweep(self):
+        """Выселяет простаивающие сессии из памяти и из хранилища"""
+        cutoff = time.time() - self.idle_ttl
+        idle = [user_id for user_id, session in self._sessions.items() if session.last_seen < cutoff]
+        for user_id in idle:
+            self._drop(user_id)
+        self.evicted += len(idle)
+        try:
+            await self.backend.purge(cutoff)
+        except Exception as e:
+            logger.warning("Session purge failed: %r", e)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self.bytes,
+            "created": self.created,
+            "evicted": self.evicted,
+        }
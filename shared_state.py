@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+from config import STATE_BACKEND, REDIS_URL, LEADER_LEASE_TTL, SHARED_SYNC_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# ============================================
+# ОБЩЕЕ СОСТОЯНИЕ ПРОЦЕССОВ И РЕПЛИК
+# ============================================
+# Аренды (кто из процессов лидер), счётчики и лимиты допуска, общие для
+# всех воркеров (лимиты в памяти ведёт сам admission).
+# memory — один процесс, как раньше; sqlite — процессы на одной машине
+# (таблицы leases/counters базы знаний, WAL); redis — реплики на разных машинах
+# (нужен пакет redis, подойдёт любой совместимый сервер).
+
+_clients: dict = {}
+
+
+def redis_client(url: str = REDIS_URL):
+    """Общий клиент redis на процесс (импорт — только если backend выбран)"""
+    if url not in _clients:
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis требует пакет redis: pip install redis")
+        _clients[url] = redis.from_url(url)
+    return _clients[url]
+
+
+class MemoryState:
+    def __init__(self):
+        self._leases: dict[str, tuple[str, float]] = {}
+        self._counters: Counter = Counter()
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        holder = self._leases.get(name)
+        if holder is None or holder[0] == owner or holder[1] < time.time():
+            self._leases[name] = (owner, time.time() + ttl)
+            return True
+        return False
+
+    async def release(self, name: str, owner: str):
+        if self._leases.get(name, ("",))[0] == owner:
+            del self._leases[name]
+
+    async def add_counters(self, deltas: dict[str, int]):
+        self._counters.update(deltas)
+
+    async def counters(self) -> dict[str, int]:
+        return dict(self._counters)
+
+
+class SQLiteState:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        # Захват или продление одним запросом: чужую аренду можно забрать, только если она истекла
+        now = time.time()
+        async with self.pool.writer() as db:
+            await db.execute(
+                """
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+                """,
+                (name, owner, now + ttl, now),
+            )
+            row = await (await db.execute("SELECT owner FROM leases WHERE name = ?", (name,))).fetchone()
+        return row is not None and row[0] == owner
+
+    async def release(self, name: str, owner: str):
+        async with self.pool.writer() as db:
+            await db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    async def add_counters(self, deltas: dict[str, int]):
+        async with self.pool.writer() as db:
+            await db.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                list(deltas.items()),
+            )
+
+    async def counters(self) -> dict[str, int]:
+        async with self.pool.reader() as db:
+            rows = await (await db.execute("SELECT name, value FROM counters")).fetchall()
+        return {name: value for name, value in rows}
+
+    async def take_permit(self, key: str, max_inflight: int, rate: float, burst: int, ttl: float) -> tuple[Optional[int], Optional[str], float]:
+        """(id допуска, None, 0) или (None, "inflight" | "rate", сколько ждать)"""
+        now = time.time()
+        async with self.pool.writer() as db:
+            # Первым — запись: блокировка базы берётся сразу, соседний процесс ждёт, а не гонится
+            await db.execute(
+                "INSERT INTO admission_buckets (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = MIN(?, tokens + (excluded.updated_at - updated_at) * ?), "
+                "updated_at = excluded.updated_at",
+                (key, burst, now, burst, rate),
+            )
+            cursor = await db.execute("SELECT COUNT(*) FROM admission_permits WHERE key = ? AND expires_at > ?", (key, now))
+            if (await cursor.fetchone())[0] >= max_inflight:
+                return None, "inflight", 0
+            tokens = (await (await db.execute("SELECT tokens FROM admission_buckets WHERE key = ?", (key,))).fetchone())[0]
+            if tokens < 1:
+                return None, "rate", (1 - tokens) / rate
+            await db.execute("UPDATE admission_buckets SET tokens = tokens - 1 WHERE key = ?", (key,))
+            cursor = await db.execute("INSERT INTO admission_permits (key, expires_at) VALUES (?, ?)", (key, now + ttl))
+            return cursor.lastrowid, None, 0
+
+    async def release_permit(self, key: str, permit: int):
+        async with self.pool.writer() as db:
+            await db.execute("DELETE FROM admission_permits WHERE id = ?", (permit,))
+
+    async def sweep_admission(self, bucket_idle: float):
+        # Допуски упавших процессов и полные (неотличимые от новых) корзины
+        now = time.time()
+        async with self.pool.writer() as db:
+            await db.execute("DELETE FROM admission_permits WHERE expires_at < ?", (now,))
+            await db.execute("DELETE FROM admission_buckets WHERE updated_at < ?", (now - bucket_idle,))
+
+
+# Продление и освобождение только своей аренды — атомарно на стороне redis
+_RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+_RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+# Допуск: KEYS — корзина (hash), допуски (zset, score — срок); ARGV — now, max_inflight,
+# rate, burst, ttl, id. Ответ: {1, 0} — взят, {0, 0} — лимит одновременных, {-1, ждать}
+_TAKE_PERMIT = """
+local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[3]), tonumber(ARGV[4])
+redis.call('zremrangebyscore', KEYS[2], '-inf', now)
+if redis.call('zcard', KEYS[2]) >= tonumber(ARGV[2]) then return {0, '0'} end
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+tokens = math.min(burst, tokens + (now - (tonumber(bucket[2]) or now)) * rate)
+local idle = math.ceil(burst / rate) + 1
+if tokens < 1 then
+    redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[1])
+    redis.call('expire', KEYS[1], idle)
+    return {-1, tostring((1 - tokens) / rate)}
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens - 1), 'updated', ARGV[1])
+redis.call('expire', KEYS[1], idle)
+redis.call('zadd', KEYS[2], now + tonumber(ARGV[5]), ARGV[6])
+redis.call('expire', KEYS[2], math.ceil(tonumber(ARGV[5])))
+return {1, '0'}
+"""
+
+
+class RedisState:
+    def __init__(self, client, prefix: str = "bot:"):
+        self.redis = client
+        self.prefix = prefix
+
+    async def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        key, ms = f"{self.prefix}lease:{name}", int(ttl * 1000)
+        if await self.redis.set(key, owner, nx=True, px=ms):
+            return True
+        return bool(await self.redis.eval(_RENEW, 1, key, owner, ms))
+
+    async def release(self, name: str, owner: str):
+        await self.redis.eval(_RELEASE, 1, f"{self.prefix}lease:{name}", owner)
+
+    async def add_counters(self, deltas: dict[str, int]):
+        pipe = self.redis.pipeline(transaction=False)
+        for name, value in deltas.items():
+            pipe.hincrby(f"{self.prefix}counters", name, value)
+        await pipe.execute()
+
+    async def counters(self) -> dict[str, int]:
+        data = await self.redis.hgetall(f"{self.prefix}counters")
+        return {k.decode(): int(v) for k, v in data.items()}
+
+    async def take_permit(self, key: str, max_inflight: int, rate: float, burst: int, ttl: float) -> tuple[Optional[str], Optional[str], float]:
+        permit = uuid.uuid4().hex
+        status, wait = await self.redis.eval(
+            _TAKE_PERMIT, 2, f"{self.prefix}admission:{key}:bucket", f"{self.prefix}admission:{key}:permits",
+            time.time(), max_inflight, rate, burst, ttl, permit,
+        )
+        if status == 1:
+            return permit, None, 0
+        return None, "inflight" if status == 0 else "rate", float(wait)
+
+    async def release_permit(self, key: str, permit: str):
+        await self.redis.zrem(f"{self.prefix}admission:{key}:permits", permit)
+
+    async def sweep_admission(self, bucket_idle: float):
+        pass  # ключи истекают сами (expire)
+
+
+def make_state(name: str = STATE_BACKEND):
+    if name == "sqlite":
+        from db_pool import kb_pool
+        return SQLiteState(kb_pool)
+    if name == "redis":
+        return RedisState(redis_client())
+    return MemoryState()
+
+
+class SharedCounters:
+    """Счётчики копятся в процессе и сбрасываются в общее хранилище раз в interval"""
+
+    def __init__(self, state, interval: float = SHARED_SYNC_INTERVAL):
+        self.state = state
+        self.interval = interval
+        self._pending: Counter = Counter()
+
+    def incr(self, name: str, value: int = 1):
+        self._pending[name] += value
+
+    async def flush(self):
+        if not self._pending:
+            return
+        deltas, self._pending = dict(self._pending), Counter()
+        try:
+            await self.state.add_counters(deltas)
+        except Exception as e:
+            self._pending.update(deltas)  # попробуем в следующий раз
+            logger.warning("Counters flush failed: %r", e)
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+    async def totals(self) -> dict[str, int]:
+        totals = Counter(await self.state.counters())
+        totals.update(self._pending)
+        return dict(totals)
+
+
+class LeaderLease:
+    """
+    Лидер — процесс, держащий аренду name; продлевает её каждые ttl/3.
+    Потеря связи с хранилищем = потеря лидерства: иначе после истечения
+    аренды лидеров стало бы два
+    """
+
+    def __init__(self, state, name: str, ttl: float = LEADER_LEASE_TTL):
+        self.state = state
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.is_leader = False
+
+    async def run(self, on_acquired: Callable[[], Awaitable[None]], on_lost: Callable[[], Awaitable[None]]):
+        try:
+            while True:
+                try:
+                    held = await self.state.acquire(self.name, self.owner, self.ttl)
+                except Exception as e:
+                    logger.warning("Lease %s renew failed: %r", self.name, e)
+                    held = False
+                if held != self.is_leader:
+                    self.is_leader = held
+                    logger.info("Lease %s %s by %s", self.name, "acquired" if held else "lost", self.owner)
+                    try:
+                        await (on_acquired() if held else on_lost())
+                    except Exception as e:
+                        logger.error("Lease %s callback failed: %r", self.name, e)
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if self.is_leader:
+                self.is_leader = False
+                await on_lost()
+                try:
+                    await self.state.release(self.name, self.owner)
+                except Exception as e:
+                    logger.warning("Lease %s release failed: %r", self.name, e)
+
+    def stats(self) -> dict:
+        return {"leader": int(self.is_leader)}
+
+
+shared_state = make_state()
@@ -0,0 +1,111 @@
+import random
+import re
+import zlib
+from array import array
+from typing import Optional
+
+from config import SIMILARITY_NUM_PERM, SIMILARITY_BANDS
+
+# ============================================
+# ПОИСК ПОХОЖИХ ОШИБОК (MinHash + LSH)
+# ============================================
+# Точный хэш совпадает только у байт-в-байт одинаковых логов. Здесь каждая
+# ошибка превращается в MinHash-сигнатуру по биграммам слов; LSH-бакеты
+# (bands по rows значений сигнатуры) дают кандидатов, а доля совпавших
+# значений сигнатуры оценивает сходство Жаккара. Всё локально, без сервисов.
+
+_MERSENNE = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_TOKEN_RE = re.compile(r"[a-zа-яё_][a-zа-яё0-9_]*")
+# Шум, который отличается от пользователя к пользователю
+_NOISE_RE = re.compile(r"0x[0-9a-f]+|\b\d+\b|(?:/[\w.\-]+)+/|[a-z]:\\[\w\\. \-]+\\")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(_NOISE_RE.sub(" ", text.lower()))
+
+
+class SimilarityIndex:
+    def __init__(self, num_perm: int = SIMILARITY_NUM_PERM, bands: int = SIMILARITY_BANDS, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rnd = random.Random(seed)  # фиксированный seed — сигнатуры в базе совместимы между запусками
+        self._perms = [(rnd.randrange(1, _MERSENNE), rnd.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+        self._signatures: dict[str, array] = {}
+        self._buckets: list[dict[int, set[str]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def signature(self, text: str) -> Optional[array]:
+        tokens = tokenize(text)
+        if len(tokens) >= 2:
+            shingles = {f"{a} {b}" for a, b in zip(tokens, tokens[1:])}
+        else:
+            shingles = set(tokens)
+        if not shingles:
+            return None
+        hashes = [zlib.crc32(s.encode()) for s in shingles]
+        return array("I", (
+            min((a * h + b) % _MERSENNE for h in hashes) & _MAX_HASH
+            for a, b in self._perms
+        ))
+
+    def _band_keys(self, sig: array):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield band, hash(tuple(sig[start:start + self.rows]))
+
+    def add(self, key: str, sig: Optional[array]):
+        if sig is None or len(sig) != self.num_perm:
+            return
+        self.remove(key)
+        self._signatures[key] = sig
+        for band, bucket in self._band_keys(sig):
+            self._buckets[band].setdefault(bucket, set()).add(key)
+
+    def remove(self, key: str):
+        sig = self._signatures.pop(key, None)
+        if sig is None:
+            return
+        for band, bucket in self._band_keys(sig):
+            keys = self._buckets[band].get(bucket)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[band][bucket]
+
+    def query(self, text: str, k: int = 5, threshold: float = 0.5) -> list[tuple[str, float]]:
+        """Ближайшие (ключ, оценка Жаккара) не ниже threshold, лучшие первыми"""
+        sig = self.signature(text)
+        if sig is None:
+            return []
+        candidates = set()
+        for band, bucket in self._band_keys(sig):
+            candidates |= self._buckets[band].get(bucket, set())
+        scored = []
+        for key in candidates:
+            other = self._signatures[key]
+            score = sum(1 for x, y in zip(sig, other) if x == y) / self.num_perm
+            if score >= threshold:
+                scored.append((key, score))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+
+def signature_to_blob(sig: Optional[array]) -> Optional[bytes]:
+    return sig.tobytes() if sig is not None else None
+
+
+def blob_to_signature(blob: Optional[bytes]) -> Optional[array]:
+    if not blob:
+        return None
+    sig = array("I")
+    sig.frombytes(blob)
+    return sig
+
+
+kb_index = SimilarityIndex()
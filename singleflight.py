@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+Publish = Callable[[str], None]
+
+
+# ============================================
+# SINGLE-FLIGHT: ОДИН ЗАПРОС К ИИ НА ОДИНАКОВЫЕ ОШИБКИ
+# ============================================
+# Пока по ключу идёт вызов, все одинаковые запросы ждут его результат,
+# а не запускают свой. Вызов идёт отдельной задачей: отмена одного из
+# ожидающих (клиент ушёл) не отменяет работу для остальных.
+# Потоковые токены ведущего вызова рассылаются всем подписчикам.
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers: list[Publish] = []
+        self.last = ""
+
+    def publish(self, text: str):
+        self.last = text
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber(text)
+            except Exception as e:
+                logger.warning("Single-flight subscriber failed: %r", e)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: dict[Hashable, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[Publish], Awaitable[Any]],
+        on_delta: Optional[Publish] = None,
+    ) -> tuple[Any, bool]:
+        """Возвращает (результат, shared) — shared=True, если результат чужого вызова"""
+        flight = self._flights.get(key)
+        shared = flight is not None
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(fn(flight.publish))
+            flight.task.add_done_callback(lambda task: self._finish(key, flight))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            if on_delta and flight.last:
+                on_delta(flight.last)  # догоняем уже сгенерированное
+
+        if on_delta:
+            flight.subscribers.append(on_delta)
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            if on_delta in flight.subscribers:
+                flight.subscribers.remove(on_delta)
+
+    def _finish(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.task.cancelled() and flight.task.exception():
+            logger.warning("Single-flight call %s failed: %r", key, flight.task.exception())
+
+    def stats(self) -> dict:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "upstream_calls": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_rate": round(self.coalesced / total, 3) if total else 0.0,
+        }
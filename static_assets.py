@@ -0,0 +1,189 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+from collections import Counter
+from typing import Optional, Union
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from config import STATIC_DIR, STATIC_MAX_AGE, STATIC_COMPRESS_MIN
+
+try:
+    import brotli  # необязательный: без него только gzip
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# ============================================
+# СТАТИКА: МИНИФИКАЦИЯ, СЖАТИЕ, ETAG
+# ============================================
+# Всё готовится один раз при старте и лежит в памяти: минифицированное тело,
+# gzip и brotli. На запрос — выбор кодировки по Accept-Encoding и 304, если
+# у клиента та же версия (If-None-Match). Ссылки /static/... в HTML
+# переписываются на /static/...?v=<хэш>: такие ответы кэшируются навсегда,
+# а новая версия файла — новый URL. Сам HTML — no-cache (всегда с проверкой,
+# обычно 304 без тела).
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+_RAW_BLOCK = re.compile(r"<(pre|textarea)\b.*?</\1>", re.S | re.I)
+_STYLE_BLOCK = re.compile(r"(<style\b[^>]*>)(.*?)(</style>)", re.S | re.I)
+_HTML_COMMENT = re.compile(r"<!--.*?-->", re.S)
+_STATIC_REF = re.compile(r'\b(href|src)="(/static/[^"?#]+)"')
+
+
+def minify_css(text: str) -> str:
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip()
+
+
+def _minify_markup(text: str) -> str:
+    text = _HTML_COMMENT.sub("", text)
+    text = _STYLE_BLOCK.sub(lambda m: m.group(1) + minify_css(m.group(2)) + m.group(3), text)
+    # Переводы строк остаются: во встроенном JS на них держатся // комментарии и ASI
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def minify_html(text: str) -> str:
+    """Отступы, пустые строки, комментарии; содержимое <pre> и <textarea> не трогается"""
+    parts, pos = [], 0
+    for m in _RAW_BLOCK.finditer(text):
+        parts.append(_minify_markup(text[pos:m.start()]))
+        parts.append(m.group(0))
+        pos = m.end()
+    parts.append(_minify_markup(text[pos:]))
+    return "".join(parts)
+
+
+def _accepted(header: str) -> dict[str, float]:
+    # "gzip, deflate, br;q=0.5" -> {"gzip": 1.0, "deflate": 1.0, "br": 0.5}
+    result = {}
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name.strip():
+            result[name.strip().lower()] = q
+    return result
+
+
+class Asset:
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.version = hashlib.sha256(body).hexdigest()[:12]
+        self.encoded: dict[str, bytes] = {}
+        if len(body) >= STATIC_COMPRESS_MIN and media_type.startswith(COMPRESSIBLE):
+            if brotli is not None:
+                self.encoded["br"] = brotli.compress(body, quality=11)
+            self.encoded["gzip"] = gzip.compress(body, 9, mtime=0)
+        # Сжатие, которое не уменьшило файл, бесполезно
+        self.encoded = {k: v for k, v in self.encoded.items() if len(v) < len(body)}
+        # Сильный ETag у каждого представления свой (RFC 9110, 8.8.3)
+        self.etags = {None: f'"{self.version}"', **{k: f'"{self.version}-{k}"' for k in self.encoded}}
+
+    def encoding_for(self, accept_encoding: str) -> Optional[str]:
+        accepted = _accepted(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+    def not_modified(self, if_none_match: str) -> bool:
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return not tags.isdisjoint(self.etags.values())
+
+
+class StaticAssets:
+    def __init__(self):
+        self._assets: dict[str, Asset] = {}
+        self.served: Counter = Counter()
+
+    def add(self, path: str, body: Union[str, bytes], media_type: str, cache_control: Optional[str] = None) -> Asset:
+        if isinstance(body, str):
+            if media_type == "text/html":
+                body = minify_html(self._versioned_refs(body))
+            elif media_type == "text/css":
+                body = minify_css(body)
+            body = body.encode("utf-8")
+        asset = Asset(body, media_type, cache_control or f"public, max-age={STATIC_MAX_AGE}")
+        self._assets[path] = asset
+        return asset
+
+    def load_dir(self, directory: str = STATIC_DIR, prefix: str = "/static/"):
+        if not os.path.isdir(directory):
+            return
+        files = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                full = os.path.join(root, name)
+                files.append((prefix + os.path.relpath(full, directory).replace(os.sep, "/"), full))
+        # HTML последним: ссылки в нём получают версии уже загруженных файлов
+        files.sort(key=lambda item: item[0].endswith(".html"))
+        for path, full in files:
+            media_type = mimetypes.guess_type(full)[0] or "application/octet-stream"
+            with open(full, "rb") as f:
+                body = f.read()
+            if media_type.startswith("text/"):
+                body = body.decode("utf-8")
+            # HTML ссылается на версии остальных файлов — его всегда перепроверяем
+            self.add(path, body, media_type, "no-cache" if media_type == "text/html" else None)
+        logger.info("Static: %d files from %s (brotli: %s)", len(files), directory, "yes" if brotli else "no")
+
+    def _versioned_refs(self, html: str) -> str:
+        def repl(m: re.Match) -> str:
+            asset = self._assets.get(m.group(2))
+            return f'{m.group(1)}="{m.group(2)}?v={asset.version}"' if asset else m.group(0)
+        return _STATIC_REF.sub(repl, html)
+
+    def url(self, path: str) -> str:
+        asset = self._assets.get(path)
+        return f"{path}?v={asset.version}" if asset else path
+
+    def response(self, path: str, request: Request) -> Optional[Response]:
+        asset = self._assets.get(path)
+        if asset is None:
+            return None
+        encoding = asset.encoding_for(request.headers.get("accept-encoding", ""))
+        versioned = request.query_params.get("v") == asset.version
+        headers = {
+            "ETag": asset.etags[encoding],
+            "Cache-Control": IMMUTABLE if versioned else asset.cache_control,
+        }
+        if asset.encoded:
+            headers["Vary"] = "Accept-Encoding"
+        if asset.not_modified(request.headers.get("if-none-match", "")):
+            self.served["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+        self.served[encoding or "identity"] += 1
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return Response(asset.encoded[encoding], media_type=asset.media_type, headers=headers)
+        return Response(asset.body, media_type=asset.media_type, headers=headers)
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self._assets),
+            "bytes": sum(len(a.body) for a in self._assets.values()),
+            **{f"served_{k}": v for k, v in self.served.items()},
+        }
+
+
+static_assets = StaticAssets()
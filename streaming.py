@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import STREAM_EDIT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_LIMIT = 4096
+
+
+# ============================================
+# ПОТОКОВЫЕ ОТВЕТЫ
+# ============================================
+class ThrottledEditor:
+    """
+    Прогрессивно редактирует сообщение по мере прихода токенов.
+    push() вызывается на каждый токен, а edit_message_text уходит не чаще
+    раза в STREAM_EDIT_INTERVAL сек (лимиты Telegram ~1 правка/сек на чат).
+    На TelegramRetryAfter ждём сколько просит Telegram
+    """
+
+    def __init__(self, edit: Callable[[str], Awaitable], interval: float = STREAM_EDIT_INTERVAL):
+        self._edit = edit
+        self._interval = interval
+        self._text = ""
+        self._cursor = True
+        self._shown = ""
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def push(self, text: str, cursor: bool = True):
+        self._text = text
+        self._cursor = cursor
+        self._changed.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self._text
+            if len(text) > TELEGRAM_LIMIT - 2:
+                text = text[:TELEGRAM_LIMIT - 2] + " …"
+            if text.strip() and text != self._shown:
+                try:
+                    await self._edit(text + " ▌" if self._cursor else text)
+                    self._shown = text
+                except TelegramRetryAfter as e:
+                    self._changed.set()
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except TelegramBadRequest:
+                    pass  # "message is not modified" и т.п.
+                except Exception as e:
+                    logger.warning("Stream edit failed: %r", e)
+            await asyncio.sleep(self._interval)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class SSEStream:
+    """
+    Очередь для /api/fix/stream: push() получает весь текст на текущий момент,
+    events() отдаёт только прирост (или полный текст, если ответ сменила другая модель)
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._changed = asyncio.Event()
+
+    def push(self, text: str):
+        self._text = text
+        self._changed.set()
+
+    async def events(self, result: asyncio.Task):
+        sent = ""
+        while True:
+            waiter = asyncio.create_task(self._changed.wait())
+            await asyncio.wait({waiter, result}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            self._changed.clear()
+            text = self._text
+            if text != sent:
+                if text.startswith(sent):
+                    yield sse_event({"type": "delta", "text": text[len(sent):]})
+                else:
+                    yield sse_event({"type": "reset", "text": text})
+                sent = text
+            if result.done():
+                return
+
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
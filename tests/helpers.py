@@ -0,0 +1,25 @@
+from contextlib import asynccontextmanager
+
+from db_pool import SQLitePool
+from migrations import migrate
+
+
+# pytest-asyncio не нужен: тест сам запускает asyncio.run, пул живёт внутри одного цикла
+@asynccontextmanager
+async def migrated_pool(path, readers: int = 2):
+    pool = SQLitePool(str(path), readers)
+    async with pool.writer() as db:
+        await db.commit()  # migrate сам открывает транзакции
+        await migrate(db)
+    try:
+        yield pool
+    finally:
+        await pool.close()
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
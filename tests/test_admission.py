@@ -0,0 +1,231 @@
+import asyncio
+
+import pytest
+
+import admission
+import shared_state
+from admission import AdmissionRejected, FairScheduler, TokenBucket
+from shared_state import SQLiteState
+from tests.helpers import FakeClock, migrated_pool
+
+
+# ---------- token bucket ----------
+
+def test_token_bucket_burst_then_refill(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    bucket = TokenBucket(2)
+    assert bucket.take(1.0, 2) == 0
+    assert bucket.take(1.0, 2) == 0
+    assert bucket.take(1.0, 2) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert bucket.take(1.0, 2) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.take(1.0, 2) == 0
+
+
+def test_token_bucket_caps_at_capacity(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    bucket = TokenBucket(2)
+    clock.now += 3600
+    assert [bucket.take(1.0, 2) == 0 for _ in range(3)] == [True, True, False]
+
+
+# ---------- FairScheduler ----------
+
+def test_cancel_while_granted_releases_slot():
+    # Слот выдан (future выполнен), но ожидающего отменили раньше, чем он проснулся:
+    # слот должен вернуться, иначе concurrency тает с каждой такой отменой
+    async def scenario():
+        scheduler = FairScheduler(concurrency=1, max_queue=10, weights={})
+        holder_release = asyncio.Event()
+
+        async def waiter():
+            async with scheduler.slot("b"):
+                pass
+
+        async def holder():
+            async with scheduler.slot("a"):
+                await holder_release.wait()
+            # На этом же шаге цикла _release уже выполнил future ожидающего — он ещё не проснулся
+            assert scheduler.stats()["running"] == 1
+            second.cancel()
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert scheduler.stats()["waiting"] == 1
+
+        holder_release.set()
+        await first
+        with pytest.raises(asyncio.CancelledError):
+            await second
+
+        stats = scheduler.stats()
+        assert stats["running"] == 0 and stats["waiting"] == 0
+        async with scheduler.slot("c"):
+            assert scheduler.stats()["running"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancel_while_waiting_leaves_queue():
+    async def scenario():
+        scheduler = FairScheduler(concurrency=1, max_queue=10, weights={})
+        release = asyncio.Event()
+
+        async def hold(key):
+            async with scheduler.slot(key):
+                await release.wait()
+
+        first = asyncio.create_task(hold("a"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(hold("b"))
+        await asyncio.sleep(0)
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        assert scheduler.stats()["waiting"] == 0 and scheduler.stats()["waiting_users"] == 0
+        release.set()
+        await first
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_round_robin_order_and_positions():
+    # a прислал три запроса, b и c по одному: b и c не ждут всю очередь a.
+    # Вес 2 у c — два слота за ход
+    async def scenario():
+        scheduler = FairScheduler(concurrency=1, max_queue=10, weights={"c": 2})
+        release = asyncio.Event()
+        order, positions = [], {}
+
+        async def blocker():
+            async with scheduler.slot("x"):
+                await release.wait()
+
+        async def request(name, key):
+            def on_position(position):
+                positions.setdefault(name, []).append(position)
+
+            async with scheduler.slot(key, on_position):
+                order.append(name)
+
+        blocking = asyncio.create_task(blocker())
+        await asyncio.sleep(0)
+        tasks = []
+        for name, key in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("c1", "c"), ("c2", "c")]:
+            tasks.append(asyncio.create_task(request(name, key)))
+            await asyncio.sleep(0)
+
+        assert [positions[name][-1] for name in ("a1", "b1", "c1", "c2", "a2", "a3")] == [1, 2, 3, 4, 5, 6]
+        release.set()
+        await asyncio.gather(blocking, *tasks)
+        assert order == ["a1", "b1", "c1", "c2", "a2", "a3"]
+        # Новые пользователи встают перед a3, а после освобождения очередь идёт только вперёд
+        assert positions["a3"][:4] == [3, 4, 5, 6]
+        assert positions["a3"][3:] == sorted(positions["a3"][3:], reverse=True)
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_queue_overflow_rejected():
+    async def scenario():
+        scheduler = FairScheduler(concurrency=1, max_queue=1, weights={})
+        release = asyncio.Event()
+
+        async def hold(key):
+            async with scheduler.slot(key):
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold("a")), asyncio.create_task(hold("b"))]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            async with scheduler.slot("c"):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+
+# ---------- общие лимиты в SQLite ----------
+
+def test_sqlite_take_permit_inflight_and_release(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            state = SQLiteState(pool)
+            first, reason, _ = await state.take_permit("u1", 2, 10.0, 10, 60)
+            second, _, _ = await state.take_permit("u1", 2, 10.0, 10, 60)
+            assert first and second and reason is None
+            assert await state.take_permit("u1", 2, 10.0, 10, 60) == (None, "inflight", 0)
+            # Лимит на ключ, а не общий
+            other, _, _ = await state.take_permit("u2", 2, 10.0, 10, 60)
+            assert other is not None
+
+            await state.release_permit("u1", first)
+            third, reason, _ = await state.take_permit("u1", 2, 10.0, 10, 60)
+            assert third is not None and reason is None
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_take_permit_rate(tmp_path, monkeypatch):
+    clock = FakeClock(1_700_000_000.0)
+    monkeypatch.setattr(shared_state.time, "time", clock)
+
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            state = SQLiteState(pool)
+            for _ in range(2):
+                permit, _, _ = await state.take_permit("u1", 100, 0.5, 2, 60)
+                assert permit is not None
+            permit, reason, wait = await state.take_permit("u1", 100, 0.5, 2, 60)
+            assert (permit, reason) == (None, "rate")
+            assert wait == pytest.approx(2.0)
+            clock.now += 2
+            permit, reason, _ = await state.take_permit("u1", 100, 0.5, 2, 60)
+            assert permit is not None and reason is None
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_expired_permits_do_not_count_and_are_swept(tmp_path, monkeypatch):
+    # Процесс упал, не отпустив допуск: через ttl допуск не мешает, sweep его удаляет
+    clock = FakeClock(1_700_000_000.0)
+    monkeypatch.setattr(shared_state.time, "time", clock)
+
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            state = SQLiteState(pool)
+            assert (await state.take_permit("u1", 1, 10.0, 10, 30))[0] is not None
+            assert (await state.take_permit("u1", 1, 10.0, 10, 30))[1] == "inflight"
+            clock.now += 31
+            assert (await state.take_permit("u1", 1, 10.0, 10, 30))[0] is not None
+
+            clock.now += 1000
+            await state.sweep_admission(bucket_idle=100)
+            async with pool.reader() as db:
+                permits = (await (await db.execute("SELECT COUNT(*) FROM admission_permits")).fetchone())[0]
+                buckets = (await (await db.execute("SELECT COUNT(*) FROM admission_buckets")).fetchone())[0]
+            assert (permits, buckets) == (0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_admission_control_over_sqlite_state(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            control = admission.AdmissionControl(max_inflight=1, rate_per_min=600, burst=10, state=SQLiteState(pool))
+            async with control.admit(42):
+                with pytest.raises(AdmissionRejected):
+                    async with control.admit(42):
+                        pass
+            async with control.admit(42):
+                pass
+            assert control.stats()["rejected_inflight"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,18 @@
+from bench.fingerprint_bench import check_corpus
+from bench.fingerprint_corpus import DISTINCT, SAME
+from error_fingerprint import fingerprint
+
+# Отпечаток — ключ базы знаний: смена значения для той же ошибки требует миграции с пересчётом
+PINNED = "ModuleNotFoundError: No module named 'aiogram'"
+
+
+def test_corpus_groups():
+    assert check_corpus(fingerprint) == []
+
+
+def test_fingerprint_is_stable():
+    for samples in (*SAME.values(), *DISTINCT.values()):
+        for sample in samples:
+            assert fingerprint(sample) == fingerprint(sample)
+    assert fingerprint(PINNED) == fingerprint("\n" + PINNED + "  \n")
+    assert len(fingerprint(PINNED)) == len(fingerprint("")) == 16
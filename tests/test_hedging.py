@@ -0,0 +1,100 @@
+import asyncio
+
+from hedging import hedged_race
+from http_client import UpstreamError
+from model_health import OPEN, ModelHealthRegistry
+
+
+def race(models, attempt, **kwargs):
+    options = {"hedge_delay": 0.05, "deadline_for": lambda model: 5.0, "budget": 5.0}
+    options.update(kwargs)
+    return hedged_race(models, attempt, **options)
+
+
+def test_hedge_wins_and_loser_is_cancelled():
+    async def scenario():
+        started, cancelled = [], []
+
+        async def attempt(model, first_byte):
+            started.append(model)
+            try:
+                if model == "slow":
+                    await asyncio.sleep(10)
+                first_byte.set()
+                return f"answer from {model}"
+            except asyncio.CancelledError:
+                cancelled.append(model)
+                raise
+
+        result = await race(["slow", "fast"], attempt)
+        await asyncio.sleep(0.01)  # отмена доходит до attempt через wait_for
+        assert result == ("fast", "answer from fast")
+        assert started == ["slow", "fast"] and cancelled == ["slow"]
+
+    asyncio.run(scenario())
+
+
+def test_no_hedge_once_first_byte_arrived():
+    async def scenario():
+        started = []
+
+        async def attempt(model, first_byte):
+            started.append(model)
+            first_byte.set()
+            await asyncio.sleep(0.2)  # отвечает медленно, но уже отвечает
+            return model
+
+        assert await race(["primary", "backup"], attempt) == ("primary", "primary")
+        assert started == ["primary"]
+
+    asyncio.run(scenario())
+
+
+def test_failure_starts_next_model_immediately():
+    async def scenario():
+        health = ModelHealthRegistry()
+
+        async def attempt(model, first_byte):
+            if model == "limited":
+                raise UpstreamError(429, "rate limited")
+            first_byte.set()
+            return model
+
+        result = await race(["limited", "ok"], attempt, hedge_delay=None, health=health)
+        assert result == ("ok", "ok")
+        assert health.snapshot()["limited"]["state"] == OPEN
+        # Открытая модель в следующем запросе пропускается
+        assert health.rank(["limited", "ok"]) == ["ok"]
+
+    asyncio.run(scenario())
+
+
+def test_budget_exhausted_returns_none_and_cancels():
+    async def scenario():
+        cancelled = []
+
+        async def attempt(model, first_byte):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(model)
+                raise
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await race(["a", "b"], attempt, budget=0.2) is None
+        assert loop.time() - started < 1
+        await asyncio.sleep(0.01)
+        assert sorted(cancelled) == ["a", "b"]
+
+    asyncio.run(scenario())
+
+
+def test_all_models_fail():
+    async def scenario():
+        async def attempt(model, first_byte):
+            raise RuntimeError(model)
+
+        assert await race(["a", "b", "c"], attempt) is None
+
+    asyncio.run(scenario())
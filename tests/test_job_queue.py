@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import job_queue
+from job_queue import JobQueue, RetryableJobError
+from tests.helpers import FakeClock, migrated_pool
+
+
+def test_claim_by_priority_then_fifo(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            queue = JobQueue(pool, workers=1, visibility_timeout=30, poll_interval=0.05)
+            queue.register("fix", lambda payload, on_progress: None)
+            low, _ = await queue.submit("fix", {"n": 1})
+            high, _ = await queue.submit("fix", {"n": 2}, priority=5)
+            low2, _ = await queue.submit("fix", {"n": 3})
+            assert (await queue.get(low2))["position"] == 3
+            claimed = [(await queue._claim())["id"] for _ in range(3)]
+            assert claimed == [high, low, low2]
+            assert await queue._claim() is None
+
+    asyncio.run(scenario())
+
+
+def test_token_lookup(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            queue = JobQueue(pool)
+            job_id, token = await queue.submit("fix", {})
+            assert await queue.find(token) == job_id
+            assert await queue.find(str(job_id)) is None
+
+    asyncio.run(scenario())
+
+
+def test_lease_expiry_reclaims_then_fails(tmp_path, monkeypatch):
+    # Воркер взял задачу и пропал: после таймаута невидимости её берёт другой,
+    # а когда попытки кончились — задача failed, а не крутится вечно
+    clock = FakeClock(time.time())
+    monkeypatch.setattr(job_queue.time, "time", clock)
+
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            lost = JobQueue(pool, visibility_timeout=30)
+            other = JobQueue(pool, visibility_timeout=30)
+            for queue in (lost, other):
+                queue.register("fix", lambda payload, on_progress: None)
+            job_id, _ = await lost.submit("fix", {}, max_attempts=2)
+
+            assert (await lost._claim())["attempts"] == 1
+            assert await other._claim() is None
+            clock.now += 31
+            assert (await other._claim())["attempts"] == 2
+            clock.now += 31
+            job = await other._claim()
+            assert job["attempts"] == 3
+            await other._run(job)
+            assert (await other.get(job_id))["status"] == "failed"
+            assert (await other.get(job_id))["error"] == "visibility timeout"
+
+            # Пропавший воркер вернулся: чужую задачу он не перезаписывает
+            await lost._finish(job_id, "done", result={"answer": "late"})
+            assert (await other.get(job_id))["status"] == "failed"
+
+    asyncio.run(scenario())
+
+
+def test_worker_runs_and_retries(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            queue = JobQueue(pool, workers=2, visibility_timeout=30, poll_interval=0.05)
+            calls = []
+
+            async def handler(payload, on_progress):
+                calls.append(payload["n"])
+                on_progress("delta", "par")
+                if len(calls) == 1:
+                    raise RetryableJobError("all models down")
+                return {"answer": payload["n"] * 2}
+
+            queue.register("fix", handler)
+            job_id, _ = await queue.submit("fix", {"n": 21}, max_attempts=3)
+            # Повтор через 2^попытка сек — чтобы не ждать, делаем задачу видимой сразу
+            queue.start()
+            try:
+                while queue.stats()["retried"] == 0:
+                    await asyncio.sleep(0.01)
+                async with pool.writer() as db:
+                    await db.execute("UPDATE jobs SET visible_at = 0 WHERE id = ?", (job_id,))
+                queue._wakeup.set()
+                job = await asyncio.wait_for(queue.wait(job_id), 5)
+            finally:
+                await queue.stop()
+            assert job["status"] == "done" and job["result"] == {"answer": 42}
+            assert job["attempts"] == 2 and calls == [21, 21]
+
+    asyncio.run(scenario())
@@ -0,0 +1,136 @@
+import asyncio
+
+import aiosqlite
+
+import migrations
+from bench.fingerprint_bench import legacy_hash
+from bench.fingerprint_corpus import SAME
+from error_fingerprint import fingerprint
+from migrations import MIGRATIONS, get_schema_version, migrate
+
+# Схема из init_database до появления миграций (user_version = 0)
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS solutions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        error_hash TEXT UNIQUE,
+        error_text TEXT,
+        error_type TEXT,
+        solution TEXT,
+        code_snippet TEXT,
+        success_count INTEGER DEFAULT 1,
+        fail_count INTEGER DEFAULT 0,
+        confidence REAL DEFAULT 0.5,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        error_hash TEXT,
+        rating TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        query TEXT,
+        response TEXT,
+        source TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
+
+# Одна ошибка с разными данными: прежние хэши разные, новый отпечаток один
+KEY_ERROR, KEY_ERROR_OTHER = SAME["py_key_error_data"]
+NO_MODULE = "ModuleNotFoundError: No module named 'aiogram'"
+
+
+async def seed(db: aiosqlite.Connection, rows: list[tuple[str, str, str]], ratings: list[tuple[str, str]]):
+    await db.executemany(
+        "INSERT INTO solutions (error_hash, error_text, error_type, solution, confidence) VALUES (?, ?, 'KeyError', ?, 0.9)",
+        rows,
+    )
+    await db.executemany("INSERT INTO ratings (user_id, error_hash, rating) VALUES (1, ?, ?)", ratings)
+    await db.commit()
+
+
+async def fetch(db: aiosqlite.Connection, sql: str) -> list:
+    return [tuple(row) for row in await (await db.execute(sql)).fetchall()]
+
+
+def test_baseline_db_is_rehashed(tmp_path):
+    async def scenario():
+        async with aiosqlite.connect(tmp_path / "kb.db") as db:
+            for sql in BASELINE_SCHEMA:
+                await db.execute(sql)
+            assert legacy_hash(KEY_ERROR) != legacy_hash(KEY_ERROR_OTHER)
+            assert fingerprint(KEY_ERROR) == fingerprint(KEY_ERROR_OTHER)
+            await seed(
+                db,
+                [
+                    (legacy_hash(KEY_ERROR), KEY_ERROR, "first"),
+                    (legacy_hash(KEY_ERROR_OTHER), KEY_ERROR_OTHER, "second"),
+                    (legacy_hash(NO_MODULE), NO_MODULE, "install aiogram"),
+                ],
+                [(legacy_hash(KEY_ERROR), "good"), (legacy_hash(KEY_ERROR_OTHER), "bad"), (legacy_hash(NO_MODULE), "good")],
+            )
+            assert await migrate(db) == MIGRATIONS[-1][0]
+
+            solutions = dict(await fetch(db, "SELECT solution, error_hash FROM solutions"))
+            # Совпавшие отпечатки: первая строка получает новый хэш, вторая остаётся со старым
+            assert solutions == {
+                "first": fingerprint(KEY_ERROR),
+                "second": legacy_hash(KEY_ERROR_OTHER),
+                "install aiogram": fingerprint(NO_MODULE),
+            }
+            ratings = await fetch(db, "SELECT error_hash, rating FROM ratings ORDER BY id")
+            assert ratings == [
+                (fingerprint(KEY_ERROR), "good"),
+                (legacy_hash(KEY_ERROR_OTHER), "bad"),
+                (fingerprint(NO_MODULE), "good"),
+            ]
+            # Материализованная статистика (v8) посчитана по уже существующим строкам
+            stats = dict(await fetch(db, "SELECT name, value FROM kb_stats"))
+            assert stats["total_solutions"] == 3 and stats["positive_ratings"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_v9_rehashes_hashes_left_by_v4(tmp_path, monkeypatch):
+    # База, доведённая до v8 прежним отпечатком: v9 пересчитывает хэши ещё раз
+    async def scenario():
+        async with aiosqlite.connect(tmp_path / "kb.db") as db:
+            for sql in BASELINE_SCHEMA:
+                await db.execute(sql)
+            await db.commit()
+            monkeypatch.setattr(migrations, "MIGRATIONS", [m for m in MIGRATIONS if m[0] <= 8])
+            assert await migrate(db) == 8
+            monkeypatch.setattr(migrations, "MIGRATIONS", MIGRATIONS)
+
+            stale = "0123456789abcdef"
+            await seed(db, [(stale, NO_MODULE, "install aiogram")], [(stale, "good")])
+
+            assert await migrate(db) == MIGRATIONS[-1][0]
+            assert await fetch(db, "SELECT error_hash FROM solutions") == [(fingerprint(NO_MODULE),)]
+            assert await fetch(db, "SELECT error_hash FROM ratings") == [(fingerprint(NO_MODULE),)]
+            # Повторный запуск ничего не делает
+            assert await migrate(db) == await get_schema_version(db)
+            assert await fetch(db, "SELECT error_hash FROM solutions") == [(fingerprint(NO_MODULE),)]
+
+    asyncio.run(scenario())
+
+
+def test_fresh_db_reaches_latest_version(tmp_path):
+    async def scenario():
+        async with aiosqlite.connect(tmp_path / "kb.db") as db:
+            assert await migrate(db) == MIGRATIONS[-1][0]
+            assert await get_schema_version(db) == MIGRATIONS[-1][0]
+            assert [target for target, _, _ in MIGRATIONS] == list(range(1, len(MIGRATIONS) + 1))
+
+    asyncio.run(scenario())
@@ -0,0 +1,70 @@
+import pytest
+
+import model_health
+from config import BREAKER_COOLDOWN, BREAKER_MIN_SAMPLES
+from model_health import CLOSED, HALF_OPEN, OPEN, ModelHealthRegistry
+from tests.helpers import FakeClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(model_health.time, "monotonic", clock)
+    return clock
+
+
+def state(health: ModelHealthRegistry, key: str = "m") -> str:
+    return health.snapshot()[key]["state"]
+
+
+def test_overload_trips_then_half_open_probe_closes(clock):
+    health = ModelHealthRegistry()
+    health.record_failure("m", 429)
+    assert state(health) == OPEN
+    assert health.rank(["m", "other"]) == ["other"]
+
+    clock.now += BREAKER_COOLDOWN
+    assert state(health) == HALF_OPEN
+    health.begin("m")
+    # Пока идёт проба, вторую попытку не пускаем
+    assert health.rank(["m", "other"]) == ["other"]
+
+    health.record_success("m", 0.5)
+    assert state(health) == CLOSED
+    assert health.rank(["m", "other"]) == ["m", "other"]
+
+
+def test_failed_probe_reopens_with_longer_cooldown(clock):
+    health = ModelHealthRegistry()
+    health.record_failure("m", 503)
+    clock.now += BREAKER_COOLDOWN
+    health.begin("m")
+    health.record_failure("m", 500)
+    assert state(health) == OPEN
+    clock.now += BREAKER_COOLDOWN
+    assert state(health) == OPEN  # cooldown * 2 ошибки подряд
+    clock.now += BREAKER_COOLDOWN
+    assert state(health) == HALF_OPEN
+
+
+def test_retry_after_extends_cooldown(clock):
+    health = ModelHealthRegistry()
+    health.record_failure("m", 429, BREAKER_COOLDOWN * 3)
+    clock.now += BREAKER_COOLDOWN * 2
+    assert state(health) == OPEN
+
+
+def test_error_rate_trips_after_min_samples(clock):
+    health = ModelHealthRegistry()
+    for _ in range(BREAKER_MIN_SAMPLES - 1):
+        health.record_failure("m", 500)
+        assert state(health) == CLOSED
+    health.record_failure("m", 500)
+    assert state(health) == OPEN
+
+
+def test_all_open_ranked_by_recovery(clock):
+    health = ModelHealthRegistry()
+    health.record_failure("a", 429, BREAKER_COOLDOWN * 2)
+    health.record_failure("b", 429)
+    assert health.rank(["a", "b"]) == ["b", "a"]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    async def scenario():
+        flights = SingleFlight()
+        calls = []
+
+        async def generate(publish):
+            calls.append(1)
+            publish("par")
+            await asyncio.sleep(0.05)
+            publish("partial")
+            return "answer"
+
+        seen = []
+        results = await asyncio.gather(*(flights.do("k", generate, seen.append) for _ in range(3)))
+        assert results == [("answer", False), ("answer", True), ("answer", True)]
+        assert len(calls) == 1
+        assert seen.count("partial") == 3
+        assert flights.stats()["in_flight"] == 0 and flights.stats()["coalesced"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_error_reaches_every_waiter_and_key_is_freed():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def failing(publish):
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(*(flights.do("k", failing) for _ in range(3)), return_exceptions=True)
+        assert [type(r) for r in results] == [RuntimeError] * 3
+        # Следующий вызов идёт заново, а не получает старую ошибку
+        assert await flights.do("k", lambda publish: asyncio.sleep(0, "ok")) == ("ok", False)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_call():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def generate(publish):
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        leader = asyncio.create_task(flights.do("k", generate))
+        follower = asyncio.create_task(flights.do("k", generate))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == ("answer", True)
+
+    asyncio.run(scenario())
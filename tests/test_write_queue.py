@@ -0,0 +1,67 @@
+import asyncio
+
+from tests.helpers import migrated_pool
+from write_queue import WriteBehindQueue
+
+INSERT = "INSERT INTO counters (name, value) VALUES (?, ?)"
+BUMP = "UPDATE counters SET value = value * 10 WHERE name = ?"
+
+
+def test_flush_applies_in_order_and_calls_back_after_commit(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            queue = WriteBehindQueue(pool, max_batch=50, max_delay=10, max_pending=100)
+            queue.start()
+            order, applied = [], {}
+
+            async def committed(name):
+                # Колбэк видит запись из другого соединения — значит, commit уже был
+                async with pool.reader() as db:
+                    row = await (await db.execute("SELECT value FROM counters WHERE name = ?", (name,))).fetchone()
+                applied[name] = row[0] if row else None
+
+            def on_applied(name):
+                def callback():
+                    order.append(name)
+                    callbacks.append(asyncio.ensure_future(committed(name)))
+                return callback
+
+            callbacks = []
+            # Порядок важен: UPDATE между INSERT одного SQL не должен уехать в конец пачки
+            await queue.put(INSERT, ("a", 1), on_applied("a"))
+            await queue.put(BUMP, ("a",))
+            await queue.put(INSERT, ("b", 2), on_applied("b"))
+            await queue.put(BUMP, ("b",))
+            await queue.put(INSERT, ("c", 3))
+            # flush не ждёт max_delay, даже если фоновая задача ещё не взяла первую запись
+            started = asyncio.get_running_loop().time()
+            await queue.flush()
+            assert asyncio.get_running_loop().time() - started < 2
+            await asyncio.gather(*callbacks)
+
+            async with pool.reader() as db:
+                rows = await (await db.execute("SELECT name, value FROM counters ORDER BY name")).fetchall()
+            assert [tuple(row) for row in rows] == [("a", 10), ("b", 20), ("c", 3)]
+            assert order == ["a", "b"] and applied == {"a": 10, "b": 20}
+            assert queue.stats()["batches"] == 1 and queue.stats()["applied"] == 5
+            await queue.close()
+
+    asyncio.run(scenario())
+
+
+def test_bad_write_is_dropped_alone(tmp_path):
+    async def scenario():
+        async with migrated_pool(tmp_path / "kb.db") as pool:
+            queue = WriteBehindQueue(pool, max_batch=50, max_delay=10, max_pending=100)
+            queue.start()
+            await queue.put(INSERT, ("a", 1))
+            await queue.put(INSERT, ("a", 2))  # PRIMARY KEY — вся пачка откатится
+            await queue.put(INSERT, ("b", 3))
+            await queue.close()
+
+            async with pool.reader() as db:
+                rows = await (await db.execute("SELECT name, value FROM counters ORDER BY name")).fetchall()
+            assert [tuple(row) for row in rows] == [("a", 1), ("b", 3)]
+            assert queue.stats()["dropped"] == 1
+
+    asyncio.run(scenario())
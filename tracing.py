@@ -0,0 +1,173 @@
+import json
+import logging
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from config import TRACE_ENABLED, TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_KEEP
+from log_setup import offload
+
+# ============================================
+# ТРАССИРОВКА ЗАПРОСОВ
+# ============================================
+# Трасса — один запрос (сообщение в боте, /api/fix), спаны — его стадии.
+# Текущие трасса и спан живут в contextvars, поэтому спаны внутри задач,
+# созданных из запроса (single-flight, хеджирование), попадают в ту же трассу.
+# Завершённые трассы: в память (последние TRACE_KEEP, для /traces) и в
+# TRACE_FILE строками JSON — доля TRACE_SAMPLE_RATE, медленные и с ошибкой всегда.
+
+MAX_SPANS = 200  # на трассу; дальше спаны не записываются
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_span: ContextVar[Optional["Span"]] = ContextVar("span", default=None)
+
+_writer = logging.getLogger("trace")
+_writer.propagate = False
+
+
+class Span:
+    __slots__ = ("id", "name", "parent", "start", "end", "attrs", "error")
+
+    def __init__(self, span_id: int, name: str, parent: Optional[int], attrs: dict):
+        self.id = span_id
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Trace:
+    def __init__(self, name: str, attrs: dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.error: Optional[str] = None
+        self.spans: list[Span] = []
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": round(self.wall_start, 3),
+            "duration_ms": round(self.duration * 1000, 1),
+            "attrs": self.attrs,
+            "error": self.error,
+            "spans": [
+                {
+                    "id": span.id,
+                    "name": span.name,
+                    "parent": span.parent,
+                    "start_ms": round((span.start - self.start) * 1000, 1),
+                    "duration_ms": round(((span.end or span.start) - span.start) * 1000, 1),
+                    "attrs": span.attrs,
+                    "error": span.error,
+                }
+                for span in self.spans
+            ],
+        }
+
+
+class _NoopSpan:
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+_recent: deque = deque(maxlen=TRACE_KEEP)
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def start_trace(name: str, **attrs):
+    """Корневой контекст запроса; вложенный вызов просто открывает спан"""
+    if not TRACE_ENABLED:
+        yield _NOOP
+        return
+    if _trace.get() is not None:
+        with span(name, **attrs) as sp:
+            yield sp
+        return
+    trace = Trace(name, attrs)
+    trace_token = _trace.set(trace)
+    span_token = _span.set(None)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.error = repr(e)
+        raise
+    finally:
+        trace.duration = time.perf_counter() - trace.start
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        _finish(trace)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    trace = _trace.get()
+    if trace is None or len(trace.spans) >= MAX_SPANS:
+        yield _NOOP
+        return
+    parent = _span.get()
+    sp = Span(len(trace.spans), name, parent.id if parent else None, attrs)
+    trace.spans.append(sp)
+    token = _span.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.error = repr(e)
+        raise
+    finally:
+        sp.end = time.perf_counter()
+        _span.reset(token)
+
+
+def _finish(trace: Trace):
+    _recent.append(trace)
+    slow = trace.duration * 1000 >= TRACE_SLOW_MS
+    if not (slow or trace.error or random.random() < TRACE_SAMPLE_RATE):
+        return
+    if not _writer.handlers:
+        handler = logging.FileHandler(TRACE_FILE, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _writer.addHandler(offload(handler))
+        _writer.setLevel(logging.INFO)
+    _writer.info(json.dumps(trace.to_dict(), ensure_ascii=False, default=str))
+
+
+def slowest(limit: int = 10, name: Optional[str] = None) -> list[dict]:
+    traces = [t for t in _recent if name is None or t.name == name]
+    traces.sort(key=lambda t: t.duration, reverse=True)
+    return [t.to_dict() for t in traces[:limit]]
+
+
+def breakdown(trace: dict, top: int = 5) -> list[tuple[str, float]]:
+    """
+    Куда ушло время: собственное время спанов (минус вложенные), сложенное
+    по имени, самые долгие первыми: [(имя, мс)]
+    """
+    children: dict[int, float] = {}
+    for s in trace["spans"]:
+        if s["parent"] is not None:
+            children[s["parent"]] = children.get(s["parent"], 0.0) + s["duration_ms"]
+    own: dict[str, float] = {}
+    for s in trace["spans"]:
+        # Параллельные попытки хеджирования могут дать детей длиннее родителя
+        own[s["name"]] = own.get(s["name"], 0.0) + max(0.0, s["duration_ms"] - children.get(s["id"], 0.0))
+    return sorted(own.items(), key=lambda item: item[1], reverse=True)[:top]
@@ -1,5 +1,9 @@
-import httpx
+import logging
+
 from config import GROQ_API_KEY
+from http_client import get_client
+
+logger = logging.getLogger(__name__)
 
 # Модели для текста
 TEXT_MODELS = [
@@ -16,20 +20,20 @@ async def ask_ai(messages: list, roast_mode=False) -> str:
     if roast_mode:
         messages[0]["content"] = "Ты — злой и смешной стендап-комик программист. Твоя задача — жестко, с сарказмом и черным юмором 'прожарить' код пользователя. Ищи костыли, плохие имена переменных и глупые ошибки. Не давай решений, только смейся."
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        for model in TEXT_MODELS:
-            try:
-                payload = {
-                    "model": model,
-                    "messages": messages,
-                    "temperature": 0.7 if not roast_mode else 1.0, # Для прожарки больше креатива
-                    "max_tokens": 3000
-                }
-                resp = await client.post("https://api.groq.com/openai/v1/chat/completions", headers=headers, json=payload)
-                if resp.status_code == 200:
-                    return resp.json()["choices"][0]["message"]["content"]
-            except: continue
-            
+    client = get_client("groq")
+    for model in TEXT_MODELS:
+        try:
+            payload = {
+                "model": model,
+                "messages": messages,
+                "temperature": 0.7 if not roast_mode else 1.0, # Для прожарки больше креатива
+                "max_tokens": 3000
+            }
+            resp = await client.post("/chat/completions", timeout=60.0, headers=headers, json=payload)
+            if resp.status_code == 200:
+                return resp.json()["choices"][0]["message"]["content"]
+        except: continue
+        
     return "🤯 Мозг перегрелся. Попробуй позже."
 
 # 2. Функция: ГОЛОС -> ТЕКСТ (Новая фича!)
@@ -38,14 +42,14 @@ async def transcribe_voice(file_bytes: bytes, filename: str) -> str:
     files = {'file': (filename, file_bytes, 'audio/ogg')}
     data = {'model': 'whisper-large-v3-turbo', 'language': 'ru'} # Супер быстрая модель
 
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.post("https://api.groq.com/openai/v1/audio/transcriptions", headers=headers, files=files, data=data)
-            if resp.status_code == 200:
-                return resp.json().get("text", "")
-            else:
-                print(f"Ошибка Whisper: {resp.text}")
-                return ""
-        except Exception as e:
-            print(f"Ошибка сети: {e}")
+    client = get_client("groq")
+    try:
+        resp = await client.post("/audio/transcriptions", headers=headers, files=files, data=data)
+        if resp.status_code == 200:
+            return resp.json().get("text", "")
+        else:
+            logger.warning("Whisper HTTP %d: %.200s", resp.status_code, resp.text)
             return ""
+    except Exception as e:
+        logger.warning("Whisper request failed: %r", e)
+        return ""
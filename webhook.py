@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot, Dispatcher, types
+
+from config import WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================
+# ОБРАБОТКА АПДЕЙТОВ ИЗ WEBHOOK
+# ============================================
+# Эндпоинт только кладёт апдейт в очередь и сразу отвечает Telegram 200,
+# а обрабатывают его WEBHOOK_WORKERS воркеров: долгий ответ ИИ не держит
+# HTTP-запрос Telegram, и одновременно работает не больше воркеров.
+# Очередь полна — submit() возвращает False, эндпоинт отвечает 503, и
+# Telegram доставит апдейт повторно.
+class UpdateWorkers:
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: list[asyncio.Task] = []
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Даёт воркерам дообработать очередь, затем останавливает их"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Webhook queue not drained: %d updates dropped", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, update: types.Update) -> bool:
+        try:
+            self._queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def _worker(self):
+        while True:
+            update: Optional[types.Update] = await self._queue.get()
+            self.busy += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Update %s failed: %r", update.update_id, e)
+            finally:
+                self.busy -= 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "queued": self._queue.qsize(),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
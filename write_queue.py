@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from itertools import groupby
+from typing import Callable, Optional
+
+from config import WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_QUEUE_MAX
+from db_pool import kb_pool
+from metrics import DB_WRITE_SECONDS, DB_WRITE_BATCH
+
+logger = logging.getLogger(__name__)
+
+OnApplied = Optional[Callable[[], None]]
+
+
+# ============================================
+# ОТЛОЖЕННАЯ ЗАПИСЬ (WRITE-BEHIND)
+# ============================================
+# Запись ставится в очередь и сразу возвращает управление — ответ пользователю
+# не ждёт fsync. Фоновая задача собирает пачку (до max_batch записей или
+# max_delay сек с первой) и применяет её одной транзакцией; одинаковые
+# запросы подряд идут через executemany. on_applied вызывается после commit —
+# там сбрасывают кэш и обновляют индекс. Полная очередь тормозит put().
+class WriteBehindQueue:
+    def __init__(
+        self,
+        pool,
+        max_batch: int = WRITE_BATCH_SIZE,
+        max_delay: float = WRITE_FLUSH_INTERVAL,
+        max_pending: int = WRITE_QUEUE_MAX,
+    ):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._flushing = 0
+        self.applied = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, sql: str, params: tuple = (), on_applied: OnApplied = None):
+        await self._queue.put((sql, params, on_applied))
+        if self._queue.qsize() >= self.max_batch:
+            self._full.set()
+
+    async def flush(self):
+        """Ждёт, пока всё поставленное в очередь будет записано"""
+        # Пока кто-то ждёт flush, пачка не копит max_delay: иначе _run сбросил бы
+        # _full, если взял первую запись уже после вызова flush
+        self._flushing += 1
+        self._full.set()
+        try:
+            await self._queue.join()
+        finally:
+            self._flushing -= 1
+
+    async def close(self):
+        self._closing = True
+        if self._task is not None:
+            await self.flush()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if not self._closing and not self._flushing and self._queue.qsize() < self.max_batch - 1:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._apply(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _apply(self, batch: list):
+        started = time.perf_counter()
+        try:
+            async with self.pool.writer() as db:
+                for sql, group in groupby(batch, key=lambda item: item[0]):
+                    await db.executemany(sql, [params for _, params, _ in group])
+            DB_WRITE_SECONDS.observe(time.perf_counter() - started)
+            DB_WRITE_BATCH.observe(len(batch))
+        except Exception as e:
+            # Одна плохая запись не должна уносить всю пачку — повторяем по одной
+            logger.warning("Write batch of %d failed (%r), retrying one by one", len(batch), e)
+            applied = []
+            for item in batch:
+                try:
+                    async with self.pool.writer() as db:
+                        await db.execute(item[0], item[1])
+                    applied.append(item)
+                except Exception as e:
+                    self.dropped += 1
+                    logger.error("Write dropped: %r (%s)", e, " ".join(item[0].split()[:3]))
+            batch = applied
+        self.batches += 1
+        self.applied += len(batch)
+        for _, _, on_applied in batch:
+            if on_applied is not None:
+                try:
+                    on_applied()
+                except Exception as e:
+                    logger.warning("Write callback failed: %r", e)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "applied": self.applied,
+            "batches": self.batches,
+            "dropped": self.dropped,
+        }
+
+
+kb_writes = WriteBehindQueue(kb_pool)